@@ -1,11 +1,19 @@
+import os
+import sys
 import argparse
 import logging
 import logging.config
+import cProfile
+import importlib
+import tracemalloc
 
-from test.test import run_tests
-from src.score_model import run_scoring
-from src.generate_features import run_features
-from src.train_model import run_training
+
+def command(module, function):
+    """Gets a function that runs `module.function(args)`, importing `module` only when the command is run, so that
+    each command only pays for importing the dependencies of its own code path."""
+    def run(args):
+        return getattr(importlib.import_module(module), function)(args)
+    return run
 
 
 if __name__ == '__main__':
@@ -13,6 +21,12 @@ if __name__ == '__main__':
     logging.config.fileConfig("config/logging/local.conf")
     logger = logging.getLogger("run")
     parser = argparse.ArgumentParser(description="Run components of the model source code")
+    parser.add_argument("--report", default=None,
+                        help="Path to save a JSON report of the time, CPU and memory taken by each stage (optional)")
+    parser.add_argument("--profile", default=None,
+                        help="Path to save cProfile stats of the run to, readable with pstats or snakeviz (optional)")
+    parser.add_argument("--trace_memory", default=False, action="store_true",
+                        help="Trace memory allocations so that the report includes the peak memory of each stage")
     subparsers = parser.add_subparsers()
 
     # FEATURE subparser
@@ -20,26 +34,111 @@ if __name__ == '__main__':
     sb_features.add_argument('--config', help='path to yaml file with configurations')
     sb_features.add_argument('--csv', default=None, help="Path to CSV for input to model scoreing")
     sb_features.add_argument('--save', default=None, help='Path to where the dataset should be saved to (optional')
-    sb_features.set_defaults(func=run_features)
+    sb_features.set_defaults(func=command("src.generate_features", "run_features"))
+
+    # SPLIT subparser
+    sb_split = subparsers.add_parser("split_data", description="Split data into train, test and validate sets")
+    sb_split.add_argument('--config', help='path to yaml file with configurations')
+    sb_split.add_argument('--csv', default=None, help="Path to CSV for input to splitting")
+    sb_split.add_argument('--save', default=None, help='Prefix of the paths to save each split to (optional)')
+    sb_split.add_argument('--chunksize', default=None, type=int,
+                          help='Number of rows to read and split at a time, all at once if not given (optional)')
+    sb_split.set_defaults(func=command("src.train_model", "run_split"))
 
     # TRAIN subparser
     sb_train = subparsers.add_parser("train_model", description="Train model")
     sb_train.add_argument('--config', help='path to yaml file with configurations')
     sb_train.add_argument('--csv', default=None, help="Path to CSV for input to model training")
     sb_train.add_argument('--save', default=None, help='Path to where the dataset should be saved to (optional')
-    sb_train.set_defaults(func=run_training)
+    sb_train.set_defaults(func=command("src.train_model", "run_training"))
+
+    # SEARCH subparser
+    sb_search = subparsers.add_parser("search_model", description="Search for the best parameters of a model")
+    sb_search.add_argument('--config', help='path to yaml file with configurations')
+    sb_search.add_argument('--csv', default=None, help="Path to CSV for input to model training")
+    sb_search.add_argument('--save', default=None, help='Path to save the best model to (optional)')
+    sb_search.add_argument('--n_jobs', default=None, type=int,
+                           help='Number of trials run at once, -1 for all cores (optional)')
+    sb_search.set_defaults(func=command("src.search_model", "run_search"))
 
     # SCORE subparser
     sb_score = subparsers.add_parser("score_model", description="Score model")
     sb_score.add_argument('--config', help='path to yaml file with configurations')
     sb_score.add_argument('--csv', default=None, help="Path to CSV for input to model scoring")
     sb_score.add_argument('--save', default=None, help='Path to where the dataset should be saved to (optional')
-    sb_score.set_defaults(func=run_scoring)
+    sb_score.add_argument('--n_jobs', default=None, type=int,
+                          help='Number of processes to score across, -1 for all cores (optional)')
+    sb_score.set_defaults(func=command("src.score_model", "run_scoring"))
+
+    # SERVE subparser
+    sb_serve = subparsers.add_parser("serve_model", description="Serve model scores over HTTP")
+    sb_serve.add_argument('--config', help='path to yaml file with configurations')
+    sb_serve.add_argument('--host', default=None, help='Host to listen on (optional)')
+    sb_serve.add_argument('--port', default=None, type=int, help='Port to listen on (optional)')
+    sb_serve.set_defaults(func=command("src.score_server", "run_server"))
+
+    # PIPELINE subparser
+    sb_pipeline = subparsers.add_parser("pipeline", description="Run the stages of the pipeline in one process")
+    sb_pipeline.add_argument('--config', help='path to yaml file with configurations')
+    sb_pipeline.add_argument('--stages', default=None,
+                             help='Comma-separated stages to run, by default every stage configured (optional)')
+    sb_pipeline.add_argument('--n_jobs', default=None, type=int,
+                             help='Number of stages that can run at once (optional)')
+    sb_pipeline.set_defaults(func=command("src.pipeline", "run_pipeline"))
+
+    # EVALUATE subparser
+    sb_evaluate = subparsers.add_parser("evaluate_model",
+                                        description="Evaluate predicted probabilities against targets")
+    sb_evaluate.add_argument('--config', help='path to yaml file with configurations')
+    sb_evaluate.add_argument('--scores',
+                             help="Path to CSV or Parquet file of the predicted probabilities, not labels")
+    sb_evaluate.add_argument('--targets', help="Path to CSV or Parquet file of the targets of the same rows")
+    sb_evaluate.add_argument('--save', default=None, help='Path to save the evaluation to as JSON (optional)')
+    sb_evaluate.add_argument('--n_jobs', default=None, type=int,
+                             help='Number of processes to compute bootstrap replicates in, -1 for all cores (optional)')
+    sb_evaluate.set_defaults(func=command("src.evaluate_model", "run_evaluation"))
 
     # TEST subparser
     sb_test = subparsers.add_parser("test", description="Test whether the expected outputs are produced")
     sb_test.add_argument("--path", default="test/test_config.yml", help="Path to the test configuration file")
-    sb_test.set_defaults(func=run_tests)
+    sb_test.add_argument("--n_jobs", default=None, type=int, help="Number of tests run at once (optional)")
+    sb_test.add_argument("--timeout", default=None, type=float, help="Seconds each test command may take (optional)")
+    sb_test.set_defaults(func=command("test.test", "run_tests"))
+
+    # BENCHMARK subparser
+    sb_benchmark = subparsers.add_parser("benchmark", description="Benchmark each stage of the pipeline")
+    sb_benchmark.add_argument("--path", default="test/benchmark_config.yml",
+                              help="Path to the benchmark configuration file")
+    sb_benchmark.add_argument("--update_baseline", default=False, action="store_true",
+                              help="Save the results as the new baseline instead of comparing to them")
+    sb_benchmark.add_argument("--startup", default=False, action="store_true",
+                              help="Only benchmark the import time of run.py and the src modules")
+    sb_benchmark.add_argument("--large", default=False, action="store_true",
+                              help="Also benchmark the large_sizes of the data, up to 1e8 rows")
+    sb_benchmark.set_defaults(func=command("test.benchmark", "run_benchmarks"))
 
     args = parser.parse_args()
-    args.func(args)
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    if args.report is not None:
+        from src.helpers import Timer
+        Timer.keep_records = True
+
+    profiler = cProfile.Profile() if args.profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        args.func(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info("Profile of the run saved to %s", args.profile)
+
+        if args.report is not None:
+            from src.helpers import write_report
+            write_report(args.report, command=" ".join(sys.argv[1:]), cwd=os.getcwd(),
+                         traced_memory=args.trace_memory)
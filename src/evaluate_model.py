@@ -0,0 +1,336 @@
+import json
+import yaml
+import logging
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from src.helpers import Timer, resolve_n_jobs, read_frame, read_frame_chunks, align_chunks
+
+logger = logging.getLogger(__name__)
+
+# Number of score bins of the tables built chunk by chunk, whose AUC treats scores in the same bin as ties
+default_n_bins = 65536
+
+# Keys of the `evaluate_model` configuration that say how to read score files rather than how to evaluate scores
+file_config_keys = ["chunksize", "score_column", "target_column"]
+
+# Metrics that rank or weigh rows by their predicted probability, so are meaningless for predicted labels
+probability_metrics = ["auc", "logloss"]
+
+# Score table of a bootstrap worker process, set once per process by `_init_worker()`
+_worker_table = None
+
+
+def score_table(y, y_score, threshold=0.5, n_bins=None, eps=1e-15):
+    """Summarizes targets and predicted probabilities in one vectorized pass as a table of the number of rows, their
+    summed log loss and the number classified correctly, for each score (or score bin) and target.
+
+    Every metric of `metrics` is computed from this table alone, so scores are sorted once however many metrics are
+    computed, and tables of chunks of data can be added together.
+
+    Args:
+        y: Array of targets, 0 or 1
+        y_score: Array of predicted probabilities of the positive class
+        threshold: Probability above which a row is classified as positive
+        n_bins: Number of equally wide bins of probabilities to group scores into. If not given, each distinct score
+            is its own group, which sorts the scores but keeps AUC exact
+        eps: Probabilities are clipped to [eps, 1 - eps] when computing the log loss
+
+    Returns: Dictionary of `count`, `loss` and `correct`, each an array of shape (n_groups, 2) of the rows of each
+        score group, in increasing order, with targets 0 and 1
+
+    """
+    y = np.asarray(y, dtype=float).ravel()
+    y_score = np.asarray(y_score, dtype=float).ravel()
+
+    if len(y) != len(y_score):
+        raise ValueError("%i targets and %i scores given, there must be as many of each" % (len(y), len(y_score)))
+    if not np.isin(y, [0, 1]).all():
+        raise ValueError("Targets must be 0 or 1")
+
+    if n_bins is None:
+        groups = np.unique(y_score, return_inverse=True)[1].ravel()
+        n_groups = groups.max() + 1 if len(groups) > 0 else 0
+    else:
+        groups = np.minimum((np.clip(y_score, 0, 1) * n_bins).astype(int), n_bins - 1)
+        n_groups = n_bins
+
+    probability = np.clip(y_score, eps, 1 - eps)
+    loss = -np.where(y == 1, np.log(probability), np.log1p(-probability))
+    correct = (y == (y_score > threshold))
+
+    cells = groups * 2 + y.astype(int)
+    return dict(count=np.bincount(cells, minlength=2 * n_groups).reshape(-1, 2).astype(float),
+                loss=np.bincount(cells, weights=loss, minlength=2 * n_groups).reshape(-1, 2),
+                correct=np.bincount(cells, weights=correct, minlength=2 * n_groups).reshape(-1, 2))
+
+
+def _labels_only(y_score):
+    return bool(np.isin(np.asarray(y_score, dtype=float), [0, 1]).all())
+
+
+def _check_probabilities(labels_only, metrics_to_use=None):
+    """Raises a ValueError if scores that are all 0 or 1, e.g. labels saved by a model's `predict()`, are to be
+    evaluated with metrics of `probability_metrics`, which need predicted probabilities."""
+    metrics_to_use = list(metrics) if metrics_to_use is None else metrics_to_use
+    metrics_to_use = [metrics_to_use] if type(metrics_to_use) != list else metrics_to_use
+
+    needed = [metric for metric in metrics_to_use if metric in probability_metrics]
+    if labels_only and len(needed) > 0:
+        raise ValueError("Scores are all 0 or 1, so look like predicted labels rather than the probabilities that %s "
+                         "need. Score with `score_model: method: predict_proba` to save probabilities of the positive "
+                         "class, or only compute accuracy" % ", ".join(needed))
+
+
+def add_tables(table, other):
+    """Adds the score tables of two chunks of data binned the same way."""
+    if table is None:
+        return other
+    return {k: table[k] + other[k] for k in table}
+
+
+def _auc(count, loss, correct):
+    negatives, positives = count[..., 0], count[..., 1]
+    # Negatives scored lower than each group, counting those with the same score as half
+    below = np.cumsum(negatives, axis=-1) - 0.5 * negatives
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (positives * below).sum(axis=-1) / (positives.sum(axis=-1) * negatives.sum(axis=-1))
+
+
+def _logloss(count, loss, correct):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return loss.sum(axis=(-2, -1)) / count.sum(axis=(-2, -1))
+
+
+def _accuracy(count, loss, correct):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return correct.sum(axis=(-2, -1)) / count.sum(axis=(-2, -1))
+
+
+# Metrics of binary classifiers, each computed from the `count`, `loss` and `correct` of a `score_table()`
+metrics = dict(auc=_auc, logloss=_logloss, accuracy=_accuracy)
+
+
+def _init_worker(table):
+    global _worker_table
+    _worker_table = table
+
+
+def _bootstrap_replicates(args):
+    """Computes metrics of bootstrap replicates of `_worker_table`, one for each seed given."""
+    seeds, metrics_to_use = args
+    count = _worker_table["count"]
+
+    # Rows of the same score and target have the same loss and correctness, so reweighting each row by a Poisson(1)
+    # draw, the Poisson bootstrap, is the same as drawing a Poisson(count) number of each group's rows
+    with np.errstate(invalid="ignore", divide="ignore"):
+        loss_per_row = np.where(count > 0, _worker_table["loss"] / count, 0)
+        correct_per_row = np.where(count > 0, _worker_table["correct"] / count, 0)
+
+    values = np.empty((len(seeds), len(metrics_to_use)))
+    for i, seed in enumerate(seeds):
+        replicate = np.random.RandomState(seed).poisson(count).astype(float)
+        for j, metric in enumerate(metrics_to_use):
+            values[i, j] = metrics[metric](replicate, replicate * loss_per_row, replicate * correct_per_row)
+    return values
+
+
+def bootstrap_intervals(table, metrics_to_use, n_bootstraps=1000, confidence=0.95, n_jobs=1, random_state=24):
+    """Computes percentile bootstrap confidence intervals of metrics from a score table, with the replicates split
+    across `n_jobs` worker processes.
+
+    Each replicate draws new counts of the rows of each score group, so costs as much as the number of groups rather
+    than the number of rows. Every replicate has its own seed, so the intervals do not depend on `n_jobs`.
+
+    Args:
+        table: Score table from `score_table()`
+        metrics_to_use: List of keys of `metrics`
+        n_bootstraps: Number of bootstrap replicates
+        confidence: Confidence level of the intervals, e.g. 0.95 for the 2.5th to 97.5th percentiles
+        n_jobs: Number of worker processes, negative to count back from all cores (e.g. -1 to use all cores)
+        random_state: Seed of the replicates
+
+    Returns: Dictionary of the lower and upper bound of the interval of each metric
+
+    """
+    n_jobs = min(resolve_n_jobs(n_jobs), n_bootstraps)
+    seeds = [random_state + i for i in range(n_bootstraps)]
+    tasks = [(part.tolist(), metrics_to_use) for part in np.array_split(np.array(seeds), n_jobs)]
+
+    with Timer("bootstrap", logger, rows=n_bootstraps):
+        if n_jobs == 1:
+            _init_worker(table)
+            values = [_bootstrap_replicates(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(processes=n_jobs, initializer=_init_worker, initargs=(table,)) as pool:
+                values = pool.map(_bootstrap_replicates, tasks)
+    values = np.concatenate(values)
+
+    tail = 100 * (1 - confidence) / 2
+    return {metric: [float(np.nanpercentile(values[:, j], tail)), float(np.nanpercentile(values[:, j], 100 - tail))]
+            for j, metric in enumerate(metrics_to_use)}
+
+
+def evaluate_table(table, metrics_to_use=None, save_evaluation=None, n_bootstraps=0, confidence=0.95, n_jobs=1,
+                   random_state=24):
+    """Computes metrics, and optionally their bootstrap confidence intervals, from a score table.
+
+    Args:
+        table: Score table from `score_table()`, or the sum of those of chunks of data from `add_tables()`
+        metrics_to_use: List of keys of `metrics` to compute, all of them if not given
+        save_evaluation: Path to save the evaluation to as JSON (optional)
+        n_bootstraps: Number of bootstrap replicates of the confidence intervals, none are computed if 0
+        confidence: Confidence level of the intervals
+        n_jobs: Number of processes the bootstrap replicates are computed in
+        random_state: Seed of the bootstrap replicates
+
+    Returns: Dictionary of the value of each metric, and of `confidence_intervals` if `n_bootstraps` is given
+
+    """
+    metrics_to_use = list(metrics) if metrics_to_use is None else metrics_to_use
+    metrics_to_use = [metrics_to_use] if type(metrics_to_use) != list else metrics_to_use
+
+    unknown = [metric for metric in metrics_to_use if metric not in metrics]
+    if len(unknown) > 0:
+        raise ValueError("%s are not metrics, options are %s" % (", ".join(unknown), ", ".join(metrics)))
+
+    evaluation = {metric: float(metrics[metric](**table)) for metric in metrics_to_use}
+    for metric, value in evaluation.items():
+        logger.info("%s: %0.4f", metric, value)
+
+    if n_bootstraps > 0:
+        intervals = bootstrap_intervals(table, metrics_to_use, n_bootstraps=n_bootstraps, confidence=confidence,
+                                        n_jobs=n_jobs, random_state=random_state)
+        for metric, (lower, upper) in intervals.items():
+            logger.info("%s %i%% confidence interval: %0.4f to %0.4f", metric, round(100 * confidence), lower, upper)
+        evaluation["confidence_intervals"] = intervals
+
+    if save_evaluation is not None:
+        with open(save_evaluation, "w") as f:
+            json.dump(evaluation, f, indent=2)
+        logger.info("Evaluation saved to %s", save_evaluation)
+
+    return evaluation
+
+
+def evaluate_model(y, y_score, metrics_to_use=None, save_evaluation=None, threshold=0.5, n_bins=None, **kwargs):
+    """Evaluates the predicted probabilities of a binary classifier against the targets.
+
+    Args:
+        y: Array of targets, 0 or 1
+        y_score: Array of predicted probabilities of the positive class. Scores that are all 0 or 1 are taken to be
+            predicted labels, and raise a ValueError if AUC or log loss are to be computed
+        metrics_to_use: List of keys of `metrics` to compute, all of them if not given
+        save_evaluation: Path to save the metrics to as JSON (optional)
+        threshold: Probability above which a row is classified as positive when computing the accuracy
+        n_bins: Number of bins to group scores into, see `score_table()`. Scores are not binned if not given
+        **kwargs: Keyword arguments to `evaluate_table()`, e.g. `n_bootstraps` and `n_jobs`
+
+    Returns: Dictionary of the value of each metric, and of `confidence_intervals` if `n_bootstraps` is given
+
+    """
+    _check_probabilities(_labels_only(y_score), metrics_to_use)
+
+    with Timer("evaluation", logger, rows=len(y_score)):
+        table = score_table(y, y_score, threshold=threshold, n_bins=n_bins)
+    return evaluate_table(table, metrics_to_use=metrics_to_use, save_evaluation=save_evaluation, **kwargs)
+
+
+def evaluate_chunks(chunks, metrics_to_use=None, save_evaluation=None, threshold=0.5, n_bins=default_n_bins,
+                    **kwargs):
+    """Evaluates predicted probabilities chunk by chunk, e.g. of score files too large to hold in memory, holding only
+    one chunk and a table of `n_bins` score bins in memory at a time.
+
+    Log loss and accuracy are exact. AUC counts scores in the same bin as ties, so is within the fraction of pairs of
+    rows whose scores share a bin of the exact AUC.
+
+    Args:
+        chunks: Iterator of the targets and predicted probabilities of each chunk
+        metrics_to_use: List of keys of `metrics` to compute, all of them if not given
+        save_evaluation: Path to save the metrics to as JSON (optional)
+        threshold: Probability above which a row is classified as positive when computing the accuracy
+        n_bins: Number of equally wide bins of probabilities to group scores into
+        **kwargs: Keyword arguments to `evaluate_table()`, e.g. `n_bootstraps` and `n_jobs`
+
+    Returns: Dictionary of the value of each metric, and of `confidence_intervals` if `n_bootstraps` is given
+
+    """
+    table, n_rows, labels_only = None, 0, True
+    with Timer("evaluation", logger) as timer:
+        for y, y_score in chunks:
+            table = add_tables(table, score_table(y, y_score, threshold=threshold, n_bins=n_bins))
+            n_rows += len(y_score)
+            labels_only = labels_only and _labels_only(y_score)
+        timer.rows = n_rows
+
+    if table is None:
+        raise ValueError("No scores were given to evaluate")
+    _check_probabilities(labels_only, metrics_to_use)
+
+    return evaluate_table(table, metrics_to_use=metrics_to_use, save_evaluation=save_evaluation, **kwargs)
+
+
+def read_scored_chunks(targets, scores, chunksize, target_column=None, score_column=None):
+    """Reads the targets and scores of the same rows from two CSV or Parquet files chunk by chunk.
+
+    Args:
+        targets: Path to the targets, e.g. the targets of a split saved by `split_data()`
+        scores: Path to the predicted probabilities, e.g. saved by `score_model()`
+        chunksize: Number of rows read from each file at a time
+        target_column: Column of the targets, the last column of `targets` if not given
+        score_column: Column of the scores, the last column of `scores` if not given
+
+    Returns: Iterator of the targets and scores of each chunk
+
+    """
+    unmatched = {}
+    for offset, target_chunk, score_chunk in align_chunks(read_frame_chunks(targets, chunksize),
+                                                          read_frame_chunks(scores, chunksize), unmatched):
+        y = target_chunk[target_column] if target_column is not None else target_chunk.iloc[:, -1]
+        y_score = score_chunk[score_column] if score_column is not None else score_chunk.iloc[:, -1]
+        yield y.to_numpy(), y_score.to_numpy()
+
+    if unmatched["left"] > 0 or unmatched["right"] > 0:
+        raise ValueError("%s and %s do not have the same number of rows" % (targets, scores))
+
+
+def run_evaluation(args):
+    with open(args.config, "r") as f:
+        config = yaml.load(f)
+
+    evaluate_config = {k: v for k, v in config["evaluate_model"].items() if k not in file_config_keys + ["split"]}
+    evaluate_config["metrics_to_use"] = evaluate_config.pop("metrics", None)
+    if args.save is not None:
+        evaluate_config["save_evaluation"] = args.save
+    if getattr(args, "n_jobs", None) is not None:
+        evaluate_config["n_jobs"] = args.n_jobs
+
+    target_column = config["evaluate_model"].get("target_column")
+    score_column = config["evaluate_model"].get("score_column")
+    chunksize = config["evaluate_model"].get("chunksize")
+
+    if chunksize is not None:
+        chunks = read_scored_chunks(args.targets, args.scores, chunksize, target_column=target_column,
+                                    score_column=score_column)
+        evaluate_chunks(chunks, **evaluate_config)
+        return
+
+    targets, scores = read_frame(args.targets), read_frame(args.scores)
+    evaluate_model(targets[target_column] if target_column is not None else targets.iloc[:, -1],
+                   scores[score_column] if score_column is not None else scores.iloc[:, -1], **evaluate_config)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate predicted probabilities against targets")
+    parser.add_argument('--config', help='path to yaml file with configurations')
+    parser.add_argument('--scores', help='Path to CSV or Parquet file of the predicted probabilities')
+    parser.add_argument('--targets', help='Path to CSV or Parquet file of the targets of the same rows')
+    parser.add_argument('--save', default=None, help='Path to save the evaluation to as JSON (optional)')
+    parser.add_argument('--n_jobs', default=None, type=int,
+                        help='Number of processes bootstrap replicates are computed in (optional)')
+
+    args = parser.parse_args()
+
+    run_evaluation(args)
@@ -2,13 +2,13 @@ import logging
 import argparse
 import yaml
 import os
-import subprocess
-import re
-import boto3
-import sqlalchemy
+import inspect
+import pickle
+import numpy as np
 import pandas as pd
 
 from src.load_data import load_data, read_csv
+from src.helpers import Timer, save_frame, FrameWriter
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +33,7 @@ def choose_features(df, features_to_use=None, save_path=None, target=None, **kwa
         X = df
 
     if save_path is not None:
-        X.to_csv(save_path, **kwargs)
+        save_frame(X, save_path, **kwargs)
 
     return X
 
@@ -43,12 +43,12 @@ def get_target(df, target, save_path=None, **kwargs):
     y = df[target]
 
     if save_path is not None:
-        y.to_csv(save_path, **kwargs)
+        save_frame(y, save_path, **kwargs)
 
     return y.values
 
 
-def bin_values(df, columns, bins=None, quartiles=None, new_column=False, **kwargs):
+def bin_values(df, columns, bins=None, quartiles=None, new_column=False, edges=None, **kwargs):
     columns = [columns] if type(columns) != list else columns
 
     if bins is not None and quartiles is not None:
@@ -57,8 +57,10 @@ def bin_values(df, columns, bins=None, quartiles=None, new_column=False, **kwarg
         raise ValueError("Specify bins or quartiles")
     else:
         for j, column in enumerate(columns):
-            column_name = "%s_binned" if new_column else column
-            if bins is not None:
+            column_name = "%s_binned" % column if new_column else column
+            if edges is not None and column in edges:
+                df[column_name] = bin_with_edges(df[column], edges[column])
+            elif bins is not None:
                 bins_input = bins[j] if type(bins) == list and len(bins) == len(columns) else bins
                 df[column_name] = pd.cut(df[column], bins=bins_input, labels=range(bins_input))
             else:
@@ -69,11 +71,34 @@ def bin_values(df, columns, bins=None, quartiles=None, new_column=False, **kwarg
     return df
 
 
-def make_categorical(df, columns, one_hot=False, **kwargs):
+def bin_with_edges(values, edges):
+    """Bins values given the bin edges learned by `FeaturePipeline.fit()` with a vectorized binary search.
+
+    Bins include their right edge, as with `pd.cut()`. Values below the first or above the last edge are put in the
+    first or last bin rather than being left missing, so scoring data outside the range of the training data is
+    still binned.
+
+    Args:
+        values: Array-like of values to bin
+        edges: List of bin edges
+
+    Returns: `pd.Categorical` of bin labels 0 to len(edges) - 2
+
+    """
+    values = np.asarray(values, dtype=float)
+
+    codes = np.searchsorted(edges[1:-1], values, side="left")
+    codes[np.isnan(values)] = -1
+
+    return pd.Categorical.from_codes(codes, categories=range(len(edges) - 1), ordered=True)
+
+
+def make_categorical(df, columns, one_hot=False, sparse=False, **kwargs):
     columns = [columns] if type(columns) != list else columns
 
     for column in columns:
         one_hot_col = False
+        categories = None
         if column in kwargs:
             if "read_csv" in kwargs[column]:
                 categories = read_csv(**kwargs[column]["read_csv"])
@@ -88,42 +113,399 @@ def make_categorical(df, columns, one_hot=False, **kwargs):
         df[column] = pd.Categorical(df[column], categories=categories)
 
         if one_hot or one_hot_col:
-            df = one_hot_encode(df, column)
+            df = one_hot_encode(df, column, sparse=sparse)
 
     return df
 
 
-def one_hot_encode(df, columns, drop_original=True):
+def one_hot_encode(df, columns, drop_original=True, categories=None, sparse=False):
     columns = [columns] if type(columns) != list else columns
 
     for column in columns:
-        dummies = pd.get_dummies(df[column])
+        if categories is not None and column in categories:
+            # Fixes the dummy column layout to the categories learned in training, whatever values are in df
+            dummies = pd.get_dummies(pd.Categorical(df[column], categories=categories[column]), sparse=sparse)
+        else:
+            dummies = pd.get_dummies(df[column], sparse=sparse)
+
         dummies.columns = ["%s_dummy_%i" % (column, j) for j in range(len(dummies.columns))]
+
         df = pd.concat([df, dummies], axis=1)
 
-    if drop_original:
-        df = df.drop(labels=columns, axis=1)
+        if drop_original:
+            del df[column]
 
     return df
 
 
-def generate_features(df, save_dataset=None, **kwargs):
+def has_sparse_columns(df):
+    return any(isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes)
+
+
+def to_sparse_matrix(df):
+    """Converts a dataframe holding sparse columns, e.g. from `one_hot_encode(..., sparse=True)`, to a scipy CSR
+    matrix without densifying the sparse columns.
+
+    Args:
+        df: Pandas dataframe with a fill value of 0 for each sparse column
+
+    Returns: `scipy.sparse.csr_matrix` with the same shape as `df`
+
+    """
+    import scipy.sparse
+
+    rows, cols, data = [], [], []
+    for j, column in enumerate(df.columns):
+        values = df[column].values
+        if isinstance(df[column].dtype, pd.SparseDtype):
+            if values.fill_value != 0:
+                raise ValueError("Sparse column %s must have a fill value of 0" % column)
+            row_index = values.sp_index.to_int_index().indices
+            column_data = values.sp_values
+        else:
+            values = np.asarray(values, dtype=float)
+            row_index = np.flatnonzero(values)
+            column_data = values[row_index]
+
+        rows.append(row_index)
+        cols.append(np.full(len(row_index), j))
+        data.append(np.asarray(column_data, dtype=float))
+
+    X = scipy.sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=df.shape)
+
+    return X.tocsr()
+
+
+def to_model_input(df):
+    """Converts a dataframe of features to the array given to a model, a CSR matrix if it holds sparse columns."""
+    return to_sparse_matrix(df) if has_sparse_columns(df) else df.values
+
+
+def _dummy_columns(column, categories=None):
+    if categories is None or type(categories) != list:
+        # The number of dummy columns is not known until the data is seen
+        return ["%s_dummy_*" % column]
+    return ["%s_dummy_%i" % (column, j) for j in range(len(categories))]
+
+
+def _bin_values_columns(columns, bins=None, quartiles=None, new_column=False, **kwargs):
+    if bins is not None and quartiles is not None:
+        raise ValueError("Only bins or quartiles can be done at one time.")
+    elif bins is None and quartiles is None:
+        raise ValueError("Specify bins or quartiles")
+
+    writes = ["%s_binned" % column for column in columns] if new_column else columns
+
+    return writes, []
+
+
+def _make_categorical_columns(columns, one_hot=False, **kwargs):
+    writes, drops = [], []
+    for column in columns:
+        column_kwargs = kwargs[column] if column in kwargs else {}
+        if one_hot or ("one_hot_encode" in column_kwargs and column_kwargs["one_hot_encode"]):
+            writes += _dummy_columns(column, column_kwargs.get("categories"))
+            drops.append(column)
+        else:
+            writes.append(column)
+
+    return writes, drops
+
+
+def _one_hot_encode_columns(columns, drop_original=True, categories=None, **kwargs):
+    categories = {} if categories is None else categories
+    writes = [dummy for column in columns for dummy in _dummy_columns(column, categories.get(column))]
+    drops = columns if drop_original else []
+
+    return writes, drops
+
+
+def _fit_bin_values(df, columns, bins=None, quartiles=None, new_column=False, **kwargs):
+    columns = [columns] if type(columns) != list else columns
+
+    edges = {}
+    for j, column in enumerate(columns):
+        if bins is not None:
+            bins_input = bins[j] if type(bins) == list and len(bins) == len(columns) else bins
+            _, column_edges = pd.cut(df[column], bins=bins_input, retbins=True)
+        else:
+            quartiles_input = quartiles[j] if type(quartiles) == list else quartiles
+            _, column_edges = pd.qcut(df[column], q=quartiles_input, retbins=True)
+        edges[column] = column_edges.tolist()
+
+    return dict(kwargs, columns=columns, bins=bins, quartiles=quartiles, new_column=new_column, edges=edges)
+
+
+def _fit_make_categorical(df, columns, one_hot=False, **kwargs):
+    columns = [columns] if type(columns) != list else columns
+
+    for column in columns:
+        column_kwargs = dict(kwargs[column]) if column in kwargs else {}
+
+        if "read_csv" in column_kwargs:
+            categories = read_csv(**column_kwargs.pop("read_csv"))
+        elif "categories" in column_kwargs:
+            categories = column_kwargs["categories"]
+        elif column in kwargs:
+            categories = df[column].dropna().unique()
+        else:
+            categories = None
+
+        column_kwargs["categories"] = pd.Categorical(df[column], categories=categories).categories.tolist()
+        kwargs[column] = column_kwargs
+
+    return dict(kwargs, columns=columns, one_hot=one_hot)
+
+
+def _fit_one_hot_encode(df, columns, drop_original=True, categories=None, sparse=False, **kwargs):
+    columns = [columns] if type(columns) != list else columns
+    categories = {} if categories is None else dict(categories)
+
+    for column in columns:
+        categories[column] = pd.Categorical(df[column], categories=categories.get(column)).categories.tolist()
+
+    return dict(columns=columns, drop_original=drop_original, categories=categories, sparse=sparse)
+
+
+# Steps that can be configured in `generate_features`, functions returning the columns each step
+# writes and drops given its configuration, and functions learning the data-dependent keyword arguments of each step
+feature_steps = dict(bin_values=bin_values,
+                     make_categorical=make_categorical,
+                     one_hot_encode=one_hot_encode)
+
+feature_step_columns = dict(bin_values=_bin_values_columns,
+                            make_categorical=_make_categorical_columns,
+                            one_hot_encode=_one_hot_encode_columns)
 
-    for step in kwargs:
-        if step not in ["choose_features", "get_target"]:
-            command = "%s(df, **kwargs[step])" % step
-            logging.debug("Generating feature via %s", command)
-            df = eval(command)
+feature_step_fitters = dict(bin_values=_fit_bin_values,
+                            make_categorical=_fit_make_categorical,
+                            one_hot_encode=_fit_one_hot_encode)
 
-    choose_features_kwargs = {} if "choose_features" not in kwargs else kwargs["choose_features"]
-    df = choose_features(df, **choose_features_kwargs)
+
+class FeaturePipeline:
+    """Steps of a `generate_features` configuration compiled once into a validated sequence of callables.
+
+    The same pipeline can be applied to any number of dataframes (training data, scoring data, chunks of a
+    streamed dataset) without re-reading the configuration. Once fit, category vocabularies, bin edges and dummy
+    column layouts are fixed to those learned from the training data rather than recomputed from each dataframe.
+
+    Attributes:
+        steps (list): Tuples of (step name, step function, step keyword arguments) in the order they are run
+        dependencies (list): Dictionaries giving the columns each step reads, writes and drops
+        required_columns (list): Columns that must exist in the input to the pipeline
+        choose_features (dict): Keyword arguments to `choose_features()`, run after the last step
+        fitted (bool): True if the data-dependent state of each step has been learned by `fit()`
+        model_columns (list): Columns, in order, of the model input a model was trained on with the pipeline, set
+            when training. None if the pipeline has not been used to train a model
+        config (dict): The `generate_features` configuration the pipeline was compiled from
+
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.steps = []
+        self.choose_features = {}
+        self.fitted = False
+        self.model_columns = None
+
+        for step in config:
+            if step in ["save_dataset", "get_target"]:
+                continue
+            elif step == "choose_features":
+                self.choose_features = config[step]
+                continue
+            elif step not in feature_steps:
+                raise ValueError("%s is not a feature generation step, options are %s"
+                                 % (step, ", ".join(feature_steps)))
+
+            try:
+                inspect.signature(feature_steps[step]).bind(None, **config[step])
+            except TypeError as e:
+                raise ValueError("Invalid configuration for %s: %s" % (step, e))
+
+            self.steps.append((step, feature_steps[step], dict(config[step])))
+
+        self.dependencies, self.required_columns = self._resolve_dependencies()
+
+    def _resolve_dependencies(self):
+        dependencies, required_columns = [], []
+        written, dropped = set(), set()
+
+        for step, _, kwargs in self.steps:
+            reads = [kwargs["columns"]] if type(kwargs["columns"]) != list else kwargs["columns"]
+            step_kwargs = {k: v for k, v in kwargs.items() if k != "columns"}
+            writes, drops = feature_step_columns[step](reads, **step_kwargs)
+
+            for column in reads:
+                if column in dropped:
+                    raise ValueError("%s uses column %s, which is dropped by an earlier step" % (step, column))
+                if column not in written and column not in required_columns:
+                    required_columns.append(column)
+
+            written.update(writes)
+            written.difference_update(drops)
+            dropped.update(drops)
+            dropped.difference_update(writes)
+
+            dependencies.append(dict(step=step, reads=reads, writes=writes, drops=drops))
+
+        return dependencies, required_columns
+
+    def _check_columns(self, df):
+        missing = [column for column in self.required_columns if column not in df.columns]
+        if len(missing) > 0:
+            raise ValueError("Columns required to generate features are missing: %s" % ", ".join(missing))
+
+    def fit(self, df):
+        self.fit_transform(df)
+        return self
+
+    def fit_transform(self, df):
+        """Learns the category vocabularies, bin edges and dummy column layouts of each step from `df` and
+        generates features from `df` with them.
+
+        Args:
+            df: Pandas dataframe holding at least `required_columns`
+
+        Returns: Pandas dataframe of features
+
+        """
+        self._check_columns(df)
+
+        fitted_steps = []
+        for step, func, kwargs in self.steps:
+            with Timer("generate_features.%s" % step, logger, rows=len(df), level=logging.DEBUG):
+                fitted_kwargs = feature_step_fitters[step](df, **kwargs)
+                logger.debug("Generating feature via %s(df, **%s)", step, fitted_kwargs)
+                df = func(df, **fitted_kwargs)
+            fitted_steps.append((step, func, fitted_kwargs))
+
+        self.steps = fitted_steps
+        self.fitted = True
+        self.dependencies, self.required_columns = self._resolve_dependencies()
+
+        return choose_features(df, **self.choose_features)
+
+    def transform(self, df, model_input=False):
+        """Runs each step on `df`, modifying it in place where the step allows, then chooses the features.
+
+        Args:
+            df: Pandas dataframe holding at least `required_columns`
+            model_input: Whether to choose the `model_columns` a model was trained on, in the order it was trained
+                on them, e.g. to score data with the model, rather than the features of `choose_features`
+
+        Returns: Pandas dataframe of features
+
+        """
+        self._check_columns(df)
+
+        for step, func, kwargs in self.steps:
+            with Timer("generate_features.%s" % step, logger, rows=len(df), level=logging.DEBUG):
+                logger.debug("Generating feature via %s(df, **%s)", step, kwargs)
+                df = func(df, **kwargs)
+
+        # Pipelines saved before model columns were recorded have no `model_columns`
+        model_columns = getattr(self, "model_columns", None)
+        if model_input and model_columns is not None:
+            missing = [column for column in model_columns if column not in df.columns]
+            if len(missing) > 0:
+                raise ValueError("Features %s the model was trained on are missing" % ", ".join(missing))
+            return df[model_columns]
+
+        return choose_features(df, **self.choose_features)
+
+    def save(self, path):
+        with Timer("save %s" % path, logger, level=logging.DEBUG), open(path, "wb") as f:
+            pickle.dump(self, f)
+        logger.info("Feature pipeline saved to %s", path)
+
+
+def load_feature_pipeline(path):
+    with open(path, "rb") as f:
+        pipeline = pickle.load(f)
+    logger.info("Feature pipeline loaded from %s", path)
+    return pipeline
+
+
+def feature_pipeline_path(path_to_tmo):
+    """Path that the feature pipeline fit with a trained model object is saved to, next to the model object."""
+    return "%s-features.pkl" % os.path.splitext(path_to_tmo)[0]
+
+
+def compile_feature_pipeline(config, stage):
+    """Compiles the `generate_features` configuration if the `stage` section of `config` sets `featurize: True`.
+
+    Args:
+        config: Model configuration
+        stage: Section of the configuration that may set `featurize`, e.g. "train_model" or "score_model"
+
+    Returns: `FeaturePipeline`, or None if `stage` does not featurize its input
+
+    """
+    if not config[stage].get("featurize", False):
+        return None
+
+    if "generate_features" not in config:
+        raise ValueError("'generate_features' configuration must exist in config file if featurize is True")
+
+    return FeaturePipeline(config["generate_features"])
+
+
+def generate_features(df, save_dataset=None, pipeline=None, **kwargs):
+    """Generates features as configured by `kwargs`, or by an already compiled `pipeline`.
+
+    Args:
+        df: Pandas dataframe to generate features from
+        save_dataset: Path to save the dataframe of features to, as CSV unless its extension is that of another
+            format supported by `save_frame()` (optional)
+        pipeline: `FeaturePipeline` to use instead of compiling one from `kwargs` (optional)
+        **kwargs: Feature generation steps and their keyword arguments, as in the `generate_features` config
+
+    Returns: Pandas dataframe of features
+
+    """
+
+    pipeline = FeaturePipeline(kwargs) if pipeline is None else pipeline
+
+    df = pipeline.transform(df)
 
     if save_dataset is not None:
-        df.to_csv(save_dataset)
+        save_frame(df, save_dataset)
 
     return df
 
 
+def generate_feature_chunks(chunks, save_dataset, pipeline=None, **kwargs):
+    """Generates features from data read in chunks (e.g. a streamed query) and appends each chunk to `save_dataset`.
+
+    Unless `pipeline` is already fitted, it is fit on the first chunk and applied as fitted to the rest, so every
+    chunk is given the same categories, bin edges and dummy columns.
+
+    Args:
+        chunks: Iterator of dataframes, e.g. from `load_data(..., chunksize=n)`
+        save_dataset: Path to the CSV or Parquet file the features of each chunk are appended to
+        pipeline: `FeaturePipeline` to use instead of compiling one from `kwargs` (optional)
+        **kwargs: Feature generation steps and their keyword arguments, as in the `generate_features` config
+
+    Returns: Number of rows of features generated
+
+    """
+
+    pipeline = FeaturePipeline(kwargs) if pipeline is None else pipeline
+
+    n_rows = 0
+    with Timer("chunked feature generation", logger) as t, FrameWriter(save_dataset, index=False) as writer:
+        for df in chunks:
+            df = pipeline.transform(df) if pipeline.fitted else pipeline.fit_transform(df)
+            writer.write(df)
+            n_rows += len(df)
+            t.rows = n_rows
+
+    logger.info("Features of %i rows saved to %s", n_rows, save_dataset)
+
+    return n_rows
+
+
 def run_features(args):
     with open(args.config, "r") as f:
         config = yaml.load(f)
@@ -136,7 +518,15 @@ def run_features(args):
         raise ValueError("Path to CSV for input data must be provided through --csv or "
                          "'load_data' configuration must exist in config file")
 
-    df = generate_features(df, **config["generate_features"])
+    if isinstance(df, pd.DataFrame):
+        df = generate_features(df, **config["generate_features"])
+    else:
+        # Data read in chunks is never held in memory at once, so the features of each chunk are saved as made
+        features_config = dict(config["generate_features"])
+        save_dataset = features_config.pop("save_dataset", None)
+        if save_dataset is None:
+            raise ValueError("generate_features['save_dataset'] must be given when generating features in chunks")
+        generate_feature_chunks(df, save_dataset, **features_config)
 
 
 if __name__ == '__main__':
@@ -1 +1,5 @@
-from .helpers import *
\ No newline at end of file
+from .helpers import *
+from .cache import StageCache, fingerprint_file, fingerprint_frame
+from .formats import save_frame, read_frame, read_frame_chunks, align_chunks, FrameWriter, get_format, format_extensions
+from .s3 import get_s3_client, parse_s3path, transfer_config, list_s3_objects, download_s3_objects, open_s3_object, \
+    fingerprint_s3_object
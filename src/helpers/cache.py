@@ -0,0 +1,105 @@
+import os
+import json
+import pickle
+import hashlib
+import logging
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint_file(path):
+    """Fingerprints a file by its path, size and modification time, without reading it."""
+    stat = os.stat(path)
+    return "%s:%i:%i" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def fingerprint_frame(df):
+    """Fingerprints the contents of a dataframe, including its index and column names."""
+    digest = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    digest.update(json.dumps([str(column) for column in df.columns]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class StageCache:
+    """Content-addressed cache of the outputs of pipeline stages.
+
+    Each output is stored as a pickle under a key hashed from the stage name, the configuration of the stage and
+    the keys or fingerprints of its inputs, so that a stage is only re-run when one of those changes. Pickle is used
+    rather than a columnar format so that categorical and sparse columns, fitted feature pipelines and dictionaries
+    of splits round trip exactly. Least recently used outputs are evicted once the cache exceeds `max_size_mb`.
+
+    Args:
+        path: Directory to store cached outputs in
+        max_size_mb: Maximum total size of the cached outputs in megabytes, no limit if None
+
+    """
+
+    def __init__(self, path="data/cache", max_size_mb=None):
+        self.path = path
+        self.max_size_mb = max_size_mb
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def key(stage, config, *inputs):
+        """Hashes the name of a stage, its configuration and the keys or fingerprints of its inputs."""
+        description = json.dumps([stage, config, inputs], sort_keys=True, default=str)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def _file(self, stage, key):
+        return os.path.join(self.path, "%s-%s.pkl" % (stage, key))
+
+    def get(self, stage, key):
+        """Returns (True, cached output) if the output of `stage` under `key` is cached, (False, None) if not."""
+        path = self._file(stage, key)
+        if not os.path.exists(path):
+            return False, None
+
+        with open(path, "rb") as f:
+            output = pickle.load(f)
+
+        # Marks the output as recently used for eviction
+        os.utime(path, None)
+        logger.info("%s output loaded from cache %s", stage, path)
+
+        return True, output
+
+    def put(self, stage, key, output):
+        path = self._file(stage, key)
+
+        # Written to a temporary file first so that an interrupted write never leaves a partial output in the cache
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+        logger.debug("%s output saved to cache %s", stage, path)
+
+        self.evict()
+
+    def run(self, stage, key, func, *args, **kwargs):
+        """Returns the cached output of `stage` under `key`, or runs `func(*args, **kwargs)` and caches its output."""
+        cached, output = self.get(stage, key)
+        if cached:
+            return output
+
+        output = func(*args, **kwargs)
+        self.put(stage, key, output)
+
+        return output
+
+    def evict(self):
+        if self.max_size_mb is None:
+            return
+
+        files = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".pkl")]
+        files = sorted(files, key=os.path.getmtime)
+        size = sum(os.path.getsize(f) for f in files)
+
+        # The most recently used output is kept even if it alone is larger than the cache
+        while size > self.max_size_mb * 1e6 and len(files) > 1:
+            oldest = files.pop(0)
+            size -= os.path.getsize(oldest)
+            os.remove(oldest)
+            logger.info("%s evicted from cache", oldest)
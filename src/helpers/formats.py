@@ -0,0 +1,209 @@
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .helpers import Timer
+
+logger = logging.getLogger(__name__)
+
+# File extensions of each supported format, CSV is used for any other extension
+format_extensions = dict(csv=[".csv"],
+                         parquet=[".parquet", ".pq"],
+                         feather=[".feather", ".arrow"],
+                         npy=[".npy"])
+
+
+def get_format(path, fmt=None):
+    """Gets the format to save or read `path` in, given explicitly by `fmt` or picked by the extension of `path`."""
+    if fmt is not None:
+        if fmt not in format_extensions:
+            raise ValueError("%s is not a supported format, options are %s" % (fmt, ", ".join(format_extensions)))
+        return fmt
+
+    extension = os.path.splitext(path)[1].lower()
+    for fmt in format_extensions:
+        if extension in format_extensions[fmt]:
+            return fmt
+
+    return "csv"
+
+
+def _as_frame(data, index=True):
+    df = data.to_frame() if isinstance(data, pd.Series) else pd.DataFrame(data)
+
+    # Parquet, Feather and structured arrays need string column names
+    df = df.copy(deep=False)
+    df.columns = [str(column) for column in df.columns]
+
+    if index and not isinstance(df.index, pd.RangeIndex):
+        df = df.reset_index()
+
+    return df
+
+
+def save_frame(data, path, fmt=None, index=True, **kwargs):
+    """Saves a dataframe, series or array as CSV, Parquet, Feather or a NumPy structured array (.npy).
+
+    Args:
+        data: Pandas dataframe or series, or numpy array, to save
+        path: Path to save to, the format is picked by its extension unless `fmt` is given
+        fmt: Format to save in, one of "csv", "parquet", "feather" or "npy" (optional)
+        index: Whether to save the index. Feather and .npy files do not store an index, so it is saved as a column
+        **kwargs: Keyword arguments to the pandas writer of the format, e.g. `to_csv()`
+
+    """
+    fmt = get_format(path, fmt)
+
+    with Timer("save %s" % path, logger, rows=len(data), level=logging.DEBUG):
+        if fmt == "csv":
+            data = data if isinstance(data, (pd.DataFrame, pd.Series)) else pd.DataFrame(data)
+            data.to_csv(path, index=index, **kwargs)
+        elif fmt == "parquet":
+            _as_frame(data, index=False).to_parquet(path, index=index, **kwargs)
+        elif fmt == "feather":
+            _as_frame(data, index=index).reset_index(drop=True).to_feather(path, **kwargs)
+        elif fmt == "npy":
+            np.save(path, _as_frame(data, index=index).to_records(index=False), **kwargs)
+
+    logger.debug("%s saved as %s", path, fmt)
+
+
+def read_frame(path, fmt=None, **kwargs):
+    """Reads a dataframe saved by `save_frame()`.
+
+    Args:
+        path: Path to read, the format is picked by its extension unless `fmt` is given
+        fmt: Format to read, one of "csv", "parquet", "feather" or "npy" (optional)
+        **kwargs: Keyword arguments to the pandas reader of the format, e.g. `read_csv()`
+
+    Returns: Pandas dataframe
+
+    """
+    fmt = get_format(path, fmt)
+
+    if fmt == "csv":
+        df = pd.read_csv(path, **kwargs)
+    elif fmt == "parquet":
+        df = pd.read_parquet(path, **kwargs)
+    elif fmt == "feather":
+        df = pd.read_feather(path, **kwargs)
+    else:
+        df = pd.DataFrame(np.load(path, **kwargs))
+
+    return df
+
+
+def read_frame_chunks(path, chunksize, fmt=None, **kwargs):
+    """Reads a CSV or Parquet file as an iterator of dataframes of at most `chunksize` rows, so that only one chunk, or
+    one Parquet row group, is held in memory at a time. The counterpart of `FrameWriter`.
+
+    Args:
+        path: Path to read, the format is picked by its extension unless `fmt` is given
+        chunksize: Maximum number of rows of each chunk
+        fmt: Format to read, "csv" or "parquet" (optional)
+        **kwargs: Keyword arguments to `pd.read_csv()` or `pyarrow.parquet.ParquetFile.read_row_group()`
+
+    Returns: Iterator of pandas dataframes
+
+    """
+    fmt = get_format(path, fmt)
+
+    if fmt == "csv":
+        for chunk in pd.read_csv(path, chunksize=chunksize, **kwargs):
+            yield chunk
+    elif fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        # Row groups are read one at a time, each split into chunks of at most `chunksize` rows
+        parquet_file = pq.ParquetFile(path)
+        for i in range(parquet_file.num_row_groups):
+            df = parquet_file.read_row_group(i, **kwargs).to_pandas()
+            for start in range(0, len(df), chunksize):
+                yield df.iloc[start:start + chunksize]
+    else:
+        raise ValueError("Only csv and parquet files can be read chunk by chunk, not %s" % fmt)
+
+
+def align_chunks(left_chunks, right_chunks, unmatched=None):
+    """Pairs up the rows of two iterators of dataframes whose chunks may differ in size, e.g. Parquet row groups, in
+    constant memory.
+
+    Args:
+        left_chunks: Iterator of dataframes, e.g. from `read_frame_chunks()`
+        right_chunks: Iterator of dataframes with rows in the same order
+        unmatched: Dictionary that the number of rows left in either iterator once the other runs out is set in as
+            "left" and "right" (optional)
+
+    Returns: Iterator of the offset of each pair of equally long chunks and the chunks
+
+    """
+    left_chunk, right_chunk, offset = [], [], 0
+    while True:
+        while left_chunk is not None and len(left_chunk) == 0:
+            left_chunk = next(left_chunks, None)
+        while right_chunk is not None and len(right_chunk) == 0:
+            right_chunk = next(right_chunks, None)
+        if left_chunk is None or right_chunk is None:
+            break
+
+        n = min(len(left_chunk), len(right_chunk))
+        yield offset, left_chunk.iloc[:n], right_chunk.iloc[:n]
+        left_chunk, right_chunk, offset = left_chunk.iloc[n:], right_chunk.iloc[n:], offset + n
+
+    unmatched = {} if unmatched is None else unmatched
+    unmatched["left"] = sum(len(chunk) for chunk in left_chunks) + (0 if left_chunk is None else len(left_chunk))
+    unmatched["right"] = sum(len(chunk) for chunk in right_chunks) + (0 if right_chunk is None else len(right_chunk))
+
+
+class FrameWriter:
+    """Writes dataframes to one CSV or Parquet file chunk by chunk, e.g. the scores of each chunk of a streamed
+    dataset, without holding all of the chunks in memory.
+
+    Args:
+        path: Path to write to, the format is picked by its extension unless `fmt` is given
+        fmt: Format to write, "csv" or "parquet" (optional)
+        index: Whether to write the index. In Parquet files a non-default index is written as a column
+        **kwargs: Keyword arguments to `to_csv()` or `pyarrow.parquet.ParquetWriter`
+
+    """
+
+    def __init__(self, path, fmt=None, index=True, **kwargs):
+        self.path = path
+        self.fmt = get_format(path, fmt)
+        self.index = index
+        self.kwargs = kwargs
+        self.writer = None
+        self.n_chunks = 0
+
+        if self.fmt not in ["csv", "parquet"]:
+            raise ValueError("Only csv and parquet files can be written chunk by chunk, not %s" % self.fmt)
+
+    def write(self, data):
+        if self.fmt == "csv":
+            # The first chunk creates the file and writes the header, the rest are appended to it
+            first = self.n_chunks == 0
+            df = data if isinstance(data, pd.DataFrame) else pd.DataFrame(data)
+            df.to_csv(self.path, mode="w" if first else "a", header=first, index=self.index, **self.kwargs)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(_as_frame(data, index=self.index), preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema, **self.kwargs)
+            self.writer.write_table(table)
+
+        self.n_chunks += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,4 +1,12 @@
+import sys
+import json
+import time
+import logging
 import datetime
+import resource
+import threading
+import tracemalloc
+import multiprocessing
 
 
 def fillin_kwargs(keywords, kwargs):
@@ -8,17 +16,108 @@ def fillin_kwargs(keywords, kwargs):
             kwargs[keyword] = {}
     return kwargs
 
+def resolve_n_jobs(n_jobs):
+    """Converts an sklearn-style `n_jobs` (where -1 means all cores, -2 all but one, etc) to a number of workers."""
+    return max(multiprocessing.cpu_count() + 1 + n_jobs, 1) if n_jobs < 0 else n_jobs
+
+
+def max_rss_mb():
+    """Peak resident set size of this process so far in megabytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return max_rss / 1e6 if sys.platform == "darwin" else max_rss / 1e3
+
+
 class Timer:
-    def __init__(self, function, logger):
+    """Times a block of code, logs how long it took and records its metrics, in `Timer.records` too if
+    `Timer.keep_records` is set, e.g. by `run.py --report`.
+
+    Each record holds the wall-clock and CPU seconds taken, the peak RSS of the process so far, the rows processed and
+    rows per second if `rows` is given, and the peak memory allocated within the block if tracemalloc is tracing.
+
+    Args:
+        function: Name of the stage being timed
+        logger: Logger to log the time taken to
+        rows: Number of rows processed (optional), can also be set on the timer within the block
+        level: Logging level of the time taken
+
+    """
+
+    # Metrics of every timed block in this process, in the order the blocks finished, kept only while `keep_records`
+    # is set so that long-lived processes such as the score server do not accumulate them
+    records = []
+    keep_records = False
+
+    # Stack of timers open in each thread, so that nested blocks each get their own tracemalloc peak
+    _open = threading.local()
+
+    def __init__(self, function, logger, rows=None, level=logging.INFO):
         self.logger = logger
         self.function = function
+        self.rows = rows
+        self.level = level
+        self.record = None
 
     def __enter__(self):
         self.start = datetime.datetime.now()
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+        if tracemalloc.is_tracing():
+            self._open.stack = getattr(self._open, "stack", [])
+            current, peak = tracemalloc.get_traced_memory()
+            if len(self._open.stack) > 0:
+                self._open.stack[-1]._peak = max(self._open.stack[-1]._peak, peak)
+            self._traced_start, self._peak = current, current
+            self._open.stack.append(self)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
 
         return self
 
     def __exit__(self, *args):
         self.end = datetime.datetime.now()
         self.interval = self.end - self.start
-        self.logger.info("%s took %0.2f seconds", self.function, self.interval.total_seconds())
\ No newline at end of file
+        self.seconds = time.perf_counter() - self._start
+        self.cpu_seconds = time.process_time() - self._start_cpu
+
+        self.record = dict(stage=self.function, seconds=self.seconds, cpu_seconds=self.cpu_seconds,
+                           max_rss_mb=max_rss_mb(), rows=self.rows,
+                           rows_per_second=self.rows / self.seconds if self.rows and self.seconds > 0 else None)
+
+        if tracemalloc.is_tracing() and getattr(self._open, "stack", None):
+            self._peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            self._open.stack.pop()
+            if len(self._open.stack) > 0:
+                self._open.stack[-1]._peak = max(self._open.stack[-1]._peak, self._peak)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            self.record["peak_traced_mb"] = (self._peak - self._traced_start) / 1e6
+
+        if Timer.keep_records:
+            Timer.records.append(self.record)
+
+        if self.record["rows_per_second"] is not None:
+            self.logger.log(self.level, "%s took %0.2f seconds, %i rows at %0.0f rows/sec",
+                            self.function, self.seconds, self.rows, self.record["rows_per_second"])
+        else:
+            self.logger.log(self.level, "%s took %0.2f seconds", self.function, self.seconds)
+
+
+def write_report(path, **kwargs):
+    """Writes the metrics of every block timed by `Timer` while `Timer.keep_records` was set to a JSON run report, then
+    clears them.
+
+    Args:
+        path: Path to write the report to
+        **kwargs: Other information to include in the report, e.g. the command run
+
+    """
+    report = dict(kwargs, max_rss_mb=max_rss_mb(), stages=Timer.records)
+
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+
+    logging.getLogger(__name__).info("Run report with %i timed stages saved to %s", len(Timer.records), path)
+    del Timer.records[:]
@@ -0,0 +1,169 @@
+import os
+import re
+import json
+import logging
+import threading
+import multiprocessing.pool
+
+from .helpers import Timer, resolve_n_jobs
+
+logger = logging.getLogger(__name__)
+
+# boto3 clients are thread-safe and slow to create, so one is shared by every thread of the process
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Gets the S3 client shared by the process, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            import boto3
+            _client = boto3.client("s3")
+    return _client
+
+
+def parse_s3path(s3path):
+    """Splits an S3 path of the form s3://bucket/key into its bucket and key, the key being empty for a bucket."""
+    m = re.match(r"s3://([\w._-]+)/?(.*)", s3path)
+    if m is None:
+        raise ValueError("%s is not an S3 path of the form s3://bucket/key" % s3path)
+    return m.group(1), m.group(2)
+
+
+def transfer_config(multipart_threshold_mb=8, multipart_chunksize_mb=8, max_concurrency=10):
+    """Configures how large objects are downloaded as concurrent byte-range parts."""
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(multipart_threshold=int(multipart_threshold_mb * 1024 ** 2),
+                          multipart_chunksize=int(multipart_chunksize_mb * 1024 ** 2),
+                          max_concurrency=max_concurrency)
+
+
+def list_s3_objects(s3path, client=None):
+    """Lists the objects under an S3 prefix.
+
+    Args:
+        s3path: S3 path of the prefix, e.g. s3://bucket/data/2019/
+        client: boto3 S3 client, the shared one if not given (optional)
+
+    Returns: List of dictionaries with the `Key`, `ETag` and `Size` of each object
+
+    """
+    client = get_s3_client() if client is None else client
+    bucket, prefix = parse_s3path(s3path)
+
+    objects = []
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        objects += [dict(Key=o["Key"], ETag=o["ETag"], Size=o["Size"])
+                    for o in page.get("Contents", []) if not o["Key"].endswith("/")]
+
+    return objects
+
+
+def fingerprint_s3_object(s3path, client=None):
+    """Fingerprints an S3 object by its path, ETag and size, without downloading it."""
+    client = get_s3_client() if client is None else client
+    bucket, key = parse_s3path(s3path)
+
+    head = client.head_object(Bucket=bucket, Key=key)
+    return "%s:%s:%i" % (s3path, head["ETag"], head["ContentLength"])
+
+
+def open_s3_object(s3path, client=None):
+    """Opens an S3 object as a stream that can be read, e.g. by `pd.read_csv()`, without staging it on disk."""
+    client = get_s3_client() if client is None else client
+    bucket, key = parse_s3path(s3path)
+
+    return client.get_object(Bucket=bucket, Key=key)["Body"]
+
+
+def _read_manifest(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(path, manifest):
+    # Written to a temporary file first so that an interrupted write never leaves a corrupt manifest
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def download_s3_objects(s3path, destpath, manifest="default", n_jobs=8, client=None, **kwargs):
+    """Downloads every object under one or more S3 prefixes concurrently, skipping those already downloaded.
+
+    Objects are downloaded `n_jobs` at a time, and objects larger than the multipart threshold are each downloaded
+    as concurrent byte-range parts. The ETag and size of each object downloaded is recorded in a manifest, and an
+    object is skipped if the manifest records the same ETag and size and the local copy is still that size.
+
+    Args:
+        s3path: S3 path of a prefix, or list of S3 paths of prefixes, to download
+        destpath: Local directory, or list of directories for each prefix, the objects are downloaded to, keeping
+            their paths relative to the prefix
+        manifest: Path to the manifest of objects downloaded, `.s3-manifest.json` in each `destpath` by default, or
+            None to download every object
+        n_jobs: Number of objects downloaded at once, -1 for one per core
+        client: boto3 S3 client, the shared one if not given (optional)
+        **kwargs: Keyword arguments to `transfer_config()`, e.g. `multipart_chunksize_mb`
+
+    Returns: List of local paths of the objects, whether downloaded or skipped
+
+    """
+    client = get_s3_client() if client is None else client
+    s3path = [s3path] if type(s3path) != list else s3path
+    destpath = [destpath] if type(destpath) != list else destpath
+
+    assert len(s3path) == len(destpath)
+
+    config = transfer_config(**kwargs)
+
+    def download(transfer):
+        bucket, key, path = transfer
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        client.download_file(bucket, key, path, Config=config)
+
+    paths, n_downloaded, n_bytes = [], 0, 0
+    with Timer("s3 download", logger, level=logging.DEBUG) as t:
+        for s3p, destp in zip(s3path, destpath):
+            bucket, prefix = parse_s3path(s3p)
+            manifest_path = os.path.join(destp, ".s3-manifest.json") if manifest == "default" else manifest
+            entries = _read_manifest(manifest_path)
+
+            objects = list_s3_objects(s3p, client=client)
+            transfers, downloaded = [], {}
+            for o in objects:
+                # As with `aws s3 cp --recursive`, objects keep their paths relative to the prefix
+                path = os.path.join(destp, o["Key"][len(prefix):].lstrip("/") if o["Key"] != prefix
+                                    else os.path.basename(o["Key"]))
+                paths.append(path)
+
+                entry = entries.get("s3://%s/%s" % (bucket, o["Key"]))
+                if (entry is not None and entry["ETag"] == o["ETag"] and entry["Size"] == o["Size"]
+                        and os.path.exists(path) and os.path.getsize(path) == o["Size"]):
+                    continue
+
+                transfers.append((bucket, o["Key"], path))
+                downloaded["s3://%s/%s" % (bucket, o["Key"])] = dict(ETag=o["ETag"], Size=o["Size"])
+                n_bytes += o["Size"]
+
+            logger.info("%i objects to download from %s, %i unchanged since they were last downloaded",
+                        len(transfers), s3p, len(objects) - len(transfers))
+
+            if len(transfers) > 0:
+                with multiprocessing.pool.ThreadPool(min(resolve_n_jobs(n_jobs), len(transfers))) as pool:
+                    pool.map(download, transfers)
+
+            n_downloaded += len(transfers)
+
+            if manifest_path is not None:
+                os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+                _write_manifest(manifest_path, dict(entries, **downloaded))
+
+    logger.info("%i objects (%0.1f MB) downloaded in %0.2f seconds", n_downloaded, n_bytes / 1e6, t.seconds)
+
+    return paths
@@ -2,14 +2,29 @@ import logging
 import argparse
 import yaml
 import os
-import subprocess
-import re
-import boto3
-import sqlalchemy
+import glob
+import hashlib
+import time
+import threading
+import multiprocessing.pool
+import numpy as np
 import pandas as pd
+from numpy.lib.recfunctions import structured_to_unstructured
+
+from src.helpers import Timer, resolve_n_jobs, fingerprint_file, read_frame, save_frame, FrameWriter, get_format, \
+    format_extensions, get_s3_client, parse_s3path, transfer_config, download_s3_objects, open_s3_object, \
+    fingerprint_s3_object
 
 logger = logging.getLogger(__name__)
 
+# Engines created by `create_connection()`, keyed by their URL and pool settings, so each database is connected to
+# through one connection pool per process
+_engines = {}
+_engines_lock = threading.Lock()
+
+# Parsed database configuration files, keyed by path and modification time
+_dbconfigs = {}
+
 
 def ifin(param, dictionary, alt=None):
 
@@ -21,30 +36,21 @@ def ifin(param, dictionary, alt=None):
 
 
 def copy_file_from_s3(path, s3path, s3=None):
-    if s3 is None:
-        s3 = boto3.resource("s3")
-    regex = r"s3://([\w._-]+)/([\w./_-]+)"
-
-    m = re.match(regex, s3path)
-    s3bucket = m.group(1)
-    s3path = m.group(2)
-
-    bucket = s3.Bucket(s3bucket)
+    """Downloads the object `path` under the S3 prefix `s3path` to `path`, using the shared S3 client unless a boto3
+    resource `s3` is given."""
+    bucket, prefix = parse_s3path(s3path)
+    key = os.path.join(prefix, path)
 
-    s3path = os.path.join(s3path, path)
-
-    bucket.download_file(s3path, path)
-
-
-def copy_files_from_s3(s3path, destpath):
-    s3path = [s3path] if type(s3path) != list else s3path
-    destpath = [destpath] if type(destpath) != list else destpath
+    if s3 is not None:
+        s3.Bucket(bucket).download_file(key, path)
+    else:
+        get_s3_client().download_file(bucket, key, path, Config=transfer_config())
 
-    assert len(s3path) == len(destpath)
 
-    for s3p, destp in zip(s3path, destpath):
-        command = "aws s3 --recursive cp {s3path} {destpath}".format(s3path=s3p, destpath=destp)
-        subprocess.check_output(command.split())
+def copy_files_from_s3(s3path, destpath, **kwargs):
+    """Downloads every object under each S3 prefix in `s3path` to the matching directory in `destpath`, many at once
+    and skipping objects unchanged since they were last downloaded. See `download_s3_objects()` for `kwargs`."""
+    return download_s3_objects(s3path, destpath, **kwargs)
 
 
 def format_sql(sql, replace_sqlvar=None, replace_var=None, python=True):
@@ -68,39 +74,157 @@ def load_sql(path_to_sql, load_comments=False, replace_sqlvar=None, replace_var=
             if not load_comments and not line.startswith("--"):
                 sql += line
 
-    sql = format_sql(replace_sqlvar=replace_sqlvar, replace_var=replace_var, python=python)
+    sql = format_sql(sql, replace_sqlvar=replace_sqlvar, replace_var=replace_var, python=python)
 
     return sql
 
 
+def read_dbconfig(path):
+    """Reads a database configuration file, parsing it only once unless it changes."""
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+    if key not in _dbconfigs:
+        with open(path, "r") as f:
+            _dbconfigs[key] = yaml.load(f)
+    return _dbconfigs[key]
+
+
 def create_connection(host='127.0.0.1', database="", sqltype="mysql+pymysql", port=3308,
                       user_env="amazonRDS_user", password_env="amazonRDS_pw",
-                      username=None, password=None, dbconfig=None):
+                      username=None, password=None, dbconfig=None,
+                      pool_size=5, max_overflow=10, pool_recycle=3600, pool_pre_ping=True, reuse=True):
+    """Gets a SQLAlchemy engine from the given arguments, or from the database configuration file `dbconfig`.
+
+    Engines are kept in a process-wide registry keyed by their URL and pool settings, so repeated queries to the same
+    database reuse one pool of connections instead of connecting again each time. Call `dispose_engines()` to close
+    them. For SQLite (`sqltype` "sqlite"), `database` is the path to the database file and the host, port, user and
+    pool size settings are ignored.
+
+    Args:
+        host, database, sqltype, port: Where the database is and how to connect to it
+        user_env, password_env: Environment variables holding the username and password
+        username, password: Username and password, read from `user_env` and `password_env` if not given
+        dbconfig: Path to a database configuration file, whose `host`, `dbname`, `type`, `port`, `user_env`,
+            `password_env` and pool settings override the arguments (optional)
+        pool_size: Number of connections kept open in the pool
+        max_overflow: Number of connections that may be opened beyond `pool_size` when all are in use
+        pool_recycle: Seconds after which a connection is replaced, before the server times it out
+        pool_pre_ping: Whether to test each connection as it is taken from the pool and replace it if it is stale
+        reuse: If False, a new engine is created and not added to the registry
+
+    Returns: SQLAlchemy engine
+
+    """
 
     if dbconfig is not None:
-        with open(args.dbconfig, "r") as f:
-            db = yaml.load(f)
+        db = read_dbconfig(dbconfig)
 
-        host = db["host"]
+        host = ifin("host", db, host)
         database = ifin("dbname", db, "")
         sqltype = ifin("type", db, sqltype)
-        port = db["port"]
-        user_env = db["user_env"]
-        password_env = db["password_env"]
+        port = ifin("port", db, port)
+        user_env = ifin("user_env", db, user_env)
+        password_env = ifin("password_env", db, password_env)
+        pool_size = ifin("pool_size", db, pool_size)
+        max_overflow = ifin("max_overflow", db, max_overflow)
+        pool_recycle = ifin("pool_recycle", db, pool_recycle)
+        pool_pre_ping = ifin("pool_pre_ping", db, pool_pre_ping)
+
+    if sqltype.startswith("sqlite"):
+        engine_string = "{sqltype}:///{database}".format(sqltype=sqltype, database=database)
+        pool_kwargs = dict(pool_pre_ping=pool_pre_ping)
+    else:
+        username = os.environ.get(user_env) if username is None else username
+        password = os.environ.get(password_env) if password is None else password
 
-    username = os.environ.get(user_env) if username is None else username
-    password = os.environ.get(password_env) if password is None else password
+        engine_string = "{sqltype}://{username}:{password}@{host}:{port}/{database}"
+        engine_string = engine_string.format(sqltype=sqltype, username=username,
+                                             password=password, host=host, port=port, database=database)
+        pool_kwargs = dict(pool_size=pool_size, max_overflow=max_overflow, pool_recycle=pool_recycle,
+                           pool_pre_ping=pool_pre_ping)
 
-    engine_string = "{sqltype}://{username}:{password}@{host}:{port}/{database}"
-    engine_string = engine_string.format(sqltype=sqltype, username=username,
-                                         password=password, host=host, port=port, database=database)
-    conn = sqlalchemy.create_engine(engine_string)
+    # Imported here so that loading data from files never pays for importing sqlalchemy
+    import sqlalchemy
+
+    if not reuse:
+        return sqlalchemy.create_engine(engine_string, **pool_kwargs)
+
+    key = (engine_string, tuple(sorted(pool_kwargs.items())))
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = sqlalchemy.create_engine(engine_string, **pool_kwargs)
+            logger.debug("Engine created for %s", _engines[key].url)
+        conn = _engines[key]
 
     return conn
 
 
+def dispose_engines():
+    """Closes the connections of every engine in the registry and empties it, e.g. before forking worker processes,
+    which must not share connections with their parent."""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        logger.debug("%i engines disposed", len(_engines))
+        _engines.clear()
+
+
+def stream_query(sql, conn, chunksize, dtype=None):
+    """Streams the results of a query in chunks through a server-side cursor.
+
+    `pd.read_sql(..., chunksize=n)` only splits up results the database driver has already fetched in full, so its
+    memory use still grows with the size of the result. Here the rows are fetched `chunksize` at a time, so only one
+    chunk is held in memory at once on drivers that support server-side cursors (e.g. pymysql, psycopg2) and on
+    SQLite, which steps through results lazily.
+
+    Args:
+        sql: Query to run, passed to the driver as is
+        conn: SQLAlchemy engine to run the query on
+        chunksize: Number of rows per chunk
+        dtype: Dictionary of column names to dtypes each chunk is cast to, so every chunk has the same types even
+            when a column of one chunk is entirely null (optional)
+
+    Yields: Pandas dataframe of each chunk of rows
+
+    """
+    with conn.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+
+        # Raw SQL is given to the driver as pd.read_sql() does, through exec_driver_sql() from SQLAlchemy 1.4 on
+        execute = getattr(connection, "exec_driver_sql", connection.execute)
+        result = execute(sql)
+        columns = list(result.keys())
+
+        while True:
+            rows = result.fetchmany(chunksize)
+            if len(rows) == 0:
+                break
+
+            df = pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns, coerce_float=True)
+            if dtype is not None:
+                df = df.astype(dtype)
+
+            yield df
+
+
 def query_data(sql=None, path_to_sql=None, dbconfig="config/dbconfig.yml", conn=None,
-               load_comments=False, replace_sqlvar=None, replace_var=None, python=True):
+               load_comments=False, replace_sqlvar=None, replace_var=None, python=True, chunksize=None, dtype=None):
+    """Runs a query and returns its results.
+
+    Args:
+        sql: Query to run, may contain variables to replace (see `format_sql()`)
+        path_to_sql: Path to a file holding the query, if `sql` is not given
+        dbconfig: Path to the database configuration file, used if `conn` is not given
+        conn: SQLAlchemy engine to run the query on (optional)
+        load_comments: Whether to keep lines of `path_to_sql` starting with "--"
+        replace_sqlvar: Dictionary of values to replace `${var:name}` variables in the query with (optional)
+        replace_var: Dictionary of values to replace `{name}` variables in the query with (optional)
+        python: Whether to escape `%` as `%%` for drivers that use `%` for parameters (e.g. pymysql, psycopg2)
+        chunksize: If given, the results are streamed through a server-side cursor in chunks of this many rows
+        dtype: Dictionary of column names to dtypes to cast the results to (optional)
+
+    Returns: Pandas dataframe, or an iterator of dataframes if `chunksize` is given
+
+    """
     if sql is None and path_to_sql is not None:
         sql = load_sql(path_to_sql,
                        load_comments=load_comments,
@@ -113,50 +237,360 @@ def query_data(sql=None, path_to_sql=None, dbconfig="config/dbconfig.yml", conn=
                          replace_var=replace_var,
                          python=python)
     else:
-        raise ValueError("Only sql or path_to_sql should be provided")
+        raise ValueError("sql or path_to_sql must be provided")
 
     if conn is None:
         conn = create_connection(dbconfig=dbconfig)
 
+    if chunksize is not None:
+        logger.info("Query results being streamed in chunks of %i rows", chunksize)
+        return stream_query(sql, conn, chunksize, dtype=dtype)
+
     df = pd.read_sql(sql, con=conn)
+    if dtype is not None:
+        df = df.astype(dtype)
 
     logger.info("Dataframe with %i rows loaded from query", len(df))
 
     return df
 
 
+def query_many(queries, n_jobs=4, conn=None, dbconfig="config/dbconfig.yml", **kwargs):
+    """Runs many queries at once over pooled connections, e.g. one query template with different variables.
+
+    Args:
+        queries: List of dictionaries of inputs to `query_data()` for each query (e.g. `replace_var`), which override
+            those in `kwargs`
+        n_jobs: Number of queries run at once, -1 for one per core. Should not exceed the pool size and overflow of
+            the engine, or queries will wait for connections
+        conn: SQLAlchemy engine to run the queries on, from `create_connection(dbconfig=dbconfig)` if not given
+        dbconfig: Path to the database configuration file, used if `conn` is not given
+        **kwargs: Inputs to `query_data()` shared by every query, e.g. `sql` or `path_to_sql`
+
+    Returns: List of pandas dataframes of the results of each query, in the order of `queries`
+
+    """
+    if "chunksize" in kwargs or any("chunksize" in query for query in queries):
+        raise ValueError("Queries run by query_many() cannot be read in chunks")
+
+    if conn is None:
+        conn = create_connection(dbconfig=dbconfig)
+
+    # A query template in a file is read once rather than once per query
+    if kwargs.get("path_to_sql") is not None:
+        kwargs["sql"] = load_sql(kwargs.pop("path_to_sql"), load_comments=kwargs.pop("load_comments", False),
+                                 python=False)
+
+    def run_query(query):
+        return query_data(conn=conn, **dict(kwargs, **query))
+
+    with Timer("query_many", logger) as t:
+        with multiprocessing.pool.ThreadPool(min(resolve_n_jobs(n_jobs), max(len(queries), 1))) as pool:
+            frames = pool.map(run_query, queries)
+        t.rows = sum(len(df) for df in frames)
+
+    return frames
+
+
+def save_chunks(chunks, path, fmt=None, **kwargs):
+    """Writes each chunk of a dataset read in chunks (e.g. a streamed query) to one CSV or Parquet file in turn.
+
+    Args:
+        chunks: Iterator of dataframes, e.g. from `load_data(..., chunksize=n)`
+        path: Path to write to, the format is picked by its extension unless `fmt` is given
+        fmt: Format to write, "csv" or "parquet" (optional)
+        **kwargs: Keyword arguments to `FrameWriter`
+
+    Returns: Number of rows written
+
+    """
+    n_rows = 0
+    with Timer("save %s" % path, logger) as t, FrameWriter(path, fmt=fmt, index=False, **kwargs) as writer:
+        for df in chunks:
+            writer.write(df)
+            n_rows += len(df)
+            t.rows = n_rows
+
+    logger.info("%i rows in %i chunks saved to %s", n_rows, writer.n_chunks, path)
+
+    return n_rows
+
+
 def read_csv(path, **kwargs):
 
+    # Objects on S3 are streamed straight into the parser rather than downloaded first
+    if path.startswith("s3://"):
+        if path.endswith(".gz") and "compression" not in kwargs:
+            kwargs["compression"] = "gzip"
+        source = open_s3_object(path)
+    else:
+        source = path
+
     if "usecols" in kwargs:
         logging.debug("Columns being read from csv: %s", ",".join(kwargs["usecols"]))
-    df = pd.read_csv(path, **kwargs)
+    df = pd.read_csv(source, **kwargs)
+
+    if kwargs.get("chunksize") is not None:
+        logger.info("%s being read in chunks of %i rows", path, kwargs["chunksize"])
+    else:
+        logger.info("Dataframe with %i rows loaded from %s", len(df), path)
+
+    return df
+
 
-    logger.info("Dataframe with %i rows loaded from %s", len(df), path)
+def read_npy(path, columns=None):
+    """Opens a .npy file memory-mapped, so that processes reading the same file share the page cache rather than
+    each holding a private copy.
+
+    The file should hold a 2D array, or a structured array whose fields all have the same dtype (as written by
+    `save_frame()` for a numeric dataframe). The dataframe returned is then a zero-copy view of the file, as is its
+    `.values` when given to a model. Structured arrays with mixed dtypes are copied into memory.
+
+    Args:
+        path: Path to the .npy file
+        columns: Column names for a 2D array, ignored for structured arrays which hold their own (optional)
+
+    Returns: Pandas dataframe backed by the memory-mapped file
+
+    """
+    mapped = np.load(path, mmap_mode="r")
+
+    data = mapped
+    if mapped.dtype.names is not None:
+        columns = list(mapped.dtype.names)
+        data = structured_to_unstructured(mapped)
+
+    if not np.may_share_memory(data, mapped):
+        logger.warning("%s could not be memory-mapped without a copy, store a single dtype to avoid copying", path)
+
+    df = pd.DataFrame(data, columns=columns, copy=False)
+
+    logger.info("Dataframe with %i rows memory-mapped from %s", len(df), path)
 
     return df
 
 
-def load_data(how, query=None, csv=None):
+def read_arrow(path, columns=None):
+    """Opens an Arrow IPC file (e.g. a .arrow or .feather file written by `save_frame()`) memory-mapped.
+
+    Numeric columns without missing values are zero-copy views of the file, so processes reading the same file share
+    the page cache. Being columnar, the columns are still copied into one array when given to a model.
+
+    Args:
+        path: Path to the Arrow file
+        columns: Columns to read, all if None (optional)
+
+    Returns: Pandas dataframe backed by the memory-mapped file
+
     """
+    import pyarrow as pa
+
+    table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+    if columns is not None:
+        table = pa.Table.from_arrays([table.column(column) for column in columns], names=columns)
+
+    # Keeping each column in its own block avoids consolidating, and copying, the columns into 2D arrays
+    df = table.to_pandas(split_blocks=True)
+
+    logger.info("Dataframe with %i rows memory-mapped from %s", len(df), path)
+
+    return df
+
+
+def list_partitions(path, fmt=None):
+    """Lists the partition files of a dataset, given as a directory, a glob pattern or a list of paths.
 
     Args:
-        how: How to load data. Options are one of remaining keyword args (e.g. query, read_csv)
-        query: Dictionary of inputs to `query_data()`, None if how="csv"
-        csv:  Dictionary of inputs to `read_csv()`, None if how="query"
+        path: Directory holding the partitions, glob pattern matching them (e.g. "data/2019-*.csv") or list of paths
+        fmt: Format of the partitions, "csv" or "parquet". Files in a directory are filtered to those with an extension
+            of `fmt`, or of either format if not given (optional)
+
+    Returns: Sorted list of paths to the partitions
+
+    """
+    if type(path) == list:
+        paths = path
+    elif os.path.isdir(path):
+        extensions = sum([format_extensions[f] for f in ([fmt] if fmt is not None else ["csv", "parquet"])], [])
+        paths = [os.path.join(path, f) for f in os.listdir(path) if os.path.splitext(f)[1].lower() in extensions]
+    else:
+        paths = glob.glob(path)
+
+    if len(paths) == 0:
+        raise ValueError("No partitions found at %s" % path)
+
+    return sorted(paths)
+
+
+def read_partition(path, fmt=None, usecols=None, dtype=None, **kwargs):
+    """Reads one CSV or Parquet partition, reading only `usecols` and casting to `dtype` as it is read.
+
+    Args:
+        path: Path to the partition
+        fmt: Format of the partition, picked by its extension if not given (optional)
+        usecols: Columns to read, all if None (optional)
+        dtype: Dtype, or dictionary of column names to dtypes, to read the columns as (optional)
+        **kwargs: Keyword arguments to `pd.read_csv()` or `pd.read_parquet()`
 
     Returns: Pandas dataframe
 
     """
+    fmt = get_format(path, fmt)
+
+    with Timer("read %s" % path, logger, level=logging.DEBUG) as t:
+        if fmt == "csv":
+            df = pd.read_csv(path, usecols=usecols, dtype=dtype, **kwargs)
+        elif fmt == "parquet":
+            # Parquet is columnar, so columns not in `usecols` are never read from disk
+            df = pd.read_parquet(path, columns=usecols, **kwargs)
+            df = df.astype(dtype) if dtype is not None else df
+        else:
+            raise ValueError("Partitions must be csv or parquet files, not %s" % fmt)
+        t.rows = len(df)
+
+    # Throughput in bytes as well as rows, as rows of different datasets differ in size
+    t.record["size_mb"] = os.path.getsize(path) / 1e6
+    t.record["mb_per_second"] = t.record["size_mb"] / t.seconds if t.seconds > 0 else None
+
+    return df
+
+
+def _read_partition(args):
+    path, kwargs = args
+    return read_partition(path, **kwargs)
+
+
+def read_partitions(path, format=None, usecols=None, dtype=None, n_jobs=4, processes=False, **kwargs):
+    """Reads the CSV or Parquet partitions of a dataset in parallel and concatenates them into one dataframe.
+
+    Threads are used by default, as the pandas CSV parser and pyarrow release the GIL while parsing and each
+    partition is returned without being copied between processes. Use `processes` if parsing is bound by the GIL,
+    e.g. for CSVs read with a `converters` function or the python engine.
+
+    Args:
+        path: Directory, glob pattern or list of paths of the partitions (see `list_partitions()`)
+        format: Format of the partitions, "csv" or "parquet", picked by the extension of each if not given (optional)
+        usecols: Columns to read from each partition, all if None (optional)
+        dtype: Dtype, or dictionary of column names to dtypes, to read the columns of each partition as (optional)
+        n_jobs: Number of partitions read at once, -1 for one per core
+        processes: Whether to read the partitions in a pool of processes instead of threads
+        **kwargs: Keyword arguments to `pd.read_csv()` or `pd.read_parquet()` for each partition
+
+    Returns: Pandas dataframe of the partitions concatenated in the order of their paths
+
+    """
+    paths = list_partitions(path, fmt=format)
+    kwargs = dict(kwargs, fmt=format, usecols=usecols, dtype=dtype)
+
+    n_jobs = min(resolve_n_jobs(n_jobs), len(paths))
+    pool = multiprocessing.Pool(n_jobs) if processes else multiprocessing.pool.ThreadPool(n_jobs)
+    with pool:
+        frames = pool.map(_read_partition, [(p, kwargs) for p in paths])
+
+    # Concatenated once at the end, rather than appending partition by partition, so each row is copied only once
+    df = pd.concat(frames, ignore_index=True)
+    del frames
+
+    # Categories differ between partitions, which pd.concat() falls back to object columns for
+    if type(dtype) == dict:
+        for column in [c for c in dtype if dtype[c] == "category" and c in df.columns]:
+            df[column] = df[column].astype("category")
 
-    if how.lower() == "query":
-        query = {} if query is None else query
-        data = query_data(**query)
+    logger.info("Dataframe with %i rows loaded from %i partitions at %s", len(df), len(paths), path)
+
+    return df
+
+
+def fingerprint_data(how, query=None, csv=None, file=None, cache_key=None, cache_ttl=None, **kwargs):
+    """Fingerprints the data `load_data()` would load, for keying cached pipeline stages on.
+
+    Files are fingerprinted by path, size and modification time. Query results cannot be fingerprinted without
+    running the query, so a query is only fingerprinted if the configuration opts in to caching its results, by an
+    explicit `cache_key` to change whenever the results should be queried again, or by `cache_ttl`, the number of
+    seconds the results may be reused for. Otherwise None is returned and the results are never cached.
+    """
+    if how.lower() == "query" and cache_key is not None:
+        return "query:%s" % cache_key
+    elif how.lower() == "query" and cache_ttl is not None:
+        # The fingerprint changes at the end of each window of `cache_ttl` seconds
+        return "query-ttl:%i:%i" % (cache_ttl, time.time() // cache_ttl)
+    if how.lower() == "csv" and csv["path"].startswith("s3://"):
+        return fingerprint_s3_object(csv["path"])
     elif how.lower() == "csv":
-        if csv is None or "path" not in csv:
-            raise ValueError("csv['path'] must exist be provided")
-        data = read_csv(**csv)
-    else:
-        raise ValueError("how must be given as 'query' or 'csv'")
+        return fingerprint_file(csv["path"])
+    elif how.lower() == "partitions":
+        # Each partition is fingerprinted, so adding, removing or rewriting any one of them changes the fingerprint
+        fingerprints = [fingerprint_file(p) for p in list_partitions(kwargs["partitions"]["path"],
+                                                                     kwargs["partitions"].get("format"))]
+        return hashlib.sha256("\n".join(fingerprints).encode("utf-8")).hexdigest()
+    elif how.lower() in ["file", "npy", "arrow"]:
+        return fingerprint_file((file or kwargs[how.lower()])["path"])
+    return None
+
+
+def load_data(how, query=None, csv=None, file=None, npy=None, arrow=None, partitions=None, chunksize=None,
+              cache_key=None, cache_ttl=None):
+    """
+
+    Args:
+        how: How to load data. Options are one of remaining keyword args (e.g. query, read_csv)
+        query: Dictionary of inputs to `query_data()`, None if how="csv"
+        csv:  Dictionary of inputs to `read_csv()`, None if how="query"
+        file: Dictionary of inputs to `read_frame()` for reading CSV, Parquet, Feather or .npy files, with the
+            format picked by extension or given by `format`
+        npy: Dictionary of inputs to `read_npy()` for memory-mapping a .npy file
+        arrow: Dictionary of inputs to `read_arrow()` for memory-mapping an Arrow IPC file
+        partitions: Dictionary of inputs to `read_partitions()` for reading a directory or glob of CSV or Parquet
+            partitions in parallel
+        chunksize: If given, number of rows per chunk to read the data in (optional)
+        cache_key, cache_ttl: Whether query results may be cached by the stage cache, see `fingerprint_data()`.
+            Not used to load the data
+
+    Returns: Pandas dataframe, or an iterator of dataframes if `chunksize` is given
+
+    """
+
+    with Timer("load_data", logger) as t:
+        if how.lower() == "query":
+            query = {} if query is None else query
+            if chunksize is not None:
+                query = dict(query, chunksize=chunksize)
+            data = query_data(**query)
+        elif how.lower() == "csv":
+            if csv is None or "path" not in csv:
+                raise ValueError("csv['path'] must exist be provided")
+            if chunksize is not None:
+                csv = dict(csv, chunksize=chunksize)
+            data = read_csv(**csv)
+        elif how.lower() == "file":
+            if file is None or "path" not in file:
+                raise ValueError("file['path'] must exist be provided")
+            if chunksize is not None:
+                raise ValueError("Only csv and query data can be read in chunks")
+            file = dict(file)
+            path, fmt = file.pop("path"), file.pop("format", None)
+            data = read_frame(path, fmt=fmt, **file)
+            logger.info("Dataframe with %i rows loaded from %s", len(data), path)
+        elif how.lower() in ["npy", "arrow"]:
+            source = npy if how.lower() == "npy" else arrow
+            if source is None or "path" not in source:
+                raise ValueError("%s['path'] must exist be provided" % how.lower())
+            if chunksize is not None:
+                raise ValueError("Only csv and query data can be read in chunks")
+            data = read_npy(**source) if how.lower() == "npy" else read_arrow(**source)
+        elif how.lower() == "partitions":
+            if partitions is None or "path" not in partitions:
+                raise ValueError("partitions['path'] must exist be provided")
+            if chunksize is not None:
+                raise ValueError("Only csv and query data can be read in chunks")
+            data = read_partitions(**partitions)
+        else:
+            raise ValueError("how must be given as 'query', 'csv', 'file', 'npy', 'arrow' or 'partitions'")
+
+        # Rows of chunked data are only known once the chunks are read
+        t.rows = len(data) if chunksize is None else None
+
     return data
 
 
@@ -173,5 +607,7 @@ if __name__ == '__main__':
 
     df = load_data(**config["load_data"])
 
-    if args.save is not None:
-        df.to_csv(args.save)
+    if args.save is not None and isinstance(df, pd.DataFrame):
+        save_frame(df, args.save)
+    elif args.save is not None:
+        save_chunks(df, args.save)
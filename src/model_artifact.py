@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import pickle
+import hashlib
+import logging
+import datetime
+import threading
+
+import numpy as np
+import pandas as pd
+
+from src.helpers import Timer
+
+logger = logging.getLogger(__name__)
+
+# Sections of the `train_model` configuration that do not change the model trained, so are not hashed
+unhashed_config_keys = ["featurize", "warm_start", "save_tmo"]
+
+
+def _joblib():
+    try:
+        import joblib
+    except ImportError:
+        from sklearn.externals import joblib
+    return joblib
+
+
+def xgboost_extension():
+    """Extension of the format xgboost models are saved in. Universal binary JSON is the fastest format xgboost saves
+    to, older versions only have their own binary format."""
+    import xgboost
+    return "ubj" if tuple(int(v) for v in xgboost.__version__.split(".")[:2]) >= (1, 6) else "bin"
+
+
+def is_artifact(path_to_tmo):
+    """Whether a trained model object is saved as an artifact directory rather than a pickle. Paths without an
+    extension (e.g. models/example-boston-crime-prediction) are artifacts."""
+    return os.path.isdir(path_to_tmo) or os.path.splitext(path_to_tmo)[1] == ""
+
+
+def config_hash(train_config):
+    """Hashes the sections of a `train_model` configuration that decide the model trained."""
+    train_config = {k: v for k, v in train_config.items() if k not in unhashed_config_keys}
+    return hashlib.sha256(json.dumps(train_config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 ** 2), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_artifact(model, path, X=None, train_config_hash=None):
+    """Saves a trained model object as an artifact directory of the model in a format that loads quickly and a
+    manifest describing it.
+
+    XGBoost models are saved in xgboost's own binary format, which loads far faster than unpickling, and other
+    models with joblib, whose numpy arrays can be memory-mapped when loaded. The manifest records the format, a
+    checksum of the model file, the hash of the configuration that trained it and the features and dtypes it was
+    trained on, and for xgboost classifiers their objective and classes, which older versions of xgboost do not save
+    in their own format.
+
+    Args:
+        model: Trained model object
+        path: Directory to save the artifact to, replacing any artifact already there
+        X: Features the model was trained on, whose columns and dtypes are recorded if a dataframe (optional)
+        train_config_hash: `config_hash()` of the `train_model` configuration (optional)
+
+    """
+    os.makedirs(path, exist_ok=True)
+
+    # A model can only be an xgboost model if xgboost was imported to train or load it, so it is not imported here
+    xgboost, native = sys.modules.get("xgboost"), sys.modules.get("src.xgboost_native")
+
+    if native is not None and isinstance(model, native.BoosterModel):
+        kind, model_file = "xgboost_booster", "model.%s" % xgboost_extension()
+        model.booster.save_model(os.path.join(path, model_file))
+    elif xgboost is not None and isinstance(model, xgboost.XGBModel):
+        kind, model_file = "xgboost_sklearn", "model.%s" % xgboost_extension()
+        model.save_model(os.path.join(path, model_file))
+    else:
+        kind, model_file = "joblib", "model.joblib"
+        # Uncompressed so that the arrays of the model can be memory-mapped when loaded
+        _joblib().dump(model, os.path.join(path, model_file), compress=0)
+
+    manifest = dict(kind=kind, model_file=model_file, model_class=type(model).__name__,
+                    checksum=checksum(os.path.join(path, model_file)), config_hash=train_config_hash,
+                    created=datetime.datetime.now().isoformat(),
+                    objective=model.objective if kind != "joblib" and isinstance(model.objective, str) else None)
+
+    if kind == "xgboost_sklearn" and hasattr(model, "classes_"):
+        manifest["classes"] = np.asarray(model.classes_).tolist()
+
+    if isinstance(X, pd.DataFrame):
+        manifest["features"] = [str(c) for c in X.columns]
+        manifest["dtypes"] = {str(c): str(dtype) for c, dtype in X.dtypes.items()}
+    elif X is not None:
+        manifest["n_features"] = int(X.shape[1])
+
+    # The manifest is written last, so a directory without one holds no complete artifact
+    with open(os.path.join(path, "manifest.json.tmp"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(os.path.join(path, "manifest.json.tmp"), os.path.join(path, "manifest.json"))
+
+
+def read_manifest(path):
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+        return json.load(f)
+
+
+def _load_estimator(path, manifest, mmap=True, verify=True):
+    model_path = os.path.join(path, manifest["model_file"])
+
+    if verify and checksum(model_path) != manifest["checksum"]:
+        raise ValueError("Checksum of %s does not match its manifest, the artifact is corrupt or was modified"
+                         % model_path)
+
+    if manifest["kind"] == "xgboost_booster":
+        import xgboost
+        from src.xgboost_native import BoosterModel
+
+        booster = xgboost.Booster()
+        booster.load_model(model_path)
+        return BoosterModel(booster, manifest["objective"])
+    elif manifest["kind"] == "xgboost_sklearn":
+        import xgboost
+
+        model = getattr(xgboost, manifest["model_class"])()
+        if manifest.get("objective") is not None:
+            model.objective = manifest["objective"]
+        model.load_model(model_path)
+
+        # Older xgboost, as the pinned 0.82, only sets the classes of a classifier when fitting it, not loading it
+        if manifest.get("classes") is not None and getattr(model, "n_classes_", None) is None:
+            from sklearn.preprocessing import LabelEncoder
+
+            model._le = LabelEncoder()
+            model._le.classes_ = model.classes_ = np.array(manifest["classes"])
+            model.n_classes_ = len(manifest["classes"])
+        return model
+    return _joblib().load(model_path, mmap_mode="r" if mmap else None)
+
+
+class LazyModel:
+    """Trained model artifact whose manifest is read when it is opened but whose model is only loaded, and its
+    checksum verified, the first time it is used, e.g. by `predict()`.
+
+    Args:
+        path: Artifact directory saved by `save_artifact()`
+        mmap: Whether the arrays of joblib models are memory-mapped rather than read into memory
+        verify: Whether to check the model file against the checksum in the manifest when loading it
+
+    """
+
+    def __init__(self, path, mmap=True, verify=True):
+        self.path = path
+        self.mmap = mmap
+        self.verify = verify
+        self.manifest = read_manifest(path)
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                with Timer("loading %s" % self.path, logger, level=logging.DEBUG):
+                    self._model = _load_estimator(self.path, self.manifest, mmap=self.mmap, verify=self.verify)
+            return self._model
+
+    def __getattr__(self, name):
+        # Only called for attributes not set in __init__, which are looked up on the model itself
+        if name.startswith("__") or name in ["path", "mmap", "verify", "manifest", "_model", "_lock"]:
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def __getstate__(self):
+        return dict(path=self.path, mmap=self.mmap, verify=self.verify, manifest=self.manifest)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, _model=None, _lock=threading.Lock())
+
+
+def load_model(path_to_tmo, lazy=True, mmap=True, verify=True):
+    """Loads a trained model object saved either as an artifact directory or a pickle.
+
+    Args:
+        path_to_tmo: Path to the artifact directory or pickle
+        lazy: Whether to defer loading an artifact's model until it is first used
+        mmap: Whether to memory-map the arrays of joblib models, which makes them read-only
+        verify: Whether to check an artifact's model file against the checksum in its manifest
+
+    Returns: Trained model object, a `LazyModel` for lazily loaded artifacts
+
+    """
+    if not is_artifact(path_to_tmo):
+        with open(path_to_tmo, "rb") as f:
+            return pickle.load(f)
+
+    model = LazyModel(path_to_tmo, mmap=mmap, verify=verify)
+    return model if lazy else model.model
+
+
+def check_config(path_to_tmo, train_config):
+    """Warns if the model at `path_to_tmo` was not trained with the `train_model` configuration given.
+
+    Returns: False if the artifact's configuration hash differs, True otherwise, including for pickles
+    """
+    if not is_artifact(path_to_tmo):
+        return True
+
+    trained_with = read_manifest(path_to_tmo).get("config_hash")
+    if trained_with is not None and trained_with != config_hash(train_config):
+        logger.warning("%s was trained with a different train_model configuration than the one given",
+                       path_to_tmo)
+        return False
+    return True
+
+
+def trained_features(path_to_tmo):
+    """Features an artifact was trained on, in order. None for pickles and models trained on sparse matrices."""
+    if not is_artifact(path_to_tmo):
+        return None
+    return read_manifest(path_to_tmo).get("features")
+
+
+def check_model_input(X, features):
+    """Checks that a dataframe has the `features` a model was trained on, from `trained_features()`, and orders its
+    columns as they were when training. Other inputs are returned as they are."""
+    if features is None or not isinstance(X, pd.DataFrame):
+        return X
+
+    missing = [c for c in features if c not in X.columns]
+    if len(missing) > 0:
+        raise ValueError("Features %s the model was trained on are missing" % ", ".join(missing))
+
+    return X[features]
@@ -0,0 +1,200 @@
+import logging
+import argparse
+import yaml
+import concurrent.futures
+
+import pandas as pd
+
+from src.helpers import Timer, StageCache
+from src.load_data import load_data
+from src.generate_features import generate_features, compile_feature_pipeline
+from src.train_model import prepare_training_data, train_model
+from src.score_model import score_model, get_feature_pipeline
+
+logger = logging.getLogger(__name__)
+
+# Stages the pipeline can run, in the order they are run if they could not run at the same time
+pipeline_stages = ["load_data", "generate_features", "train_model", "score_model", "evaluate_model"]
+
+
+def _data_stage(config, stage, stages):
+    """Stage whose output `stage` takes as its data: the raw data if `stage` featurizes its own input or features are
+    not generated, else the features."""
+    if config[stage].get("featurize", False) or "generate_features" not in stages:
+        return "load_data"
+    return "generate_features"
+
+
+def stage_dependencies(config, stages):
+    """Gets the stages whose outputs each of `stages` takes as input.
+
+    Args:
+        config: Model configuration
+        stages: List of stages to run, each a key of `pipeline_stages`
+
+    Returns: Dictionary of the list of stages each stage depends on
+
+    """
+    dependencies = dict(load_data=[], generate_features=["load_data"])
+    if "train_model" in stages:
+        dependencies["train_model"] = [_data_stage(config, "train_model", stages)]
+    if "score_model" in stages:
+        # Without a model trained by the pipeline, the model at `path_to_tmo` is scored
+        dependencies["score_model"] = [_data_stage(config, "score_model", stages)] + \
+            (["train_model"] if "train_model" in stages else [])
+    dependencies["evaluate_model"] = ["train_model"]
+
+    for stage in stages:
+        if stage not in pipeline_stages:
+            raise ValueError("%s is not a pipeline stage, stages are %s" % (stage, ", ".join(pipeline_stages)))
+        if stage not in config:
+            raise ValueError("'%s' configuration must exist in config file to run it in the pipeline" % stage)
+        missing = [dependency for dependency in dependencies[stage] if dependency not in stages]
+        if len(missing) > 0:
+            raise ValueError("%s needs %s to run in the pipeline" % (stage, ", ".join(missing)))
+
+    return {stage: dependencies[stage] for stage in stages}
+
+
+def _run_load_data(config, inputs):
+    df = load_data(**config["load_data"])
+    if not isinstance(df, pd.DataFrame):
+        raise ValueError("The pipeline passes whole dataframes between stages, so cannot load data in chunks")
+    return df
+
+
+def _own_copy(df):
+    """Copy of a dataframe output by another stage for a stage that generates features from it. Feature steps assign
+    columns in place, so without a copy they would change the dataframe other stages read, possibly at the same time.
+    """
+    return df.copy() if isinstance(df, pd.DataFrame) else df
+
+
+def _run_generate_features(config, inputs):
+    return generate_features(_own_copy(inputs["load_data"]), **config["generate_features"])
+
+
+def _run_train_model(config, inputs):
+    train_config = {k: v for k, v in config["train_model"].items() if k != "featurize"}
+    df = inputs[_data_stage(config, "train_model", inputs)]
+    features = compile_feature_pipeline(config, "train_model")
+    cache = StageCache(**config["cache"]) if "cache" in config else None
+    df = _own_copy(df) if features is not None else df
+
+    # Warm starts and training natively from files prepare their own data, so their splits cannot be evaluated
+    if train_config.get("warm_start") is not None or train_config.get("native", {}).get("train_path") is not None:
+        model = train_model(df, features=features, cache=cache, **train_config)
+        return dict(model=model, features=None, X=None, y=None)
+
+    splits = prepare_training_data(df, features=features, cache=cache, **train_config)
+    model = train_model(df, features=features, cache=cache, splits=splits, **train_config)
+
+    features, X, y = splits
+    return dict(model=model, features=features, X=X, y=y)
+
+
+def _run_score_model(config, inputs):
+    score_config = {k: v for k, v in config["score_model"].items() if k not in ["chunksize", "featurize"]}
+    df = inputs[_data_stage(config, "score_model", inputs)]
+    trained = inputs.get("train_model")
+
+    if trained is None:
+        features = get_feature_pipeline(config)
+        return score_model(_own_copy(df) if features is not None else df, features=features, **score_config)
+
+    if config["score_model"].get("featurize", False):
+        # Features are generated as fit when training rather than from the categories and bins of the scored data
+        features = trained["features"] if trained["features"] is not None else get_feature_pipeline(config)
+        df = features.transform(_own_copy(df), model_input=True)
+
+    # The columns the model was trained on are scored, leaving out e.g. the target
+    if trained["X"] is not None and isinstance(trained["X"]["train"], pd.DataFrame):
+        df = df[trained["X"]["train"].columns]
+
+    return score_model(df, model=trained["model"], **score_config)
+
+
+def _run_evaluate_model(config, inputs):
+    from src.evaluate_model import evaluate_model, file_config_keys
+
+    evaluate_config = {k: v for k, v in config["evaluate_model"].items() if k not in file_config_keys}
+    split = evaluate_config.pop("split", "test")
+    trained = inputs["train_model"]
+
+    if trained["X"] is None or split not in trained["X"] or trained["y"].get(split) is None:
+        raise ValueError("The model trained by the pipeline has no %s split with targets to evaluate on" % split)
+
+    y_score = trained["model"].predict_proba(trained["X"][split])[:, 1]
+    return evaluate_model(trained["y"][split], y_score, metrics_to_use=evaluate_config.pop("metrics", None),
+                          **evaluate_config)
+
+
+stage_runners = dict(load_data=_run_load_data, generate_features=_run_generate_features,
+                     train_model=_run_train_model, score_model=_run_score_model,
+                     evaluate_model=_run_evaluate_model)
+
+
+def _run_stage(stage, config, inputs):
+    with Timer("pipeline %s" % stage, logger):
+        return stage_runners[stage](config, inputs)
+
+
+def run_stages(config, stages=None, n_jobs=None):
+    """Runs the stages of the pipeline as a DAG in one process.
+
+    Each stage gets the outputs of the stages it depends on in memory, so no stage reads or writes files except where
+    its configuration asks it to (e.g. `save_dataset`, `save_tmo`, `save_scores`). Stages that do not depend on each
+    other, such as scoring and evaluating the trained model, run at the same time in threads.
+
+    Args:
+        config: Model configuration, with a section for each stage run
+        stages: List of stages to run, by default the `pipeline: stages` configuration or every stage of
+            `pipeline_stages` with a section in `config`
+        n_jobs: Number of stages that can run at once, by default as many as can be ready at once
+
+    Returns: Dictionary of the output of each stage
+
+    """
+    pipeline_config = config.get("pipeline", {})
+    stages = pipeline_config.get("stages") if stages is None else stages
+    stages = [stage for stage in pipeline_stages if stage in config] if stages is None else stages
+    stages = [stages] if type(stages) != list else stages
+    n_jobs = pipeline_config.get("n_jobs", len(stages)) if n_jobs is None else n_jobs
+
+    dependencies = stage_dependencies(config, stages)
+    logger.info("Running pipeline of %s", ", ".join(stages))
+
+    outputs, running = {}, {}
+    with Timer("pipeline", logger), concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        while len(outputs) < len(stages):
+            for stage in stages:
+                ready = all(dependency in outputs for dependency in dependencies[stage])
+                if stage not in outputs and stage not in running and ready:
+                    inputs = {dependency: outputs[dependency] for dependency in dependencies[stage]}
+                    running[stage] = executor.submit(_run_stage, stage, config, inputs)
+
+            done, _ = concurrent.futures.wait(running.values(), return_when=concurrent.futures.FIRST_COMPLETED)
+            for stage in [stage for stage, future in running.items() if future in done]:
+                # Raises the exception of a failed stage, after the stages still running finish
+                outputs[stage] = running.pop(stage).result()
+
+    return outputs
+
+
+def run_pipeline(args):
+    with open(args.config, "r") as f:
+        config = yaml.load(f)
+
+    stages = args.stages.split(",") if getattr(args, "stages", None) is not None else None
+    run_stages(config, stages=stages, n_jobs=getattr(args, "n_jobs", None))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the stages of the pipeline in one process")
+    parser.add_argument('--config', help='path to yaml file with configurations')
+    parser.add_argument('--stages', default=None, help='Comma-separated stages to run (optional)')
+    parser.add_argument('--n_jobs', default=None, type=int, help='Number of stages that can run at once (optional)')
+
+    args = parser.parse_args()
+
+    run_pipeline(args)
@@ -2,65 +2,269 @@ import logging
 import argparse
 import yaml
 import os
-import subprocess
-import re
-import datetime
+import multiprocessing
 
-import pickle
-
-import sklearn
-import xgboost
 import pandas as pd
 import numpy as np
 
 from src.load_data import load_data
-from src.helpers import Timer, fillin_kwargs
-from src.generate_features import choose_features, get_target
-from sklearn.linear_model import LogisticRegression, LinearRegression
+from src.helpers import Timer, fillin_kwargs, resolve_n_jobs, save_frame, FrameWriter
+from src.generate_features import choose_features, get_target, compile_feature_pipeline, feature_pipeline_path, \
+    load_feature_pipeline, to_model_input
+from src.model_artifact import load_model, check_config, trained_features, check_model_input
 
 logger = logging.getLogger(__name__)
 
 score_model_kwargs = ["predict"]
 
+# Methods of the trained model object that scores can be got from
+score_methods = ["predict", "predict_proba"]
+
+# Trained model object of a scoring worker process, loaded once per process by `_init_worker()`
+_worker_model = None
+
+
+def load_tmo(path_to_tmo):
+    """Loads a pickled trained model object, or lazily loads a model artifact directory saved by `save_artifact()`.
+    """
+    return load_model(path_to_tmo)
+
+
+def _init_worker(path_to_tmo):
+    global _worker_model
+    _worker_model = load_tmo(path_to_tmo)
+
+
+def predict_scores(model, X, method="predict", **kwargs):
+    """Scores `X` with `method` of a trained model object.
+
+    Args:
+        model: Trained model object
+        X: Numpy array or scipy sparse matrix of features to score
+        method: `predict` for what the model predicts, for classifiers labels, or `predict_proba` for predicted
+            probabilities, of only the positive class for binary classifiers
+        **kwargs: Keyword arguments to the method
+
+    Returns: Numpy array of scores
+
+    """
+    if method not in score_methods:
+        raise ValueError("Scoring method must be one of %s, not %s" % (", ".join(score_methods), method))
+
+    y_predicted = getattr(model, method)(X, **kwargs)
+    if method == "predict_proba" and y_predicted.ndim == 2 and y_predicted.shape[1] == 2:
+        y_predicted = y_predicted[:, 1]
+
+    return y_predicted
+
+
+def _predict_partition(partition):
+    X, method, predict_kwargs = partition
+    return predict_scores(_worker_model, X, method=method, **predict_kwargs)
+
+
+def scoring_pool(path_to_tmo, n_jobs):
+    """Creates a pool of `n_jobs` worker processes that each load the trained model object once.
+
+    Args:
+        path_to_tmo: Path to the pickled trained model object
+        n_jobs: Number of worker processes, negative to count back from all cores (e.g. -1 to use all cores)
+
+    Returns: `multiprocessing.Pool` to be given to `predict_parallel()`
+
+    """
+    n_jobs = resolve_n_jobs(n_jobs)
+
+    logger.info("Starting %i scoring worker processes", n_jobs)
+
+    return multiprocessing.Pool(processes=n_jobs, initializer=_init_worker, initargs=(path_to_tmo,))
+
+
+def predict_parallel(pool, X, n_partitions, method="predict", **kwargs):
+    """Splits `X` into row partitions, scores them across the workers of `pool` and returns the
+    predictions in the original row order.
+
+    Args:
+        pool: Pool of scoring workers from `scoring_pool()`
+        X: Numpy array or scipy sparse matrix of features to score
+        n_partitions: Number of row partitions to split `X` into
+        method: Method of the model to score with, see `predict_scores()`
+        **kwargs: Keyword arguments to the method
+
+    Returns: Numpy array of predictions
+
+    """
+    bounds = np.linspace(0, X.shape[0], n_partitions + 1).astype(int)
+    partitions = [(X[start:end], method, kwargs) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    # Pool.map returns results in the order of the partitions, regardless of which finishes first
+    y_predicted = pool.map(_predict_partition, partitions)
+
+    return np.concatenate(y_predicted)
 
-def score_model(df, path_to_tmo, save_scores=None, **kwargs):
 
-    with open(path_to_tmo, "rb") as f:
-        model = pickle.load(f)
+def score_model(df, path_to_tmo=None, save_scores=None, features=None, n_jobs=1, n_partitions=None, model=None,
+                method="predict", **kwargs):
+    """Scores `df` with a trained model object.
+
+    Args:
+        df: Pandas dataframe to score
+        path_to_tmo: Path to the trained model object, needed unless `model` is given
+        save_scores: Path to save the scores to (optional)
+        features: `FeaturePipeline` run on `df` before scoring (optional)
+        n_jobs: Number of worker processes to score across, -1 to use all cores (optional)
+        n_partitions: Number of row partitions to split `df` into when `n_jobs` is not 1, defaults to `n_jobs`
+        model: Trained model object already in memory, e.g. from the pipeline, to score with in this process instead
+            of loading `path_to_tmo` (optional)
+        method: `predict` to save what the model predicts, or `predict_proba` to save predicted probabilities, e.g.
+            to evaluate them with `auc` or `logloss` (optional)
+        **kwargs: May contain `predict`, a dictionary of inputs to the `method` of the model
+
+    Returns: Numpy array of predictions
+
+    """
+
+    if features is not None:
+        df = features.transform(df, model_input=True)
+    if model is None:
+        df = check_model_input(df, trained_features(path_to_tmo))
 
     kwargs = fillin_kwargs(score_model_kwargs, kwargs)
-    with Timer("scoring", logger):
-        y_predicted = model.predict(df.values, **kwargs["predict"])
+    if n_jobs != 1 and model is None:
+        n_partitions = resolve_n_jobs(n_jobs) if n_partitions is None else n_partitions
+        with scoring_pool(path_to_tmo, n_jobs) as pool, Timer("parallel scoring", logger, rows=len(df)):
+            y_predicted = predict_parallel(pool, to_model_input(df), n_partitions, method=method,
+                                           **kwargs["predict"])
+    else:
+        model = load_tmo(path_to_tmo) if model is None else model
+        with Timer("scoring", logger, rows=len(df)):
+            y_predicted = predict_scores(model, to_model_input(df), method=method, **kwargs["predict"])
 
     if save_scores is not None:
-        pd.DataFrame(y_predicted).to_csv(save_scores,  index=False)
+        save_frame(pd.DataFrame(y_predicted), save_scores, index=False)
 
     return y_predicted
 
 
+def score_chunks(chunks, path_to_tmo, save_scores, features=None, n_jobs=1, n_partitions=None, method="predict",
+                 **kwargs):
+    """Scores data one chunk at a time so that memory use does not grow with the size of the input.
+
+    Args:
+        chunks: Iterator of dataframes, e.g. from `load_data(..., chunksize=n)`
+        path_to_tmo: Path to the pickled trained model object
+        save_scores: Path to the CSV or Parquet file the scores of each chunk are appended to
+        features: `FeaturePipeline` run on each chunk before scoring (optional)
+        n_jobs: Number of worker processes each chunk is scored across, -1 to use all cores (optional)
+        n_partitions: Number of row partitions each chunk is split into when `n_jobs` is not 1, defaults to `n_jobs`
+        method: `predict` or `predict_proba`, as for `score_model()` (optional)
+        **kwargs: May contain `predict`, a dictionary of inputs to the `method` of the model
+
+    Returns: Number of rows scored
+
+    """
+
+    kwargs = fillin_kwargs(score_model_kwargs, kwargs)
+    n_partitions = resolve_n_jobs(n_jobs) if n_partitions is None else n_partitions
+
+    # The worker pool is started once and reused for every chunk
+    pool = scoring_pool(path_to_tmo, n_jobs) if n_jobs != 1 else None
+    n_rows = 0
+    try:
+        model = load_tmo(path_to_tmo) if pool is None else None
+        trained_on = trained_features(path_to_tmo)
+
+        with Timer("chunked scoring", logger) as t, FrameWriter(save_scores, index=False) as writer:
+            for i, df in enumerate(chunks):
+                if features is not None:
+                    df = features.transform(df, model_input=True)
+                df = check_model_input(df, trained_on)
+
+                if pool is not None:
+                    y_predicted = predict_parallel(pool, to_model_input(df), n_partitions, method=method,
+                                                   **kwargs["predict"])
+                else:
+                    y_predicted = predict_scores(model, to_model_input(df), method=method, **kwargs["predict"])
+
+                writer.write(pd.DataFrame(y_predicted))
+
+                n_rows += len(df)
+                t.rows = n_rows
+                logger.debug("Chunk %i scored, %i rows scored so far", i, n_rows)
+    finally:
+        # As when leaving `with scoring_pool(...)`, so that a failed chunk does not leave the workers running
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    logger.info("%i rows scored and saved to %s", n_rows, save_scores)
+
+    return n_rows
+
+
+def get_feature_pipeline(config):
+    """Gets the feature pipeline to apply to data before scoring, if scoring is configured to featurize its input.
+
+    The pipeline fit when training the model is used if it was saved next to the trained model object, so that
+    category vocabularies and bin edges are not recomputed from the data being scored.
+    """
+
+    features = compile_feature_pipeline(config, "score_model")
+    if features is None:
+        return None
+
+    path = feature_pipeline_path(config["score_model"]["path_to_tmo"])
+    if os.path.exists(path):
+        return load_feature_pipeline(path)
+
+    logger.warning("No fitted feature pipeline found at %s, features will be generated from the "
+                   "categories and bins of the data being scored", path)
+
+    return features
+
+
 def run_scoring(args):
     with open(args.config, "r") as f:
         config = yaml.load(f)
 
+    score_config = {k: v for k, v in config["score_model"].items() if k not in ["chunksize", "featurize"]}
+    if getattr(args, "n_jobs", None) is not None:
+        score_config["n_jobs"] = args.n_jobs
+    features = get_feature_pipeline(config)
+    chunksize = config["score_model"].get("chunksize")
+
+    if "train_model" in config:
+        check_config(score_config["path_to_tmo"], config["train_model"])
+
     if args.csv is not None:
-        df = load_data(how="csv", csv=dict(path=args.csv))
+        df = load_data(how="csv", csv=dict(path=args.csv), chunksize=chunksize)
     elif "load_data" in config:
-        df = load_data(**config["load_data"])
+        df = load_data(chunksize=chunksize, **config["load_data"])
     else:
         raise ValueError("Path to CSV for input data must be provided through --csv or "
                          "'load_data' configuration must exist in config file")
 
-    y_predicted = score_model(df, **config["score_model"])
+    if chunksize is not None:
+        if args.save is not None:
+            score_config["save_scores"] = args.save
+        if score_config.get("save_scores") is None:
+            raise ValueError("save_scores or --save must be given when scoring in chunks")
+        score_chunks(df, features=features, **score_config)
+        return
+
+    y_predicted = score_model(df, features=features, **score_config)
 
     if args.save is not None:
-        pd.DataFrame(y_predicted).to_csv(args.save, index=False)
+        save_frame(pd.DataFrame(y_predicted), args.save, index=False)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Score model")
     parser.add_argument('--config', help='path to yaml file with configurations')
-    parser.add_argumemt('--csv', default=None, help="Path to CSV for input to model scoring")
+    parser.add_argument('--csv', default=None, help="Path to CSV for input to model scoring")
     parser.add_argument('--save', default=None, help='Path to where the scores should be saved to (optional)')
+    parser.add_argument('--n_jobs', default=None, type=int,
+                        help='Number of processes to score across, -1 for all cores (optional)')
 
     args = parser.parse_args()
 
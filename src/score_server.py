@@ -0,0 +1,233 @@
+import logging
+import argparse
+import yaml
+import os
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pandas as pd
+
+from src.helpers import Timer, fillin_kwargs
+from src.generate_features import to_model_input, compile_feature_pipeline, load_feature_pipeline, \
+    feature_pipeline_path
+from src.model_artifact import load_model, trained_features, check_model_input
+from src.score_model import score_model_kwargs, predict_scores
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCache:
+    """Least recently used cache of trained model objects, keyed by path and modification time so that a model
+    is only loaded again when its file changes. Model artifacts are loaded in full rather than lazily, so that the
+    time taken to load and verify them is spent when they are cached rather than on the next request.
+
+    Each cached entry is a dictionary of the `model`, the `columns` it was trained on, from the artifact's manifest,
+    and the `features` pipeline to apply to batches before scoring them with it.
+
+    Args:
+        max_size: Maximum number of models kept loaded
+        features: Feature pipeline compiled from the configuration, used for models that have no fitted pipeline
+            saved next to them. If None, batches are scored as posted
+
+    """
+
+    def __init__(self, max_size=4, features=None):
+        self.max_size = max_size
+        self.features = features
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        # Lock of each model path, held while the model is loaded
+        self.loading = {}
+
+    def _load_features(self, path_to_tmo):
+        if self.features is None:
+            return None
+
+        # Each model is given the categories and bins fit with it, which may differ between models
+        path = feature_pipeline_path(path_to_tmo)
+        if os.path.exists(path):
+            return load_feature_pipeline(path)
+
+        logger.warning("No fitted feature pipeline found at %s, features will be generated from the "
+                       "configuration for %s", path, path_to_tmo)
+        return self.features
+
+    def get(self, path_to_tmo):
+        path = os.path.abspath(path_to_tmo)
+        key = (path, os.path.getmtime(path))
+
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            path_lock = self.loading.setdefault(path, threading.Lock())
+
+        # Models are loaded holding only the lock of their path, so loading one model does not hold up requests to
+        # the others, and concurrent requests for the same model load it once
+        with path_lock:
+            with self.lock:
+                if key in self.models:
+                    self.models.move_to_end(key)
+                    return self.models[key]
+
+            with Timer("loading %s" % path_to_tmo, logger):
+                entry = dict(model=load_model(path_to_tmo, lazy=False), columns=trained_features(path_to_tmo),
+                             features=self._load_features(path_to_tmo))
+
+            with self.lock:
+                # Drop versions of this model that were loaded before the file last changed
+                for stale in [k for k in self.models if k[0] == path]:
+                    del self.models[stale]
+                self.models[key] = entry
+
+                while len(self.models) > self.max_size:
+                    evicted, _ = self.models.popitem(last=False)
+                    logger.debug("%s evicted from model cache", evicted[0])
+
+            return entry
+
+
+class ScoringServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, models, default_model, cache, predict=None, method="predict"):
+        super().__init__(address, ScoringRequestHandler)
+        self.models = models
+        self.default_model = default_model
+        self.cache = cache
+        self.predict = {} if predict is None else predict
+        self.method = method
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """Scores batches posted as JSON of the form `{"data": [...], "columns": [...], "model": <name>}`, where
+    `data` is a list of records or rows, `columns` is optional and `model` optionally selects one of the
+    configured models. Responds with `{"scores": [...]}`."""
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._respond(200, dict(status="ok", models=list(self.server.models)))
+        else:
+            self._respond(404, dict(error="Unknown path %s" % self.path))
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length).decode("utf-8"))
+            if type(payload) != dict:
+                raise ValueError("Request body must be a JSON object with data to score")
+
+            name = payload.get("model", self.server.default_model)
+            if name not in self.server.models:
+                raise ValueError("Model %s is not served, options are %s" % (name, ", ".join(self.server.models)))
+
+            df = pd.DataFrame(payload["data"], columns=payload.get("columns"))
+        except (ValueError, KeyError, TypeError) as e:
+            self._respond(400, dict(error=str(e)))
+            return
+
+        try:
+            entry = self.server.cache.get(self.server.models[name])
+        except Exception as e:
+            logger.exception("Loading model %s failed", name)
+            self._respond(500, dict(error=str(e)))
+            return
+
+        try:
+            if entry["features"] is not None:
+                df = entry["features"].transform(df, model_input=True)
+            # Columns are ordered as the model was trained on them, and a batch missing any is rejected
+            df = check_model_input(df, entry["columns"])
+        except (ValueError, KeyError) as e:
+            self._respond(400, dict(error=str(e)))
+            return
+
+        try:
+            with Timer("scoring %i rows" % len(df), logger):
+                y_predicted = predict_scores(entry["model"], to_model_input(df), method=self.server.method,
+                                             **self.server.predict)
+        except Exception as e:
+            logger.exception("Scoring request failed")
+            self._respond(500, dict(error=str(e)))
+            return
+
+        self._respond(200, dict(scores=y_predicted.tolist()))
+
+    def _respond(self, status, body):
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def make_server(config, host="127.0.0.1", port=8000, cache_size=4, models=None):
+    """Creates a scoring server from a model configuration.
+
+    Args:
+        config: Model configuration with a `score_model` section, and `generate_features` if
+            `score_model: featurize` is set
+        host: Host to listen on
+        port: Port to listen on
+        cache_size: Maximum number of trained model objects kept loaded
+        models: Dictionary of model names to paths of trained model objects that requests can choose
+            between (optional). The `score_model: path_to_tmo` model is always served as "default"
+
+    Returns: `ScoringServer`
+
+    """
+    score_config = fillin_kwargs(score_model_kwargs, dict(config["score_model"]))
+
+    models = {} if models is None else dict(models)
+    models["default"] = score_config["path_to_tmo"]
+
+    cache = ModelCache(max_size=cache_size, features=compile_feature_pipeline(config, "score_model"))
+
+    # Load models up front so that the first requests do not pay for loading them
+    for name in models:
+        cache.get(models[name])
+
+    server = ScoringServer((host, port), models, "default", cache, predict=score_config["predict"],
+                           method=score_config.get("method", "predict"))
+
+    logger.info("Serving %s on http://%s:%i", ", ".join(models), host, server.server_address[1])
+
+    return server
+
+
+def run_server(args):
+    with open(args.config, "r") as f:
+        config = yaml.load(f)
+
+    server_config = config.get("score_server", {})
+    if args.host is not None:
+        server_config["host"] = args.host
+    if args.port is not None:
+        server_config["port"] = args.port
+
+    server = make_server(config, **server_config)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down scoring server")
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve model scores over HTTP")
+    parser.add_argument('--config', help='path to yaml file with configurations')
+    parser.add_argument('--host', default=None, help='Host to listen on (optional)')
+    parser.add_argument('--port', default=None, type=int, help='Port to listen on (optional)')
+
+    args = parser.parse_args()
+
+    run_server(args)
@@ -0,0 +1,369 @@
+import logging
+import argparse
+import yaml
+import os
+import json
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.stats
+import sklearn.metrics
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+
+from src.helpers import Timer, fillin_kwargs, resolve_n_jobs, save_frame
+from src.train_model import methods, get_method, train_model_kwargs, prepare_training_data, load_training_data, \
+    save_model
+from src.model_artifact import config_hash
+
+logger = logging.getLogger(__name__)
+
+search_strategies = ["grid", "random", "halving"]
+
+# Functions of (y_true, y_predicted) and whether they score probabilities rather than predictions. Scores are
+# oriented so that higher is better, losses and errors are negated
+metrics = dict(auc=(sklearn.metrics.roc_auc_score, True),
+               logloss=(lambda y, p: -sklearn.metrics.log_loss(y, p), True),
+               accuracy=(sklearn.metrics.accuracy_score, False),
+               r2=(sklearn.metrics.r2_score, False),
+               neg_mean_squared_error=(lambda y, p: -sklearn.metrics.mean_squared_error(y, p), False))
+
+# Splits of the search shared by the trials of a worker process, memory-mapped once per process by `_init_worker()`
+_worker_splits = None
+
+
+class LogUniform:
+    """Distribution whose logarithm is uniform between log(`low`) and log(`high`), for sampling learning rates and
+    regularization strengths."""
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def rvs(self, random_state=None):
+        random_state = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) \
+            else random_state
+        return float(np.exp(random_state.uniform(np.log(self.low), np.log(self.high))))
+
+
+def parse_search_space(space):
+    """Parses the search space of the `search_model` configuration.
+
+    Each parameter is given as a list of values to choose from, or as a dictionary describing a distribution to
+    sample from: `distribution` (`uniform`, `loguniform` or `randint`) and its `low` and `high` bounds. Grids can
+    only be searched over lists.
+
+    Returns: Dictionary of parameter names to lists of values or distributions with `rvs()`
+
+    """
+    parsed = {}
+    for param, values in space.items():
+        if type(values) == dict:
+            distribution, low, high = values["distribution"], values["low"], values["high"]
+            if distribution == "uniform":
+                parsed[param] = scipy.stats.uniform(loc=low, scale=high - low)
+            elif distribution == "loguniform":
+                parsed[param] = LogUniform(low, high)
+            elif distribution == "randint":
+                parsed[param] = scipy.stats.randint(low, high + 1)
+            else:
+                raise ValueError("%s is not a supported distribution, options are uniform, loguniform and randint"
+                                 % distribution)
+        else:
+            parsed[param] = [values] if type(values) != list else values
+
+    return parsed
+
+
+def candidate_params(strategy, space, n_trials=10, random_state=24):
+    """Lists the parameters of each trial, every combination of `space` for a grid search or `n_trials` samples
+    from it otherwise."""
+    space = parse_search_space(space)
+
+    if strategy == "grid" or (strategy == "halving" and n_trials is None):
+        if not all(type(v) == list for v in space.values()):
+            raise ValueError("A grid can only be searched over lists of values")
+        candidates = list(ParameterGrid(space))
+    else:
+        candidates = list(ParameterSampler(space, n_iter=n_trials, random_state=random_state))
+
+    # Numpy scalars sampled from distributions are converted so that parameters can be saved as JSON
+    return [{k: v.item() if isinstance(v, np.generic) else v for k, v in c.items()} for c in candidates]
+
+
+def share_splits(X, y, path):
+    """Saves the model inputs and targets of each split as .npy files in `path`, to be memory-mapped by every trial
+    rather than copied into each worker process. CSR matrices are saved as their data, indices and index pointers."""
+    for split in X:
+        arrays = dict(y=np.asarray(y[split]))
+        if scipy.sparse.issparse(X[split]):
+            X_split = X[split].tocsr()
+            arrays.update(data=X_split.data, indices=X_split.indices, indptr=X_split.indptr,
+                          shape=np.array(X_split.shape))
+        else:
+            arrays["X"] = np.ascontiguousarray(X[split].values if isinstance(X[split], pd.DataFrame) else X[split])
+
+        for name, array in arrays.items():
+            np.save(os.path.join(path, "%s-%s.npy" % (split, name)), array)
+
+    with open(os.path.join(path, "splits.json"), "w") as f:
+        json.dump(list(X), f)
+
+
+def load_shared_splits(path):
+    """Memory-maps the splits saved by `share_splits()`.
+
+    Returns:
+        X (dict): Read-only model inputs of each split, as arrays or CSR matrices
+        y (dict): Read-only targets of each split
+
+    """
+    with open(os.path.join(path, "splits.json"), "r") as f:
+        splits = json.load(f)
+
+    def load(split, name):
+        return np.load(os.path.join(path, "%s-%s.npy" % (split, name)), mmap_mode="r")
+
+    X, y = {}, {}
+    for split in splits:
+        y[split] = load(split, "y")
+        if os.path.exists(os.path.join(path, "%s-X.npy" % split)):
+            X[split] = load(split, "X")
+        else:
+            X[split] = scipy.sparse.csr_matrix((load(split, "data"), load(split, "indices"), load(split, "indptr")),
+                                               shape=tuple(load(split, "shape")), copy=False)
+
+    return X, y
+
+
+def _init_worker(path):
+    global _worker_splits
+    _worker_splits = load_shared_splits(path)
+
+
+def score_trial(model, X, y, metric):
+    """Scores a fitted model on `X` and `y` by `metric`, a key of `metrics`."""
+    func, proba = metrics[metric]
+    if proba:
+        y_predicted = model.predict_proba(X)
+        y_predicted = y_predicted[:, 1] if y_predicted.shape[1] == 2 else y_predicted
+    else:
+        y_predicted = model.predict(X)
+    return func(y, y_predicted)
+
+
+def run_trial(trial):
+    """Fits and scores the model of one trial on the splits memory-mapped by the worker process.
+
+    Args:
+        trial: Dictionary of the trial number `trial`, `method`, `params`, `fit` keyword arguments, `metric`, the
+            split to score on, `eval_split`, and optionally the number of training rows to use, `n_samples`, drawn at
+            random with the seed `random_state`
+
+    Returns: Dictionary describing the trial, with its `score` and the `seconds` and `cpu_seconds` it took
+
+    """
+    X, y = _worker_splits
+    X_train, y_train, n_samples = X["train"], y["train"], trial.get("n_samples")
+    if n_samples is not None:
+        # Every trial draws from the same permutation, so the rows of a smaller sample are in every larger one
+        rows = np.sort(np.random.RandomState(trial.get("random_state")).permutation(X_train.shape[0])[:n_samples])
+        X_train, y_train = X_train[rows], y_train[rows]
+
+    fit_kwargs = dict(trial["fit"])
+    if trial["method"] == "xgboost" and trial["eval_split"] != "train":
+        fit_kwargs["eval_set"] = [(X[trial["eval_split"]], y[trial["eval_split"]])]
+
+    with Timer("trial %i" % trial["trial"], logger, rows=X_train.shape[0], level=logging.DEBUG) as t:
+        model = get_method(trial["method"])(**trial["params"])
+        model.fit(X_train, y_train, **fit_kwargs)
+
+    score = score_trial(model, X[trial["eval_split"]], y[trial["eval_split"]], trial["metric"])
+
+    return dict(trial=trial["trial"], round=trial.get("round", 0), n_samples=n_samples, score=score,
+                seconds=t.seconds, cpu_seconds=t.cpu_seconds, params=trial["params"])
+
+
+def _halving_rounds(candidates, min_resource, max_resource, factor):
+    """Yields (round, resource, number of candidates kept) for each round of successive halving."""
+    n_candidates, r, i = len(candidates), min_resource, 0
+    while True:
+        yield i, min(r, max_resource), n_candidates
+        if n_candidates <= 1 or r >= max_resource:
+            break
+        n_candidates, r, i = max(int(np.ceil(n_candidates / factor)), 1), r * factor, i + 1
+
+
+def search_model(df, method=None, strategy="grid", space=None, n_trials=10, metric="auc", n_jobs=1,
+                 halving=None, random_state=24, save_leaderboard=None, save_tmo=None, features=None, cache=None,
+                 data_key=None, work_dir=None, **kwargs):
+    """Searches for the parameters of a model that score best on the validation split.
+
+    The features are generated and the data split once. The model inputs and targets of each split are saved to
+    .npy files memory-mapped by a pool of worker processes, so every trial reads the same pages rather than each
+    worker holding its own copy, and trials run in parallel across the pool.
+
+    Args:
+        df: Pandas dataframe to train on
+        method: Key of `methods` giving the model to train
+        strategy: How to search, "grid" for every combination of `space`, "random" for `n_trials` samples from it,
+            or "halving" for successive halving of `n_trials` samples (every combination if `n_trials` is None)
+        space: Dictionary of parameters to lists of values or distributions, see `parse_search_space()`
+        n_trials: Number of parameter samples for random and halving searches
+        metric: Key of `metrics` to score trials by on the validate split, or the test split if there is none
+        n_jobs: Number of trials run at once, -1 to use all cores
+        halving: Dictionary of `resource` (a parameter, e.g. "n_estimators", or "n_samples" for training rows),
+            `min_resource`, `max_resource` and `factor`, the fraction of candidates kept after each round.
+            `max_resource` defaults to the number of training rows, or to the parameter's value in `params` or the
+            model's default
+        random_state: Seed of parameter sampling and of the training rows sampled by halving
+        save_leaderboard: Path to save the trials, best first, to (optional)
+        save_tmo: Path to save the best model, refit on the training split, to (optional)
+        features: `FeaturePipeline` fit on and applied to `df` before training (optional)
+        cache: `StageCache` to reuse the generated features and splits of earlier runs from (optional)
+        data_key: Cache key or fingerprint of `df`, computed from the contents of `df` if not given
+        work_dir: Directory to save the shared splits in, a temporary directory removed afterwards if not given
+        **kwargs: Other sections of the `train_model` configuration (e.g. `choose_features`, `split_data`, `params`)
+
+    Returns:
+        model: Best model, refit on the training split with its parameters
+        leaderboard (`pd.DataFrame`): Score, time taken and parameters of each trial, best first
+
+    """
+
+    assert method in methods.keys()
+    if strategy not in search_strategies:
+        raise ValueError("strategy must be one of %s" % ", ".join(search_strategies))
+    if metric not in metrics:
+        raise ValueError("metric must be one of %s" % ", ".join(metrics))
+
+    features, X, y = prepare_training_data(df, features=features, cache=cache, data_key=data_key, **kwargs)
+    eval_split = "validate" if "validate" in X else "test" if "test" in X else "train"
+    if eval_split == "train":
+        logger.warning("There is no validate or test split, so trials are scored on the data they were trained on")
+
+    # Hashed like the configuration of `train_model()`, with the parameters of the best trial once it is known
+    train_config = dict(kwargs, method=method)
+    kwargs = fillin_kwargs(train_model_kwargs, kwargs)
+    candidates = candidate_params(strategy, space or {}, n_trials=n_trials, random_state=random_state)
+    n_jobs = resolve_n_jobs(n_jobs)
+
+    base_params = dict(kwargs["params"])
+    # Each trial is fit on one core when trials run in parallel, rather than every trial competing for every core
+    if n_jobs > 1 and "n_jobs" in get_method(method)().get_params() and "n_jobs" not in base_params:
+        base_params["n_jobs"] = 1
+
+    def trial(i, params, **trial_kwargs):
+        return dict(trial=i, method=method, params=dict(base_params, **params), fit=kwargs["fit"], metric=metric,
+                    eval_split=eval_split, **trial_kwargs)
+
+    shared_dir = tempfile.mkdtemp(prefix="search-") if work_dir is None else work_dir
+    os.makedirs(shared_dir, exist_ok=True)
+    share_splits(X, y, shared_dir)
+
+    results, resource, max_resource = [], None, None
+    try:
+        with Timer("model search", logger), \
+                multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(shared_dir,)) as pool:
+            if strategy != "halving":
+                results = pool.map(run_trial, [trial(i, params) for i, params in enumerate(candidates)])
+            else:
+                halving = dict(dict(resource="n_samples", factor=3), **(halving or {}))
+                resource, factor = halving["resource"], halving["factor"]
+                max_resource = halving.get("max_resource")
+                if max_resource is None and resource == "n_samples":
+                    max_resource = X["train"].shape[0]
+                elif max_resource is None:
+                    max_resource = base_params.get(resource, get_method(method)().get_params().get(resource))
+                if max_resource is None:
+                    raise ValueError("halving: max_resource must be given, as %s is not set in params and %s has no "
+                                     "default for it" % (resource, method))
+                min_resource = halving.get("min_resource", max(int(max_resource / factor ** 3), 1))
+
+                survivors = list(enumerate(candidates))
+                for i, r, n_keep in _halving_rounds(candidates, min_resource, max_resource, factor):
+                    survivors = survivors[:n_keep]
+                    if resource == "n_samples":
+                        trials = [trial(j, params, round=i, n_samples=int(r), random_state=random_state)
+                                  for j, params in survivors]
+                    else:
+                        trials = [trial(j, dict(params, **{resource: r}), round=i) for j, params in survivors]
+
+                    round_results = pool.map(run_trial, trials)
+                    results += round_results
+                    logger.info("Halving round %i: %i candidates with %s=%s, best %s %0.4f",
+                                i, len(trials), resource, r, metric, max(res["score"] for res in round_results))
+
+                    # Candidates are kept in order of their score in this round
+                    order = np.argsort([-res["score"] for res in round_results], kind="mergesort")
+                    survivors = [survivors[k] for k in order]
+    finally:
+        if work_dir is None:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+    # Trials of later halving rounds rank above those of earlier rounds, having been trained on more resources
+    results = sorted(results, key=lambda res: (-res["round"], -res["score"]))
+    leaderboard = pd.DataFrame([dict({k: v for k, v in res.items() if k != "params"},
+                                     **{"param_%s" % p: v for p, v in res["params"].items()}) for res in results])
+
+    best = results[0]
+    logger.info("Best of %i trials scored %s %0.4f with %s", len(results), metric, best["score"], best["params"])
+
+    if save_leaderboard is not None:
+        save_frame(leaderboard, save_leaderboard, index=False)
+        logger.info("Leaderboard of %i trials saved to %s", len(leaderboard), save_leaderboard)
+
+    # The best model is refit on all of the training split, and with all of a parameter resource, as halving may
+    # have stopped with one candidate left before reaching `max_resource`
+    fit_kwargs = dict(kwargs["fit"])
+    if method == "xgboost" and eval_split != "train":
+        fit_kwargs["eval_set"] = [(X[eval_split], y[eval_split])]
+    best_params = {k: v for k, v in best["params"].items() if k != "n_jobs" or "n_jobs" in kwargs["params"]}
+    if resource is not None and resource != "n_samples":
+        best_params[resource] = max_resource
+    model = get_method(method)(**best_params)
+    with Timer("model training", logger, rows=X["train"].shape[0]):
+        model.fit(X["train"], y["train"], **fit_kwargs)
+
+    if save_tmo is not None:
+        save_model(model, save_tmo, features=features, X=X.get("train"),
+                   train_config_hash=config_hash(dict(train_config, params=best_params)))
+
+    return model, leaderboard
+
+
+def run_search(args):
+    with open(args.config, "r") as f:
+        config = yaml.load(f)
+
+    if "search_model" not in config:
+        raise ValueError("'search_model' configuration must exist in config file")
+
+    df, features, cache, data_key = load_training_data(args, config)
+
+    # The search shares the method, features, splits and fixed parameters of training, and saves its best model
+    # in place of the trained one unless told otherwise
+    train_config = {k: v for k, v in config["train_model"].items() if k != "featurize"}
+    search_config = dict(config["search_model"])
+    if getattr(args, "n_jobs", None) is not None:
+        search_config["n_jobs"] = args.n_jobs
+    if getattr(args, "save", None) is not None:
+        search_config["save_tmo"] = args.save
+
+    search_model(df, features=features, cache=cache, data_key=data_key, **dict(train_config, **search_config))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Search for the best parameters of a model")
+    parser.add_argument('--config', help='path to yaml file with configurations')
+    parser.add_argument('--csv', default=None, help="Path to CSV for input to model training")
+    parser.add_argument('--save', default=None, help='Path to save the best model to (optional)')
+    parser.add_argument('--n_jobs', default=None, type=int,
+                        help='Number of trials run at once, -1 for all cores (optional)')
+
+    args = parser.parse_args()
+
+    run_search(args)
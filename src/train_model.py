@@ -2,136 +2,589 @@ import logging
 import argparse
 import yaml
 import os
-import subprocess
-import re
-import datetime
+import json
+import hashlib
+import importlib
 
 import pickle
 
-import sklearn
-import xgboost
 import pandas as pd
 import numpy as np
 
-from src.load_data import load_data
-from src.helpers import Timer, fillin_kwargs
-from src.generate_features import choose_features, get_target
-from sklearn.linear_model import LogisticRegression, LinearRegression
+from src.load_data import load_data, fingerprint_data, list_partitions
+from src.helpers import Timer, fillin_kwargs, StageCache, fingerprint_file, fingerprint_frame, save_frame, FrameWriter
+from src.generate_features import choose_features, get_target, compile_feature_pipeline, feature_pipeline_path, \
+    load_feature_pipeline, has_sparse_columns, to_sparse_matrix
+from src.model_artifact import is_artifact, save_artifact, load_model, config_hash
 
 logger = logging.getLogger(__name__)
 
-methods = dict(logistic=LogisticRegression,
-               linear_regression=LinearRegression,
-               xgboost=xgboost.XGBClassifier)
+# Model classes of each method, imported by `get_method()` only when a model of the method is trained
+methods = dict(logistic="sklearn.linear_model.LogisticRegression",
+               linear_regression="sklearn.linear_model.LinearRegression",
+               sgd_classifier="sklearn.linear_model.SGDClassifier",
+               sgd_regressor="sklearn.linear_model.SGDRegressor",
+               xgboost="xgboost.XGBClassifier")
 
-train_model_kwargs = ["split_data", "params", "fit", "compile"]
+train_model_kwargs = ["split_data", "params", "fit", "compile", "native"]
 
 
-def split_data(X, y, train_size=1, test_size=0, validate_size=0, random_state=24, save_split_prefix=None):
+split_names = ["train", "test", "validate"]
+
+
+def get_method(method):
+    """Imports the model class of a key of `methods`."""
+    module, name = methods[method].rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def hash_splits(keys, train_size=1, test_size=0, validate_size=0, random_state=24):
+    """Assigns rows to splits by hashing their keys with `random_state`.
+
+    The split of a row depends only on its key and the seed, never on the other rows, so rows are assigned the same
+    splits whether the data is split in memory or chunk by chunk, and rows with the same key (e.g. a customer id)
+    always land in the same split.
+
+    Args:
+        keys: Dataframe or series of the key column(s) of each row
+        train_size: Proportion of rows in the training split
+        test_size: Proportion of rows in the test split
+        validate_size: Proportion of rows in the validation split
+        random_state: Seed hashed with the keys, changing it reassigns the splits
+
+    Returns: Numpy array of the index in `split_names` of the split of each row
+
+    """
+    sizes = np.array([train_size, test_size, validate_size], dtype=float)
+    if not np.isclose(sizes.sum(), 1):
+        raise ValueError("train_size + test_size + validate_size must equal 1 when splitting by hashing")
+
+    # pandas needs a hash key of exactly 16 bytes, whatever the sign or number of digits of the seed, but only uses it
+    # to hash strings, so the seed is also mixed into the hash of every row
+    hash_key = hashlib.md5(str(random_state).encode("utf-8")).hexdigest()[:16]
+    hashes = pd.util.hash_pandas_object(keys, index=False, hash_key=hash_key).values
+    hashes = pd.util.hash_array(hashes ^ np.uint64(int(hash_key, 16)))
+
+    # Hashes are uniform over 64 bits, so the top 53 bits as a fraction of the range are uniform over [0, 1)
+    u = (hashes >> np.uint64(11)).astype(np.float64) / 2 ** 53
+    return np.searchsorted(np.cumsum(sizes)[:-1], u, side="right")
+
+
+def split_data(X, y, train_size=1, test_size=0, validate_size=0, random_state=24, save_split_prefix=None,
+               save_split_format="csv", hash_on=None):
+    """Splits features and targets into train, test and validate splits.
+
+    Rows are shuffled into splits with `train_test_split()` unless `hash_on` is given, in which case they are
+    assigned by `hash_splits()` so the splits match those of `split_chunks()` on the same data.
+
+    Args:
+        X: Dataframe of features
+        y: Array of targets, None if there is no target
+        train_size: Proportion or number of rows in the training split
+        test_size: Proportion or number of rows in the test split
+        validate_size: Proportion or number of rows in the validation split
+        random_state: Seed of the shuffle or hash
+        save_split_prefix: Prefix of the paths to save each split to (optional)
+        save_split_format: Format to save the splits in
+        hash_on: Column or list of columns of `X` to hash, or series of keys of each row, to split by (optional)
+
+    Returns:
+        X (dict): Features of each non-empty split
+        y (dict): Targets of each non-empty split, `dict(train=None)` if there is no target
+
+    """
 
     if y is not None:
         assert len(X) == len(y)
-        include_y = True
-    else:
-        y = [0] * len(X)
-        include_y = False
-    if train_size + test_size + validate_size == 1:
-        prop = True
-    elif train_size + test_size + validate_size == len(X):
-        prop = False
+
+    if hash_on is not None:
+        keys = X[hash_on] if isinstance(hash_on, (str, list)) else hash_on
+        assigned = hash_splits(keys, train_size, test_size, validate_size, random_state)
+        splits = {name: np.flatnonzero(assigned == i) for i, name in enumerate(split_names)}
+        X_splits = {name: X.iloc[rows] for name, rows in splits.items()}
+        y_splits = {name: y[rows] for name, rows in splits.items()} if y is not None else None
     else:
-        raise ValueError("train_size + test_size + validate_size "
-                         "must equal 1 or equal the number of rows in the dataset")
+        X_splits, y_splits = _shuffle_splits(X, y, train_size, test_size, validate_size, random_state)
+
+    X = dict(train=X_splits["train"])
+    y = dict(train=y_splits["train"] if y is not None else None)
+    for split in ["test", "validate"]:
+        if len(X_splits[split]) > 0:
+            X[split] = X_splits[split]
+            if y["train"] is not None:
+                y[split] = y_splits[split]
+
+    if save_split_prefix is not None:
+        save_splits(X, y, save_split_prefix, save_split_format)
+
+    return X, y
 
-    if prop:
+
+def _shuffle_splits(X, y, train_size, test_size, validate_size, random_state):
+    if train_size + test_size + validate_size == 1:
         train_size = int(np.round(train_size * len(X)))
         validate_size = int(np.round(validate_size * len(X)))
         test_size = int(len(X) - train_size - validate_size)
+    elif train_size + test_size + validate_size != len(X):
+        raise ValueError("train_size + test_size + validate_size "
+                         "must equal 1 or equal the number of rows in the dataset")
 
-    if train_size == 1:
-        X_train, y_train = X, y
+    from sklearn.model_selection import train_test_split
+
+    # y is only split along with X if there is one, rather than splitting a placeholder of the same length
+    arrays = [X] if y is None else [X, y]
+    empty = [array[:0] for array in arrays]
+
+    if train_size == len(X):
+        train, remain = arrays, empty
     else:
-        X_train, X_remain, y_train, y_remain = sklearn.model_selection.train_test_split(X, y, train_size=train_size,
-                                                                                        random_state=random_state)
-
-        X_validate, X_test, y_validate, y_test = sklearn.model_selection.train_test_split(X_remain, y_remain,
-                                                                                          test_size=test_size,
-                                                                                          random_state=random_state+1)
-    print(type(X_train))
-    X = dict(train=X_train)
-    y = dict(train=y_train)
-
-    if len(X_test) > 0:
-        X["test"] = X_test
-        y["test"] = y_test
-    if len(X_validate) > 0:
-        X["validate"] = X_validate
-        y["validate"] = y_validate
+        parts = train_test_split(*arrays, train_size=train_size, random_state=random_state)
+        train, remain = parts[0::2], parts[1::2]
 
-    if save_split_prefix is not None:
-        for split in X:
-            pd.DataFrame(X[split]).to_csv("%s-%s-features.csv" % (save_split_prefix, split))
-            if include_y:
-                pd.DataFrame(y[split]).to_csv("%s-%s-targets.csv" % (save_split_prefix, split))
+    if test_size == 0:
+        validate, test = remain, empty
+    elif validate_size == 0:
+        validate, test = empty, remain
+    else:
+        parts = train_test_split(*remain, test_size=test_size, random_state=random_state + 1)
+        validate, test = parts[0::2], parts[1::2]
+
+    X_splits = dict(train=train[0], test=test[0], validate=validate[0])
+    y_splits = dict(train=train[1], test=test[1], validate=validate[1]) if y is not None else None
+
+    return X_splits, y_splits
+
+
+def split_chunks(chunks, save_split_prefix, save_split_format="csv", features=None, choose_features_kwargs=None,
+                 get_target_kwargs=None, hash_on=None, train_size=1, test_size=0, validate_size=0,
+                 random_state=24, **kwargs):
+    """Splits data read in chunks (e.g. a streamed query or partitions) and appends each split of each chunk to its
+    own file, so that data larger than memory can be split without ever building the whole dataframe.
 
-            logger.info("X_%s and y_%s saved to %s-%s-features.csv and %s-%s-targets.csv",
-                        split, split,
-                        save_split_prefix, split,
-                        save_split_prefix, split)
+    Rows are assigned splits by `hash_splits()` on the `hash_on` columns, or on the contents of the whole row if
+    `hash_on` is not given, so the proportions must be given as fractions. Splitting the same data in memory with the
+    same `hash_on` gives the same splits.
 
-    if not include_y:
-        y = dict(train=None)
+    Args:
+        chunks: Iterator of dataframes, e.g. from `load_data(..., chunksize=n)`
+        save_split_prefix: Prefix of the paths the features and targets of each split are appended to, as in
+            `save_splits()`
+        save_split_format: Format of the files, "csv" or "parquet"
+        features: `FeaturePipeline` applied to each chunk before choosing features, fit on the first chunk unless
+            already fitted (optional)
+        choose_features_kwargs: `choose_features` configuration (optional)
+        get_target_kwargs: `get_target` configuration (optional)
+        hash_on: Column or list of columns to hash, looked up after features are generated but before they are
+            chosen (optional)
+        train_size: Proportion of rows in the training split
+        test_size: Proportion of rows in the test split
+        validate_size: Proportion of rows in the validation split
+        random_state: Seed hashed with the keys
 
-    return X, y
+    Returns: Dictionary of the number of rows written to each split
+
+    """
+    writers = {}
+    n_rows = {name: 0 for name in split_names}
+
+    def write(name, kind, data):
+        path = "%s-%s-%s.%s" % (save_split_prefix, name, kind, save_split_format)
+        if path not in writers:
+            writers[path] = FrameWriter(path, fmt=save_split_format, index=False)
+        writers[path].write(pd.DataFrame(data))
+
+    try:
+        with Timer("split_chunks", logger) as t:
+            for df in chunks:
+                if features is not None:
+                    df = features.transform(df) if features.fitted else features.fit_transform(df)
+
+                keys = df[hash_on] if hash_on is not None else df
+                assigned = hash_splits(keys, train_size, test_size, validate_size, random_state)
+                X = choose_features(df, **choose_features_kwargs) if choose_features_kwargs is not None else df
+                y = get_target(df, **get_target_kwargs) if get_target_kwargs is not None else None
+
+                for i, name in enumerate(split_names):
+                    rows = np.flatnonzero(assigned == i)
+                    if len(rows) == 0:
+                        continue
+                    write(name, "features", X.iloc[rows])
+                    if y is not None:
+                        write(name, "targets", y[rows])
+                    n_rows[name] += len(rows)
+
+                t.rows = sum(n_rows.values())
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    logger.info("%s rows split into %s with prefix %s",
+                sum(n_rows.values()), ", ".join("%i %s" % (n, name) for name, n in n_rows.items()), save_split_prefix)
+
+    return n_rows
+
+
+def save_splits(X, y, save_split_prefix, save_split_format="csv"):
+    for split in X:
+        save_frame(pd.DataFrame(X[split]), "%s-%s-features.%s" % (save_split_prefix, split, save_split_format))
+        if y["train"] is not None:
+            save_frame(pd.DataFrame(y[split]), "%s-%s-targets.%s" % (save_split_prefix, split, save_split_format))
+
+        logger.info("X_%s and y_%s saved to %s-%s-features.%s and %s-%s-targets.%s",
+                    split, split,
+                    save_split_prefix, split, save_split_format,
+                    save_split_prefix, split, save_split_format)
+
+
+def prepare_splits(df, choose_features_kwargs=None, get_target_kwargs=None, split_data_kwargs=None):
+    """Chooses the features and target from `df` and splits them, without saving the splits."""
+
+    X = choose_features(df, **choose_features_kwargs) if choose_features_kwargs is not None else df
+    y = get_target(df, **get_target_kwargs) if get_target_kwargs is not None else None
+
+    split_data_kwargs = {} if split_data_kwargs is None else split_data_kwargs
+    split_data_kwargs = {k: v for k, v in split_data_kwargs.items()
+                         if k not in ["save_split_prefix", "save_split_format"]}
+
+    # The keys hashed need not be features, so are looked up before the features are chosen
+    if isinstance(split_data_kwargs.get("hash_on"), (str, list)):
+        split_data_kwargs["hash_on"] = df[split_data_kwargs["hash_on"]]
+
+    with Timer("split_data", logger, rows=len(X)):
+        return split_data(X, y, **split_data_kwargs)
+
+
+def fit_features(features, df):
+    df = features.fit_transform(df)
+    return features, df
+
+
+def prepare_training_data(df, features=None, cache=None, data_key=None, **kwargs):
+    """Generates features from `df` and splits them into the model inputs and targets of each split.
+
+    Args:
+        df: Pandas dataframe to train on
+        features: `FeaturePipeline` fit on and applied to `df` before splitting (optional)
+        cache: `StageCache` to reuse the generated features and splits of earlier runs from (optional)
+        data_key: Cache key or fingerprint of `df`, computed from the contents of `df` if not given
+        **kwargs: Sections of the `train_model` configuration (e.g. `choose_features`, `get_target`, `split_data`)
+
+    Returns:
+        features (`FeaturePipeline`): `features` fit on `df`, with the `model_columns` of the training split, None if
+            not given
+        X (dict): Features of each split, as dataframes or CSR matrices if any feature is sparse
+        y (dict): Targets of each split
+
+    """
+
+    if cache is not None and data_key is None:
+        data_key = fingerprint_frame(df)
+
+    if features is not None and features.fitted:
+        # A pipeline fitted on earlier data, e.g. when warm starting, is applied as is so the features line up
+        df = features.transform(df)
+    elif features is not None and cache is not None:
+        data_key = cache.key("generate_features", features.config, data_key)
+        features, df = cache.run("generate_features", data_key, fit_features, features, df)
+    elif features is not None:
+        df = features.fit_transform(df)
+
+    split_kwargs = dict(choose_features_kwargs=kwargs.get("choose_features"),
+                        get_target_kwargs=kwargs.get("get_target"),
+                        split_data_kwargs=kwargs.get("split_data"))
+
+    if cache is not None:
+        split_key = cache.key("split_data", split_kwargs, data_key)
+        X, y = cache.run("split_data", split_key, prepare_splits, df, **split_kwargs)
+    else:
+        X, y = prepare_splits(df, **split_kwargs)
+
+    # Scoring with the pipeline gives the model exactly these columns, leaving out e.g. the target and ids
+    if features is not None and isinstance(X["train"], pd.DataFrame):
+        features.model_columns = list(X["train"].columns)
+
+    split_data_kwargs = kwargs.get("split_data") or {}
+    if "save_split_prefix" in split_data_kwargs:
+        save_splits(X, y, split_data_kwargs["save_split_prefix"], split_data_kwargs.get("save_split_format", "csv"))
+
+    # Sparse one-hot encoded features are given to the model as CSR matrices so they are never densified
+    if has_sparse_columns(X["train"]):
+        X = {split: to_sparse_matrix(X[split]) for split in X}
+
+    return features, X, y
+
+
+def load_previous_model(path_to_tmo, features=None):
+    """Loads a trained model object to continue training from, with the feature pipeline it was trained with.
+
+    Returns:
+        model: Trained model object, None if there is none at `path_to_tmo`
+        features (`FeaturePipeline`): Fitted pipeline saved next to the model if there is one, else `features`
+
+    """
+    if path_to_tmo is None or not os.path.exists(path_to_tmo):
+        logger.warning("No model at %s to continue training from, training from scratch", path_to_tmo)
+        return None, features
+
+    # Loaded in full and without memory-mapping, as the model is updated in place
+    model = load_model(path_to_tmo, lazy=False, mmap=False)
+    logger.info("Continuing training of the model at %s", path_to_tmo)
+
+    if features is not None and os.path.exists(feature_pipeline_path(path_to_tmo)):
+        features = load_feature_pipeline(feature_pipeline_path(path_to_tmo))
+
+    return model, features
+
+
+def _booster(model):
+    from src.xgboost_native import BoosterModel
 
+    return model.booster if isinstance(model, BoosterModel) else model.get_booster()
 
-def train_model(df, method=None, save_tmo=None, **kwargs):
+
+def train_model(df, method=None, save_tmo=None, features=None, cache=None, data_key=None, warm_start=None,
+                splits=None, **kwargs):
+    """Trains a model on `df` as configured by the `train_model` section of the model configuration.
+
+    Args:
+        df: Pandas dataframe to train on
+        method: Key of `methods` giving the model to train
+        save_tmo: Path to save the trained model object to (optional)
+        features: `FeaturePipeline` fit on and applied to `df` before training (optional)
+        cache: `StageCache` to reuse the generated features and splits of earlier runs from (optional)
+        data_key: Cache key or fingerprint of `df`, computed from the contents of `df` if not given
+        warm_start: Dictionary with the `path_to_tmo` of a model to continue training on `df`, `save_tmo` if not
+            given. XGBoost models are boosted for `n_estimators` more rounds and models with `partial_fit()`
+            (e.g. `sgd_classifier`) are updated in place. The feature pipeline saved with the model is reused
+            rather than fit again (optional)
+        splits: Tuple of the `features`, `X` and `y` already prepared from `df` by `prepare_training_data()`, to
+            train on instead of preparing them again (optional)
+        **kwargs: Other sections of the `train_model` configuration (e.g. `choose_features`, `split_data`, `params`)
+
+    Returns: Trained model object
+
+    """
 
     assert method in methods.keys()
 
-    if "choose_features" in kwargs:
-        X = choose_features(df, **kwargs["choose_features"])
-    else:
-        X = df
+    # Hashed before the configuration is filled in and added to below
+    train_config_hash = config_hash(dict(kwargs, method=method))
+
+    native = kwargs.get("native")
+    if native is not None and method != "xgboost":
+        raise ValueError("Only xgboost models can be trained natively")
+
+    previous = None
+    if warm_start is not None:
+        previous, features = load_previous_model(warm_start.get("path_to_tmo", save_tmo), features)
+        if previous is not None and method != "xgboost" and not hasattr(previous, "partial_fit"):
+            raise ValueError("%s models cannot be trained incrementally, use an xgboost or sgd method" % method)
 
-    if "get_target" in kwargs:
-        y = get_target(df, **kwargs["get_target"])
+    if splits is not None:
+        features, X, y = splits
+    # Data streamed from files on disk in external memory is never loaded into a dataframe
+    elif native is not None and native.get("train_path") is not None:
+        features, X, y = None, {}, {}
     else:
-        y = None
+        features, X, y = prepare_training_data(df, features=features, cache=cache, data_key=data_key, **kwargs)
 
     kwargs = fillin_kwargs(train_model_kwargs, kwargs)
 
-    X, y = split_data(X, y, **kwargs["split_data"])
+    if native is not None:
+        from src.xgboost_native import train_native
 
-    model = methods[method](**kwargs["params"])
+        model = train_native(X, y, params=kwargs["params"], fit=kwargs["fit"],
+                             xgb_model=_booster(previous) if previous is not None else None, **native)
+    elif previous is not None and method != "xgboost":
+        model = previous
+        with Timer("model training", logger, rows=X["train"].shape[0]):
+            model.partial_fit(X["train"], y["train"])
+    else:
+        model = get_method(method)(**kwargs["params"])
 
-    if "validate" in X and "validate" in y:
-        kwargs["fit"]["eval_set"] = [(X["validate"], y["validate"])]
+        if method == "xgboost" and "validate" in X and "validate" in y:
+            kwargs["fit"]["eval_set"] = [(X["validate"], y["validate"])]
+        if previous is not None:
+            kwargs["fit"]["xgb_model"] = _booster(previous)
 
-    with Timer("model training", logger) as t:
-        model.fit(X["train"], y["train"], **kwargs["fit"])
+        with Timer("model training", logger, rows=X["train"].shape[0]):
+            model.fit(X["train"], y["train"], **kwargs["fit"])
 
     if save_tmo is not None:
-        with open(save_tmo, "wb") as f:
-            pickle.dump(model, f)
-        logger.info("Trained model object saved to %s", save_tmo)
+        save_model(model, save_tmo, features=features, X=X.get("train"), train_config_hash=train_config_hash)
 
     return model
 
 
+def save_model(model, save_tmo, features=None, X=None, train_config_hash=None):
+    """Saves a trained model object to `save_tmo`, and the feature pipeline it was trained with next to it.
+
+    The model is pickled unless `save_tmo` has no extension, in which case it is saved as an artifact directory by
+    `save_artifact()`, with the features `X` it was trained on and the hash of its configuration.
+    """
+    with Timer("save_tmo", logger, level=logging.DEBUG):
+        if is_artifact(save_tmo):
+            save_artifact(model, save_tmo, X=X, train_config_hash=train_config_hash)
+        else:
+            with open(save_tmo, "wb") as f:
+                pickle.dump(model, f)
+    logger.info("Trained model object saved to %s", save_tmo)
+
+    if features is not None:
+        features.save(feature_pipeline_path(save_tmo))
+
+
+def get_load_config(args, config):
+    """Gets the configuration of `load_data()` from `args.csv` or the `load_data` configuration."""
+    if getattr(args, "csv", None) is not None:
+        return dict(how="csv", csv=dict(path=args.csv))
+    elif "load_data" in config:
+        return config["load_data"]
+    raise ValueError("Path to CSV for input data must be provided through --csv or "
+                     "'load_data' configuration must exist in config file")
+
+
+def data_manifest_path(path_to_tmo):
+    """Path of the manifest of data a model was trained on, saved next to the model."""
+    return "%s-manifest.json" % os.path.splitext(path_to_tmo)[0]
+
+
+def read_data_manifest(path_to_tmo):
+    """Reads the fingerprints of the data a model has been trained on, empty if it has no manifest."""
+    if path_to_tmo is None or not os.path.exists(data_manifest_path(path_to_tmo)):
+        return {}
+    with open(data_manifest_path(path_to_tmo), "r") as f:
+        return json.load(f)["consumed"]
+
+
+def write_data_manifest(path_to_tmo, consumed):
+    with open(data_manifest_path(path_to_tmo), "w") as f:
+        json.dump(dict(model=path_to_tmo, consumed=consumed), f, indent=2, sort_keys=True)
+    logger.info("Manifest of %i sources of data trained on saved to %s", len(consumed), data_manifest_path(path_to_tmo))
+
+
+def unconsumed_data(load_config, consumed):
+    """Narrows a `load_data()` configuration to the data not yet trained on.
+
+    Partitioned data (`how: partitions`) is tracked partition by partition, so only new or rewritten partitions are
+    loaded. Other sources are tracked as a whole by their fingerprint, or by their configuration for queries.
+
+    Args:
+        load_config: Configuration of `load_data()`
+        consumed: Dictionary of the fingerprints of the data already trained on, from `read_data_manifest()`
+
+    Returns:
+        load_config (dict): Configuration loading only the data not yet trained on, None if there is none
+        fingerprints (dict): Fingerprints of the data `load_config` loads, to add to the manifest once trained on
+
+    """
+    if load_config["how"].lower() == "partitions":
+        partitions = load_config["partitions"]
+        fingerprints = {path: fingerprint_file(path) for path in list_partitions(partitions["path"],
+                                                                                 partitions.get("format"))}
+        new = {path: fingerprint for path, fingerprint in fingerprints.items() if consumed.get(path) != fingerprint}
+
+        logger.info("%i of %i partitions have not been trained on", len(new), len(fingerprints))
+        if len(new) == 0:
+            return None, {}
+        return dict(load_config, partitions=dict(partitions, path=sorted(new))), new
+
+    key = json.dumps(load_config, sort_keys=True)
+    fingerprint = fingerprint_data(**load_config)
+    if key in consumed and consumed[key] == fingerprint:
+        return None, {}
+
+    return load_config, {key: fingerprint}
+
+
+def load_training_data(args, config, load_config=None):
+    """Loads the data to train on from `args.csv` or the `load_data` configuration, through the stage cache if the
+    configuration has a `cache` section and the data can be fingerprinted, see `fingerprint_data()`.
+
+    Returns:
+        df (`pd.DataFrame`): Data to train on
+        features (`FeaturePipeline`): Pipeline to generate features with, None if `train_model` does not featurize
+        cache (`StageCache`): Stage cache, None if not configured
+        data_key (str): Cache key of the data, None if there is no cache
+
+    """
+    load_config = get_load_config(args, config) if load_config is None else load_config
+
+    features = compile_feature_pipeline(config, "train_model")
+
+    cache, data_key = None, None
+    if "cache" in config:
+        if load_config.get("chunksize") is not None:
+            raise ValueError("Data loaded in chunks cannot be cached, remove chunksize from load_data or the cache "
+                             "configuration")
+        cache = StageCache(**config["cache"])
+
+    fingerprint = fingerprint_data(**load_config) if cache is not None else None
+    if fingerprint is not None:
+        data_key = cache.key("load_data", load_config, fingerprint)
+        df = cache.run("load_data", data_key, load_data, **load_config)
+    else:
+        # Query results are loaded afresh unless the configuration opts in to caching them, and later stages are
+        # cached by the contents of the data loaded
+        df = load_data(**load_config)
+
+    return df, features, cache, data_key
+
+
+def run_split(args):
+    """Splits the data configured by `load_data` (or `args.csv`) as configured by the `train_model` section, chunk
+    by chunk if `load_data` sets a `chunksize`, saving each split with the prefix `args.save` or `save_split_prefix`.
+    """
+    with open(args.config, "r") as f:
+        config = yaml.load(f)
+
+    train_config = config["train_model"]
+    split_config = dict(train_config.get("split_data", {}))
+
+    save_split_prefix = split_config.pop("save_split_prefix", None) if args.save is None else args.save
+    if save_split_prefix is None:
+        raise ValueError("A prefix to save the splits to must be given through --save or save_split_prefix")
+    save_split_format = split_config.pop("save_split_format", "csv")
+
+    load_config = dict(get_load_config(args, config))
+    if getattr(args, "chunksize", None) is not None:
+        load_config["chunksize"] = args.chunksize
+
+    data = load_data(**load_config)
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
+
+    split_chunks(chunks, save_split_prefix, save_split_format, features=compile_feature_pipeline(config, "train_model"),
+                 choose_features_kwargs=train_config.get("choose_features"),
+                 get_target_kwargs=train_config.get("get_target"), **split_config)
+
+
 def run_training(args):
     with open(args.config, "r") as f:
         config = yaml.load(f)
 
-    if args.csv is not None:
-        df = load_data(how="csv", csv=dict(path=args.csv))
-    elif "load_data" in config:
-        df = load_data(**config["load_data"])
+    train_config = {k: v for k, v in config["train_model"].items() if k != "featurize"}
+
+    warm_start = train_config.get("warm_start")
+    consumed, new = None, None
+
+    if train_config.get("native", {}).get("train_path") is not None:
+        df, features, cache, data_key = None, None, None, None
+    elif warm_start is not None:
+        # Only data the previous model has not been trained on is loaded
+        previous_tmo = warm_start.get("path_to_tmo", train_config.get("save_tmo"))
+        consumed = read_data_manifest(previous_tmo)
+        load_config, new = unconsumed_data(get_load_config(args, config), consumed)
+        if load_config is None:
+            logger.warning("No new data to train on since the model at %s was trained", previous_tmo)
+            return
+        df, features, cache, data_key = load_training_data(args, config, load_config=load_config)
     else:
-        raise ValueError("Path to CSV for input data must be provided through --csv or "
-                         "'load_data' configuration must exist in config file")
+        df, features, cache, data_key = load_training_data(args, config)
+
+    tmo = train_model(df, features=features, cache=cache, data_key=data_key, **train_config)
 
-    tmo = train_model(df, **config["train_model"])
+    if new is not None and train_config.get("save_tmo") is not None:
+        write_data_manifest(train_config["save_tmo"], dict(consumed, **new))
 
     if args.save is not None:
         with open(args.save, "wb") as f:
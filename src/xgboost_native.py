@@ -0,0 +1,244 @@
+import os
+import glob
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import xgboost
+from sklearn.datasets import dump_svmlight_file, load_svmlight_file
+
+from src.helpers import Timer
+from src.generate_features import to_model_input
+
+logger = logging.getLogger(__name__)
+
+# Keyword arguments of `XGBClassifier` and their names in the native parameters of `xgboost.train()`
+sklearn_param_names = dict(learning_rate="eta", random_state="seed", n_jobs="nthread", reg_alpha="alpha",
+                           reg_lambda="lambda", min_split_loss="gamma")
+
+
+def as_dmatrix_input(X):
+    """Converts a dataframe of features to an array or CSR matrix a DMatrix can be built from, with categorical
+    columns such as bins given as numbers."""
+    X = to_model_input(X) if isinstance(X, pd.DataFrame) else X
+    if not scipy.sparse.issparse(X) and X.dtype == object:
+        X = X.astype(float)
+    return X
+
+
+class BoosterModel:
+    """Booster trained by `xgboost.train()`, wrapped so that it predicts from arrays and CSR matrices as the
+    scikit-learn models do, and can be scored, served and evaluated the same way.
+
+    Args:
+        booster: Trained `xgboost.Booster`
+        objective: Objective the booster was trained with, which decides whether `predict()` returns classes
+
+    """
+
+    def __init__(self, booster, objective="binary:logistic"):
+        self.booster = booster
+        self.objective = objective
+
+    def _predict(self, X, **kwargs):
+        X = X if isinstance(X, xgboost.DMatrix) else xgboost.DMatrix(as_dmatrix_input(X))
+        return self.booster.predict(X, **kwargs)
+
+    def predict_proba(self, X, **kwargs):
+        probabilities = self._predict(X, **kwargs)
+        if probabilities.ndim == 1:
+            probabilities = np.column_stack([1 - probabilities, probabilities])
+        return probabilities
+
+    def predict(self, X, **kwargs):
+        if self.objective.startswith("binary:"):
+            return (self._predict(X, **kwargs) > 0.5).astype(int)
+        elif self.objective == "multi:softprob":
+            return np.argmax(self._predict(X, **kwargs), axis=1)
+        return self._predict(X, **kwargs)
+
+
+def native_params(params, fit=None):
+    """Converts the `params` and `fit` sections of the `train_model` configuration, written for `XGBClassifier`,
+    to the parameters, number of boosting rounds and keyword arguments of `xgboost.train()`."""
+    params, fit = dict(params), dict(fit or {})
+
+    num_boost_round = params.pop("n_estimators", 100)
+    params = {sklearn_param_names.get(k, k): v for k, v in params.items()}
+    params.setdefault("objective", "binary:logistic")
+
+    if "eval_metric" in fit:
+        params["eval_metric"] = fit.pop("eval_metric")
+
+    train_kwargs = dict(verbose_eval=fit.pop("verbose", False))
+    if "early_stopping_rounds" in fit:
+        train_kwargs["early_stopping_rounds"] = fit.pop("early_stopping_rounds")
+    if len(fit) > 0:
+        logger.warning("Fit arguments %s are not used when training natively", ", ".join(fit))
+
+    return params, num_boost_round, train_kwargs
+
+
+def fingerprint_arrays(X, y=None):
+    """Fingerprints the contents of a model input, dense or CSR, and its target."""
+    digest = hashlib.sha256()
+    if scipy.sparse.issparse(X):
+        X = X.tocsr()
+        arrays = [X.data, X.indices, X.indptr, np.array(X.shape)]
+    else:
+        arrays = [np.ascontiguousarray(as_dmatrix_input(X))]
+    for array in arrays + ([np.asarray(y)] if y is not None else []):
+        digest.update(str(array.dtype).encode("utf-8") + str(array.shape).encode("utf-8"))
+        digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+
+def cached_dmatrix(X, y=None, cache_dir=None, name="dmatrix"):
+    """Builds a DMatrix from a model input, or loads the one built from the same data by an earlier run.
+
+    DMatrix binaries are saved in `cache_dir` under a fingerprint of `X` and `y`, so repeated runs on the same
+    data skip converting it, which for large datasets takes longer than training a few rounds.
+
+    Args:
+        X: Dataframe, array or CSR matrix of features
+        y: Target (optional)
+        cache_dir: Directory to cache DMatrix binaries in, none are cached if None (optional)
+        name: Name of the split, used in the name of the cached binary
+
+    Returns: `xgboost.DMatrix`
+
+    """
+    if cache_dir is None:
+        return xgboost.DMatrix(as_dmatrix_input(X), label=y)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, "%s-%s.buffer" % (name, fingerprint_arrays(X, y)))
+
+    if os.path.exists(path):
+        logger.info("%s DMatrix loaded from %s", name, path)
+        return xgboost.DMatrix(path)
+
+    with Timer("%s DMatrix" % name, logger, rows=X.shape[0], level=logging.DEBUG):
+        dmatrix = xgboost.DMatrix(as_dmatrix_input(X), label=y)
+
+    # Saved to a temporary file first so that an interrupted save never leaves a partial binary in the cache
+    dmatrix.save_binary(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    logger.info("%s DMatrix cached at %s", name, path)
+
+    return dmatrix
+
+
+if hasattr(xgboost, "DataIter"):
+    class LibsvmShards(xgboost.DataIter):
+        """Iterates over LIBSVM shards one at a time, so that xgboost builds its external memory pages from them
+        without ever holding the whole dataset in memory."""
+
+        def __init__(self, paths, n_features, cache_prefix):
+            self.paths = paths
+            self.n_features = n_features
+            self.i = 0
+            super().__init__(cache_prefix=cache_prefix)
+
+        def next(self, input_data):
+            if self.i == len(self.paths):
+                return 0
+            X, y = load_svmlight_file(self.paths[self.i], n_features=self.n_features, zero_based=True)
+            input_data(data=X, label=y)
+            self.i += 1
+            return 1
+
+        def reset(self):
+            self.i = 0
+
+
+def external_memory_dmatrix(paths, cache_prefix, n_features=None):
+    """Opens LIBSVM files as an external memory DMatrix, whose pages are streamed from disk while training.
+
+    Args:
+        paths: LIBSVM file, glob pattern or list of files, one row per line with zero-based feature indices
+        cache_prefix: Path prefix of the page files xgboost writes
+        n_features: Number of features, needed when there is more than one file
+
+    Returns: `xgboost.DMatrix`
+
+    """
+    paths = sorted(glob.glob(paths)) if type(paths) != list else paths
+    if len(paths) == 0:
+        raise ValueError("No LIBSVM files found to train on")
+
+    if hasattr(xgboost, "DataIter"):
+        return xgboost.DMatrix(LibsvmShards(paths, n_features, cache_prefix))
+
+    # Older versions of xgboost stream a single text file given with a cache suffix
+    if len(paths) > 1:
+        raise ValueError("This version of xgboost can only train on one LIBSVM file in external memory")
+    return xgboost.DMatrix("%s#%s" % (paths[0], cache_prefix))
+
+
+def write_libsvm_shards(X, y, prefix, n_shards=1):
+    """Writes a model input and target to `n_shards` LIBSVM files for training in external memory. Zeros are not
+    written, so are treated as missing, as they are in CSR inputs.
+
+    Returns: List of paths written
+
+    """
+    X = as_dmatrix_input(X)
+    bounds = np.linspace(0, X.shape[0], n_shards + 1).astype(int)
+
+    paths = []
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        path = "%s-%i.libsvm" % (prefix, i)
+        dump_svmlight_file(X[start:end], np.asarray(y)[start:end], path, zero_based=True)
+        paths.append(path)
+
+    return paths
+
+
+def train_native(X, y, params=None, fit=None, cache_dir=None, external_memory=False, train_path=None,
+                 n_features=None, n_shards=1, xgb_model=None):
+    """Trains a booster with `xgboost.train()` on DMatrices built once and cached, rather than through
+    `XGBClassifier.fit()`, which converts its inputs to DMatrices again on every fit.
+
+    Args:
+        X: Dictionary of the features of each split, the validate split being used to evaluate each round
+        y: Dictionary of the targets of each split
+        params: `params` section of the `train_model` configuration, e.g. with `tree_method: hist`
+        fit: `fit` section of the `train_model` configuration, `eval_metric`, `verbose` and `early_stopping_rounds`
+            are used
+        cache_dir: Directory to cache DMatrix binaries and external memory pages in (optional)
+        external_memory: Whether to train from disk in external memory rather than from a DMatrix in memory
+        train_path: LIBSVM file, glob or list of files to train on in external memory, instead of writing the
+            training split to `cache_dir`
+        n_features: Number of features of the files in `train_path`, needed when there is more than one
+        n_shards: Number of LIBSVM files the training split is written to for training in external memory
+        xgb_model: `xgboost.Booster` to continue training, adding `n_estimators` rounds to it (optional)
+
+    Returns: `BoosterModel`
+
+    """
+    params, num_boost_round, train_kwargs = native_params(params or {}, fit)
+
+    if external_memory:
+        cache_dir = "data/dmatrix" if cache_dir is None else cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        if train_path is None:
+            train_path = write_libsvm_shards(X["train"], y["train"], os.path.join(cache_dir, "train"), n_shards)
+            n_features = X["train"].shape[1]
+        params.setdefault("tree_method", "hist")
+        dtrain = external_memory_dmatrix(train_path, os.path.join(cache_dir, "train.cache"), n_features=n_features)
+    else:
+        dtrain = cached_dmatrix(X["train"], y["train"], cache_dir=cache_dir, name="train")
+
+    evals = [(dtrain, "train")]
+    if "validate" in X and "validate" in y:
+        evals.append((cached_dmatrix(X["validate"], y["validate"], cache_dir=cache_dir, name="validate"),
+                      "validate"))
+
+    with Timer("model training", logger, rows=dtrain.num_row()):
+        booster = xgboost.train(params, dtrain, num_boost_round=num_boost_round, evals=evals, xgb_model=xgb_model,
+                                **train_kwargs)
+
+    return BoosterModel(booster, params["objective"])
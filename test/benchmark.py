@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import yaml
+import pickle
+import logging
+import logging.config
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+stages = ["load_data", "generate_features", "split_data", "train_model", "score_model"]
+
+
+def make_dataset(n_rows, n_numeric=10, n_categorical=2, cardinality=50, random_state=24):
+    """Generates a synthetic dataset of numeric and integer categorical columns with a binary target.
+
+    Args:
+        n_rows: Number of rows
+        n_numeric: Number of normally distributed numeric columns, x0, x1, ...
+        n_categorical: Number of categorical columns, c0, c1, ...
+        cardinality: Number of categories of each categorical column
+        random_state: Seed of the random number generator
+
+    Returns: Pandas dataframe with columns x0, ..., c0, ..., target
+
+    """
+    rng = np.random.RandomState(random_state)
+
+    df = pd.DataFrame(rng.normal(size=(n_rows, n_numeric)), columns=["x%i" % j for j in range(n_numeric)])
+    for j in range(n_categorical):
+        df["c%i" % j] = rng.randint(0, cardinality, n_rows)
+
+    signal = df.iloc[:, :n_numeric].values.dot(rng.normal(size=n_numeric))
+    df["target"] = (signal + rng.normal(size=n_rows) > 0).astype(int)
+
+    return df
+
+
+def generate_csv(path, n_rows, chunk_rows=1000000, random_state=24, **kwargs):
+    """Writes a synthetic dataset of `n_rows` rows to a CSV chunk by chunk, so sizes larger than memory can be made."""
+    n_chunks = int(np.ceil(n_rows / chunk_rows))
+    for i in range(n_chunks):
+        df = make_dataset(min(chunk_rows, n_rows - i * chunk_rows), random_state=random_state + i, **kwargs)
+        df.to_csv(path, index=False, mode="w" if i == 0 else "a", header=i == 0)
+
+    logger.info("Synthetic dataset with %i rows written to %s", n_rows, path)
+
+
+def features_config(n_categorical=2, sparse=False, **kwargs):
+    """Feature generation configuration used on the synthetic data."""
+    categorical = ["c%i" % j for j in range(n_categorical)]
+    return dict(make_categorical=dict(columns=categorical, one_hot=True, sparse=sparse),
+                bin_values=dict(columns="x0", quartiles=4))
+
+
+def _read(work_dir, name):
+    with open(os.path.join(work_dir, "%s.pkl" % name), "rb") as f:
+        return pickle.load(f)
+
+
+def _write(work_dir, name, obj):
+    with open(os.path.join(work_dir, "%s.pkl" % name), "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _run_stage(stage, work_dir, config):
+    """Runs one stage on the output of the previous stage and measures it. Run in a fresh process so that the peak
+    RSS measured is that of the stage and its inputs alone."""
+    from src.load_data import load_data
+    from src.generate_features import FeaturePipeline, to_model_input
+    from src.train_model import prepare_splits, get_method
+    from src.helpers import Timer, max_rss_mb
+
+    data_config = config["data"]
+    target = dict(target="target")
+
+    # Inputs are read before the clock starts
+    if stage == "generate_features":
+        df = _read(work_dir, "load_data")
+    elif stage == "split_data":
+        df = _read(work_dir, "generate_features")
+    elif stage == "train_model":
+        X, y = _read(work_dir, "split_data")
+    elif stage == "score_model":
+        model = _read(work_dir, "train_model")
+        X = _read(work_dir, "generate_features").drop(columns="target")
+
+    with Timer(stage, logger) as t:
+        if stage == "load_data":
+            output = load_data(how="csv", csv=dict(path=os.path.join(work_dir, "data.csv")))
+            t.rows = len(output)
+        elif stage == "generate_features":
+            output = FeaturePipeline(features_config(**data_config)).fit_transform(df)
+            t.rows = len(output)
+        elif stage == "split_data":
+            output = prepare_splits(df, get_target_kwargs=target, split_data_kwargs=config["split_data"],
+                                    choose_features_kwargs=dict(features_to_use=[c for c in df.columns
+                                                                                 if c != "target"]))
+            t.rows = len(df)
+        elif stage == "train_model":
+            output = get_method(config["method"])(**config.get("params", {}))
+            output.fit(to_model_input(X["train"]), y["train"])
+            t.rows = X["train"].shape[0]
+        else:
+            output = model.predict(to_model_input(X))
+            t.rows = len(X)
+
+    if stage != "score_model":
+        _write(work_dir, stage, output)
+
+    # The peak RSS is taken after writing the output, as the stage's output is part of its footprint
+    return dict(t.record, max_rss_mb=max_rss_mb())
+
+
+def run_benchmark(config, large=False):
+    """Generates synthetic data of each configured size and times each stage of the pipeline on it.
+
+    Args:
+        config: Benchmark configuration, see `test/benchmark_config.yml`
+        large: If True, the `large_sizes` of the data are benchmarked after its `sizes`
+
+    Returns: List of dictionaries of measurements, one per size and stage
+
+    """
+    data_config = config["data"]
+    sizes = data_config["sizes"] + (data_config.get("large_sizes", []) if large else [])
+    work_dir = config.get("work_dir", "test/test/benchmark")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    # Each stage runs in a new process, spawned rather than forked so that it does not inherit the parent's memory
+    context = multiprocessing.get_context("spawn")
+
+    results = []
+    for n_rows in sizes:
+        n_rows = int(n_rows)
+        generate_csv(os.path.join(work_dir, "data.csv"), n_rows,
+                     **{k: v for k, v in data_config.items() if k not in ["sizes", "large_sizes", "sparse"]})
+
+        for stage in config.get("stages", stages):
+            with context.Pool(1) as pool:
+                result = pool.apply(_run_stage, (stage, work_dir, config))
+            result["size"] = n_rows
+            results.append(result)
+            logger.info("%s on %i rows took %0.3f seconds with a peak RSS of %0.1f MB",
+                        stage, n_rows, result["seconds"], result["max_rss_mb"])
+
+    return results
+
+
+def measure_import(module, n_repeats=3):
+    """Measures the startup cost of importing `module` in a fresh interpreter with `python -X importtime`.
+
+    Args:
+        module: Module to import, e.g. "run" or "src.score_model"
+        n_repeats: Number of times to import it, the fastest being kept as the others include disk cache misses
+
+    Returns: Dictionary of the cumulative import `seconds`, the peak RSS of the interpreter and the top-level
+        packages `imported` along with the module
+
+    """
+    code = "import %s; import resource; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)" % module
+
+    seconds, max_rss, imported = None, None, set()
+    for _ in range(n_repeats):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+        # Each line is "import time: <self us> | <cumulative us> | <indented module name>"
+        for line in result.stderr.splitlines():
+            fields = [field.strip() for field in line.replace("import time:", "").split("|")]
+            if len(fields) != 3 or not fields[1].isdigit():
+                continue
+            imported.add(fields[2].split(".")[0])
+            if fields[2] == module:
+                seconds = min(seconds, int(fields[1]) / 1e6) if seconds is not None else int(fields[1]) / 1e6
+
+        rss = int(result.stdout.split()[-1])
+        max_rss = min(max_rss, rss) if max_rss is not None else rss
+
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return dict(seconds=seconds, max_rss_mb=max_rss / 1e6 if sys.platform == "darwin" else max_rss / 1e3,
+                imported=sorted(imported))
+
+
+def run_startup_benchmark(config):
+    """Measures the import time of `run.py` and each `src` module, so that regressions in the startup time of small
+    jobs are caught, e.g. a module importing a heavy dependency at the top level again.
+
+    Args:
+        config: `startup` section of the benchmark configuration, with the `modules` to import, each with a list of
+            packages it must not import, and the number of times to import each (`n_repeats`)
+
+    Returns: List of dictionaries of measurements, one per module
+
+    """
+    results = []
+    for module, forbidden in config["modules"].items():
+        result = dict(measure_import(module, config.get("n_repeats", 3)), stage="import %s" % module, size=0,
+                      forbidden=[package for package in (forbidden or []) if package != module])
+        results.append(result)
+        logger.info("Importing %s took %0.3f seconds, importing %i packages", module, result["seconds"],
+                    len(result["imported"]))
+
+    return results
+
+
+def check_imports(results):
+    """Describes each module measured by `run_startup_benchmark()` that imported a package it must not import."""
+    return ["%s imported %s" % (result["stage"], ", ".join(sorted(set(result["forbidden"]) & set(result["imported"]))))
+            for result in results if len(set(result.get("forbidden", [])) & set(result.get("imported", []))) > 0]
+
+
+def compare_to_baseline(results, baseline, time_tolerance=0.25, memory_tolerance=0.25, min_seconds=0.1):
+    """Compares benchmark results to a baseline.
+
+    Args:
+        results: List of measurements from `run_benchmark()`
+        baseline: List of measurements to compare to
+        time_tolerance: Fraction by which a stage may be slower than its baseline
+        memory_tolerance: Fraction by which the peak RSS of a stage may exceed its baseline
+        min_seconds: Slowdowns smaller than this many seconds are ignored as noise
+
+    Returns: List of descriptions of regressions, including measurements that have no baseline, empty if there are
+        none
+
+    """
+    baseline = {(b["size"], b["stage"]): b for b in baseline}
+
+    regressions = []
+    for result in results:
+        key = (result["size"], result["stage"])
+        if key not in baseline:
+            regressions.append("%s on %i rows has no baseline, run with --update_baseline to add it"
+                               % (result["stage"], result["size"]))
+            continue
+        base = baseline[key]
+
+        if (result["seconds"] > base["seconds"] * (1 + time_tolerance)
+                and result["seconds"] - base["seconds"] > min_seconds):
+            regressions.append("%s on %i rows took %0.3f seconds, %0.3f in baseline"
+                               % (result["stage"], result["size"], result["seconds"], base["seconds"]))
+
+        if result["max_rss_mb"] > base["max_rss_mb"] * (1 + memory_tolerance):
+            regressions.append("%s on %i rows peaked at %0.1f MB, %0.1f MB in baseline"
+                               % (result["stage"], result["size"], result["max_rss_mb"], base["max_rss_mb"]))
+
+    return regressions
+
+
+def run_benchmarks(args=None, config_path=None, update_baseline=False, startup_only=False, large=False):
+    """Runs the benchmarks configured in `config_path`, saves the results and fails if they regress from the baseline.
+
+    Args:
+        args: If fed args from argparse, args.path gives the benchmark configuration and args.update_baseline
+            whether to save the results as the new baseline
+        config_path: Path to the benchmark configuration file
+        update_baseline: If True, the results are saved as the new baseline instead of being compared to it
+        startup_only: If True, only the import times configured in the `startup` section are benchmarked
+        large: If True, the `large_sizes` of the data are benchmarked too
+
+    Returns:
+        passed (bool): True if no stage regressed from the baseline
+        results (list): Measurements of each size and stage
+
+    """
+    if args is not None:
+        config_path, update_baseline = args.path, args.update_baseline
+        startup_only = getattr(args, "startup", False)
+        large = getattr(args, "large", False)
+
+    with open(config_path, "r") as f:
+        config = yaml.load(f)
+
+    results = run_benchmark(config, large=large) if not startup_only else []
+    if "startup" in config:
+        results += run_startup_benchmark(config["startup"])
+
+    report = dict(machine=dict(platform=platform.platform(), processor=platform.processor(),
+                               cpu_count=multiprocessing.cpu_count(), python=platform.python_version()),
+                  config=config, results=results)
+
+    if config.get("save_results") is not None:
+        with open(config["save_results"], "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info("Benchmark results saved to %s", config["save_results"])
+
+    # Imports of packages a module must not import fail the benchmark whatever the baseline
+    regressions = check_imports(results)
+
+    baseline_path = config.get("baseline", "test/benchmark_baseline.json")
+    if update_baseline and len(regressions) == 0:
+        # Measurements not rerun, e.g. of the stages when only the startup is benchmarked, keep their baseline
+        if os.path.exists(baseline_path):
+            with open(baseline_path, "r") as f:
+                measured = [(r["size"], r["stage"]) for r in results]
+                report["results"] = [b for b in json.load(f)["results"]
+                                     if (b["size"], b["stage"]) not in measured] + results
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.warning("Benchmark baseline updated at %s", baseline_path)
+        return True, results
+
+    if os.path.exists(baseline_path) and not update_baseline:
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)
+        regressions += compare_to_baseline(results, baseline["results"], **config.get("tolerance", {}))
+    elif not update_baseline:
+        regressions.append("No benchmark baseline at %s to compare to, run with --update_baseline to create one"
+                           % baseline_path)
+
+    for regression in regressions:
+        logger.error("REGRESSION: %s", regression)
+
+    if len(regressions) > 0:
+        if args is not None:
+            sys.exit(1)
+        return False, results
+
+    logger.warning("No benchmark regressions from baseline")
+
+    return True, results
+
+
+if __name__ == '__main__':
+    logging.config.fileConfig("config/logging/local.conf")
+
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the pipeline on synthetic data")
+    parser.add_argument("--path", default="test/benchmark_config.yml", help="Path to the benchmark configuration")
+    parser.add_argument("--update_baseline", default=False, action="store_true",
+                        help="Save the results as the new baseline instead of comparing to it")
+    parser.add_argument("--startup", default=False, action="store_true",
+                        help="Only benchmark the import time of run.py and the src modules")
+    parser.add_argument("--large", default=False, action="store_true",
+                        help="Also benchmark the large_sizes of the data, up to 1e8 rows")
+    args = parser.parse_args()
+    run_benchmarks(args)
@@ -1,24 +1,45 @@
 import subprocess
 import yaml
+import json
+import time
+import hashlib
 import logging
+import logging.config
 import os
-import xmltodict
+import threading
 import argparse
-import filecmp
+import concurrent.futures
+import xmltodict
+
+import numpy as np
+import pandas as pd
+
+from src.helpers import get_format, read_frame_chunks, align_chunks
+
+logger = logging.getLogger(__name__)
 
 dict_file_types = ["json", "xml", "yml", "yaml"]
 
+# Files compared row by row, chunk by chunk, by `diff_tables()` when they are not identical
+table_file_types = ["csv", "parquet", "pq"]
+
+# By default numbers must be equal, though may be written differently, e.g. 1 and 1.0
+default_tolerance = dict(atol=0, rtol=0, max_mismatches=10, chunksize=100000)
+
+# Name of the cache of digests of expected outputs, kept in each test directory
+digest_cache_name = ".true-digests.json"
+
 
 def open_dictlike_file(fname):
     with open(fname, "r") as f:
         if fname.endswith("json"):
-            fdict = yaml.load(f)
+            fdict = json.load(f)
         elif fname.endswith("yaml") or fname.endswith("yml"):
             fdict = yaml.load(f)
         elif fname.endswith("xml"):
             fdict = xmltodict.parse(f.read())
         else:
-            logging.warning("%s not a known dictionary-like file type", fname)
+            logger.warning("%s not a known dictionary-like file type", fname)
     return fdict
 
 
@@ -27,225 +48,390 @@ def compare_dict(dicta, dictb):
     mismatch_keys = []
     for k in dicta:
         if k in dictb:
-            if type(dicta[k]) == dict:
+            if type(dicta[k]) == dict and type(dictb[k]) == dict:
                 same, mismatch = compare_dict(dicta[k], dictb[k])
             else:
                 same = (dicta[k] == dictb[k])
         else:
             same = False
         if not same:
-           mismatch_keys.append(k)
+            mismatch_keys.append(k)
 
     dicts_are_same = False if len(mismatch_keys) > 0 else True
 
     return dicts_are_same, mismatch_keys
 
 
-def run_tests(args=None, config_path=None):
-    """ Runs a provided command and compares the files produced to those that are expected.
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 ** 2), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-    Test is configured by a yaml file that has the following format:
 
-    ```yaml
-    test_name:
-        command: <command that should be run to produce the files being tested>
-        true_dir: <path to directory holding expected outputs of command>
-        test_dir: <path to where the command saves the outputs produced>
-        files_to_compare:
-            - <list of files that should be produced into the test directory when the>
-            - <command is run and should already exist in the true directory for comparison>
-    ```
+def _column_matches(true_column, test_column, atol, rtol):
+    if pd.api.types.is_numeric_dtype(true_column) and pd.api.types.is_numeric_dtype(test_column):
+        true_values, test_values = np.asarray(true_column, dtype=float), np.asarray(test_column, dtype=float)
+        return np.isclose(test_values, true_values, rtol=rtol, atol=atol, equal_nan=True)
 
+    true_na, test_na = true_column.isna().values, test_column.isna().values
+    same = true_column.astype(str).values == test_column.astype(str).values
+    return (same & ~true_na & ~test_na) | (true_na & test_na)
 
-    Args:
-        args: If fed args from argparse, args.path should exist and give the path to the testing configuration file
-        config_path: Path to the testing configuration file
 
-    Returns:
-        all_passed (bool): True if all tests pass, False if not
-        results (dict): Dictionary of tests and their corresponding list of files that did not match
+def _item(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def diff_tables(true_file, test_file, atol=0, rtol=0, max_mismatches=10, chunksize=100000):
+    """Compares two CSV or Parquet files row by row, reading them chunk by chunk so that files larger than memory are
+    compared in the memory of one chunk of each.
+
+    Numeric columns match where `abs(test - true) <= atol + rtol * abs(true)`, or both are missing. Other columns
+    must be equal. Columns are compared by name, so may be in a different order.
+
+    Args:
+        true_file: Path to the expected file
+        test_file: Path to the file produced
+        atol: Absolute tolerance of numeric columns
+        rtol: Tolerance of numeric columns relative to the expected values
+        max_mismatches: Number of differing rows after which the comparison stops
+        chunksize: Number of rows read from each file at a time
+
+    Returns: Dictionary of whether the files are the `same`, the number of `rows` compared, the `missing_columns` and
+        `unexpected_columns` of the file produced, its `missing_rows` and `unexpected_rows`, the number of
+        `mismatched_rows` up to `max_mismatches` and the first `mismatches`, each the `row` and the expected and
+        produced `values` of the columns that differ. If the comparison `stopped_early`, the rows after the last
+        mismatch are not compared and `missing_rows` and `unexpected_rows` are None
 
     """
+    # CSV numbers are parsed exactly, so that the parser's own rounding is not mistaken for a difference
+    true_chunks = read_frame_chunks(true_file, chunksize,
+                                    **(dict(float_precision="round_trip") if get_format(true_file) == "csv" else {}))
+    test_chunks = read_frame_chunks(test_file, chunksize,
+                                    **(dict(float_precision="round_trip") if get_format(test_file) == "csv" else {}))
+
+    diff = dict(same=True, rows=0, missing_columns=[], unexpected_columns=[], mismatched_rows=0, mismatches=[],
+                stopped_early=False)
+
+    columns, unmatched = None, {}
+    for offset, true_chunk, test_chunk in align_chunks(true_chunks, test_chunks, unmatched):
+        if columns is None:
+            columns = [c for c in true_chunk.columns if c in test_chunk.columns]
+            diff["missing_columns"] = [str(c) for c in true_chunk.columns if c not in test_chunk.columns]
+            diff["unexpected_columns"] = [str(c) for c in test_chunk.columns if c not in true_chunk.columns]
+
+        matches = np.column_stack([_column_matches(true_chunk[c], test_chunk[c], atol, rtol) for c in columns]) \
+            if len(columns) > 0 else np.ones((len(true_chunk), 0), dtype=bool)
+        diff["rows"] = offset + len(true_chunk)
+
+        mismatched = np.flatnonzero(~matches.all(axis=1))
+        for i in mismatched[:max_mismatches - diff["mismatched_rows"]]:
+            differing = [c for c, match in zip(columns, matches[i]) if not match]
+            diff["mismatches"].append(dict(row=int(offset + i), values={
+                str(c): dict(true=_item(true_chunk[c].iat[i]), test=_item(test_chunk[c].iat[i])) for c in differing}))
+
+        diff["mismatched_rows"] += min(len(mismatched), max_mismatches - diff["mismatched_rows"])
+        if diff["mismatched_rows"] >= max_mismatches:
+            diff["stopped_early"] = True
+            diff["rows"] = diff["mismatches"][-1]["row"] + 1
+            break
+
+    # Rows left over in either file are only counted once the other has been read to its end
+    diff["missing_rows"], diff["unexpected_rows"] = unmatched.get("left"), unmatched.get("right")
+    true_chunks.close()
+    test_chunks.close()
+
+    diff["same"] = diff["mismatched_rows"] == 0 and not diff["missing_columns"] and \
+        not diff["unexpected_columns"] and not diff["missing_rows"] and not diff["unexpected_rows"]
+    return diff
+
+
+class DigestCache:
+    """Digests of the expected outputs in the true directories, computed once and cached on disk with the size and
+    modification time of each file, so that a file is only hashed again when it changes.
 
-    if args is not None:
-        config_path = args.path
+    Args:
+        path: Path to the JSON file the digests are cached in
 
-    with open(config_path, "r") as f:
-        tests = yaml.load(f)
+    """
 
-    all_passed = True
-    for test in tests:
-        testconf = tests[test]
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.digests = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.digests = json.load(f)
 
-        true_dir, test_dir = testconf["true_dir"], testconf["test_dir"]
+    def get(self, true_file):
+        key = os.path.abspath(true_file)
+        stat = os.stat(true_file)
 
-        no_true_to_compare = []
-        for file in testconf["files_to_compare"]:
-            test_file = os.path.join(test_dir, file)
-            true_file = os.path.join(true_dir, file)
+        with self.lock:
+            entry = self.digests.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha256"]
 
-            # Remove test files if they have already been produced previously
-            # Otherwise, your code may not actually be producing that file but the test will pass
-            if os.path.exists(test_file):
-                os.remove(test_file)
-                logging.debug("%s removed to be recreated", test_file)
+        sha256 = file_digest(true_file)
+        with self.lock:
+            self.digests[key] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=sha256)
+        return sha256
 
-            # Check if the file actually exists in the true directory
-            if not os.path.exists(true_file):
-                logging.warning("%s does not exist to be compared to", true_file)
-                no_true_to_compare.append(file)
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.lock, open(self.path, "w") as f:
+            json.dump(self.digests, f, indent=2, sort_keys=True)
 
-        # Run command being tested
-        subprocess.check_output(testconf["command"].split())
 
-        # Compare files that were produced that are not versions of dictionaries where order is not deterministic
-        files_to_compare = [
-            f for f in testconf["files_to_compare"]
-            if f.split('.')[-1] not in dict_file_types and f not in no_true_to_compare
-        ]
+def compare_files(true_dir, test_dir, files, digests, tolerance=None):
+    """Compares files produced by a test to the expected ones, by size and then by the cached digest of the expected
+    file, or by their contents for dictionary-like files whose order is not deterministic. CSV and Parquet files that
+    are not identical are compared row by row by `diff_tables()`, within the tolerances given.
 
-        match, mismatch, errors = filecmp.cmpfiles(true_dir, test_dir,
-                                                   files_to_compare, shallow=True)
+    Args:
+        true_dir: Directory of the expected files
+        test_dir: Directory of the files produced
+        files: List of files to compare
+        digests: `DigestCache` of the expected files
+        tolerance: Dictionary of keyword arguments to `diff_tables()`, see `default_tolerance` (optional)
+
+    Returns:
+        mismatch (list): Files that do not match or were not produced
+        diffs (dict): Result of `diff_tables()` of each CSV or Parquet file that was not identical
 
-        # Compare files that are versions of dictionaries where order is not deterministic
-        dicts_to_compare = [
-            f for f in testconf["files_to_compare"]
-            if f.split('.')[-1] in dict_file_types and f not in no_true_to_compare
-        ]
+    """
+    tolerance = dict(default_tolerance, **(tolerance or {}))
 
-        dict_mismatch = []
-        for fname in dicts_to_compare:
-            true_dict = open_dictlike_file(os.path.join(true_dir, fname))
-            test_dict = open_dictlike_file(os.path.join(test_dir, fname))
+    mismatch, diffs = [], {}
+    for file in files:
+        true_file, test_file = os.path.join(true_dir, file), os.path.join(test_dir, file)
 
+        if not os.path.exists(test_file):
+            logger.warning("%s was not produced to be compared", test_file)
+            mismatch.append(file)
+        elif file.split(".")[-1] in dict_file_types:
+            true_dict, test_dict = open_dictlike_file(true_file), open_dictlike_file(test_file)
             dicts_are_same, mismatch_keys = compare_dict(true_dict, test_dict)
             if not dicts_are_same:
-                dict_mismatch.append(fname)
-                with open(os.path.join(true_dir, "true_%s.yml") % fname, "w") as f:
+                mismatch.append(file)
+                with open(os.path.join(true_dir, "true_%s.yml") % file, "w") as f:
                     yaml.dump(true_dict, f)
-                with open(os.path.join(test_dir, "test_%s.yml") % fname, "w") as f:
+                with open(os.path.join(test_dir, "test_%s.yml") % file, "w") as f:
                     yaml.dump(test_dict, f)
-                logging.warning("%s keys are not the same", ",".join(mismatch_keys))
+                logger.warning("%s keys are not the same", ",".join(mismatch_keys))
+        elif os.path.getsize(true_file) == os.path.getsize(test_file) and \
+                digests.get(true_file) == file_digest(test_file):
+            continue
+        elif file.split(".")[-1] in table_file_types:
+            diffs[file] = diff_tables(true_file, test_file, **tolerance)
+            if not diffs[file]["same"]:
+                mismatch.append(file)
+                logger.warning("%s differs from the expected file, first differing rows: %s", file,
+                               json.dumps(diffs[file]["mismatches"][:3], default=str))
+        else:
+            mismatch.append(file)
 
-        mismatch += no_true_to_compare
-        mismatch += dict_mismatch
+    return mismatch, diffs
 
-        if len(mismatch) > 0:
-                logging.warning("%s file(s) does not match or did not exist, %s test FAILED",
-                                ", ".join(mismatch), test)
-                all_passed = False
-        else:
-            logging.warning("%s test PASSED" % test)
 
-    if all_passed:
-        logging.warning("Success, all tests passed!")
+def run_test(test, testconf, digests, timeout=None):
+    """Runs the command of a test and compares the files it produces to those that are expected.
 
+    Args:
+        test: Name of the test
+        testconf: Configuration of the test, see `run_tests()`
+        digests: `DigestCache` of the expected outputs
+        timeout: Seconds the command may take before it is killed and the test fails, unless the test sets its own
+            `timeout` (optional)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Test whether the expected outputs are produced")
-    parser.add_argument("--path", default="test/test_config.yml", help="Path to the test configuration file")
-    args = parser.parse_args()
-    run_tests(config_path=args.path)
+    Returns: Dictionary of whether the test `passed` or was `skipped`, the `mismatch`ed files, the `diffs` of CSV and
+        Parquet files that were not identical, the `seconds` taken by the whole test, its `command_seconds` and
+        `compare_seconds`, the `returncode` of the command and whether it `timed_out`
 
-import subprocess
-import yaml
-import logging
-import os
-import argparse
-import filecmp
-import logging.config
-import xmltodict
+    """
+    true_dir, test_dir = testconf["true_dir"], testconf["test_dir"]
+    timeout = testconf.get("timeout", timeout)
+    result = dict(test=test, passed=False, skipped=False, mismatch=[], diffs={}, returncode=None, timed_out=False,
+                  seconds=None, command_seconds=None, compare_seconds=None)
+    start = time.perf_counter()
+
+    no_true_to_compare = []
+    for file in testconf["files_to_compare"]:
+        test_file = os.path.join(test_dir, file)
+        true_file = os.path.join(true_dir, file)
+
+        # Remove test files if they have already been produced previously
+        # Otherwise, your code may not actually be producing that file but the test will pass
+        if os.path.exists(test_file):
+            os.remove(test_file)
+            logger.debug("%s removed to be recreated", test_file)
+
+        # Check if the file actually exists in the true directory
+        if not os.path.exists(true_file):
+            logger.warning("%s does not exist to be compared to", true_file)
+            no_true_to_compare.append(file)
+
+    # Run command being tested
+    try:
+        completed = subprocess.run(testconf["command"].split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   timeout=timeout)
+        result["returncode"] = completed.returncode
+        if completed.returncode != 0:
+            logger.warning("%s command failed with exit code %i:\n%s", test, completed.returncode,
+                           completed.stderr.decode("utf-8", "replace")[-2000:])
+    except subprocess.TimeoutExpired:
+        result["timed_out"] = True
+        logger.warning("%s command timed out after %s seconds", test, timeout)
+    result["command_seconds"] = time.perf_counter() - start
+
+    compare_start = time.perf_counter()
+    if result["returncode"] == 0:
+        files_to_compare = [f for f in testconf["files_to_compare"] if f not in no_true_to_compare]
+        mismatch, result["diffs"] = compare_files(true_dir, test_dir, files_to_compare, digests,
+                                                  tolerance=testconf.get("tolerance"))
+        result["mismatch"] = mismatch + no_true_to_compare
+    else:
+        result["mismatch"] = list(testconf["files_to_compare"])
+    result["compare_seconds"] = time.perf_counter() - compare_start
+
+    result["passed"] = result["returncode"] == 0 and len(result["mismatch"]) == 0
+    result["seconds"] = time.perf_counter() - start
+
+    if result["passed"]:
+        logger.warning("%s test PASSED in %0.2f seconds", test, result["seconds"])
+    else:
+        logger.warning("%s file(s) does not match or did not exist, %s test FAILED",
+                       ", ".join(result["mismatch"]), test)
+
+    return result
+
+
+def _dependencies(testconf):
+    dependencies = testconf.get("depends_on", [])
+    return [dependencies] if type(dependencies) != list else dependencies
+
+
+def check_dependencies(tests):
+    """Checks that every test a test `depends_on` exists and that no tests depend on each other in a cycle, which
+    would leave them waiting on each other forever.
 
-dict_file_types = ["json", "xml", "yml", "yaml"]
+    Args:
+        tests: Dictionary of the configuration of each test, see `run_tests()`
 
+    Returns: List of the tests in an order they can run in
 
-def open_dictlike_file(fname):
-    with open(fname, "r") as f:
-        if fname.endswith("json"):
-            fdict = yaml.load(f)
-        elif fname.endswith("yaml") or fname.endswith("yml"):
-            fdict = yaml.load(f)
-        elif fname.endswith("xml"):
-            fdict = xmltodict.parse(f.read())
-        else:
-            logging.warning("%s not a known dictionary-like file type", fname)
-    return fdict
+    """
+    for test in tests:
+        missing = [dependency for dependency in _dependencies(tests[test]) if dependency not in tests]
+        if len(missing) > 0:
+            raise ValueError("%s depends on %s, which are not tests" % (test, ", ".join(missing)))
 
+    # Topological sort, taking tests whose dependencies have all been taken until none are left
+    order, remaining = [], list(tests)
+    while len(remaining) > 0:
+        ready = [test for test in remaining if all(dependency in order for dependency in _dependencies(tests[test]))]
+        if len(ready) == 0:
+            raise ValueError("Tests %s depend on each other in a cycle, or on tests that do" % ", ".join(remaining))
+        order.extend(ready)
+        remaining = [test for test in remaining if test not in ready]
 
-def compare_dict(dicta, dictb):
+    return order
 
-    mismatch_keys = []
-    for k in dicta:
-        if k in dictb:
-            if type(dicta[k]) == dict:
-                same, mismatch = compare_dict(dicta[k], dictb[k])
-            else:
-                same = (dicta[k] == dictb[k])
-        else:
-            same = False
-        if not same:
-           mismatch_keys.append(k)
 
-    dicts_are_same = False if len(mismatch_keys) > 0 else True
+def run_tests(args=None, config_path=None, n_jobs=None, timeout=None):
+    """ Runs a provided command and compares the files produced to those that are expected.
 
-    return dicts_are_same, mismatch_keys
+    Test is configured by a yaml file that has the following format:
+
+    ```yaml
+    test_name:
+        command: <command that should be run to produce the files being tested>
+        true_dir: <path to directory holding expected outputs of command>
+        test_dir: <path to where the command saves the outputs produced>
+        files_to_compare:
+            - <list of files that should be produced into the test directory when the>
+            - <command is run and should already exist in the true directory for comparison>
+        depends_on: <list of tests whose outputs the command uses, run and passed first (optional)>
+        timeout: <seconds the command may take before the test fails (optional)>
+        tolerance: <dictionary of the atol, rtol, max_mismatches and chunksize of comparing CSV and Parquet files,
+            see `diff_tables()` (optional)>
+    ```
 
+    Tests run `n_jobs` at a time, each as soon as the tests it depends on have passed. Tests that depend on a test
+    that failed are skipped and fail.
 
-def run_tests(args=None, config_path=None, logger=None):
-    if logger is None:
-        logger = logging.getLogger(__name__)
-        logger.setLevel("DEBUG")
+    Args:
+        args: If fed args from argparse, args.path should exist and give the path to the testing configuration file,
+            and args.n_jobs and args.timeout may be given
+        config_path: Path to the testing configuration file
+        n_jobs: Number of tests run at once, by default as many as are independent of each other
+        timeout: Seconds each test command may take, unless a test sets its own `timeout` (optional)
+
+    Returns:
+        all_passed (bool): True if all tests pass, False if not
+        results (dict): Dictionary of each test's result, see `run_test()`
+
+    """
 
     if args is not None:
         config_path = args.path
+        n_jobs, timeout = getattr(args, "n_jobs", None), getattr(args, "timeout", None)
 
     with open(config_path, "r") as f:
         tests = yaml.load(f)
 
-    all_passed = True
-    results = {}
-    for test in tests:
-        testconf = tests[test]
-
-        for file in testconf["files_to_compare"]:
-            test_file = os.path.join(testconf["test_dir"], file)
-            true_file = os.path.join(testconf["true_dir"], file)
-            if os.path.exists(test_file):
-                os.remove(test_file)
-                logging.debug("%s removed to be recreated", test_file)
-            if not os.path.exists(true_file):
-                logging.warning("%s does not exist to be compared to", true_file)
-
-        subprocess.check_output(testconf["command"].split())
-
-        match, mismatch, errors = filecmp.cmpfiles(testconf["true_dir"], testconf["test_dir"],
-                                                   testconf["files_to_compare"], shallow=True)
-        for file in testconf["files_to_compare"]:
-            test_file = os.path.join(testconf["test_dir"], file)
-            if not os.path.exists(test_file):
-                logging.warning("%s does not exist to be compared to", test_file)
-                if file not in mismatch:
-                    mismatch.append(file)
-
-        if len(mismatch) > 0:
-                logging.warning("%s file(s) does not match, %s test FAILED" % (", ".join(mismatch), test))
-                all_passed = False
-        else:
-            logging.warning("%s test PASSED" % test)
-        results[test] = mismatch
+    check_dependencies(tests)
 
+    # Expected outputs are hashed once across runs, the cache being kept with the outputs produced
+    digest_caches = {}
+    for test in tests:
+        path = os.path.join(tests[test]["test_dir"], digest_cache_name)
+        digest_caches.setdefault(os.path.abspath(path), DigestCache(path))
+
+    def digests(test):
+        return digest_caches[os.path.abspath(os.path.join(tests[test]["test_dir"], digest_cache_name))]
+
+    results, running = {}, {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs or len(tests) or 1) as executor:
+        while len(results) < len(tests):
+            for test in tests:
+                if test in results or test in running:
+                    continue
+                dependencies = _dependencies(tests[test])
+                failed = [dependency for dependency in dependencies
+                          if dependency in results and not results[dependency]["passed"]]
+                if len(failed) > 0:
+                    logger.warning("%s test SKIPPED as %s failed", test, ", ".join(failed))
+                    results[test] = dict(test=test, passed=False, skipped=True,
+                                         mismatch=list(tests[test]["files_to_compare"]), diffs={}, returncode=None,
+                                         timed_out=False, seconds=0, command_seconds=0, compare_seconds=0)
+                elif all(dependency in results for dependency in dependencies):
+                    running[test] = executor.submit(run_test, test, tests[test], digests(test), timeout)
+
+            if len(running) == 0:
+                continue
+            done, _ = concurrent.futures.wait(running.values(), return_when=concurrent.futures.FIRST_COMPLETED)
+            for test in [test for test, future in running.items() if future in done]:
+                results[test] = running.pop(test).result()
+
+    for cache in digest_caches.values():
+        cache.save()
+
+    all_passed = all(result["passed"] for result in results.values())
     if all_passed:
-        logging.warning("Success, all tests passed!")
+        logger.warning("Success, all tests passed!")
 
     return all_passed, results
 
 
 if __name__ == '__main__':
     logging.config.fileConfig("config/logging/local.conf")
-    logger = logging.getLogger(__name__)
-    logger.setLevel("DEBUG")
 
     parser = argparse.ArgumentParser(description="Test whether the expected outputs are produced")
     parser.add_argument("--path", default="test/test_config.yml", help="Path to the test configuration file")
+    parser.add_argument("--n_jobs", default=None, type=int, help="Number of tests run at once (optional)")
+    parser.add_argument("--timeout", default=None, type=float, help="Seconds each test command may take (optional)")
     args = parser.parse_args()
-    run_tests(config_path=args.path, logger=logger)
+    run_tests(args)
@@ -0,0 +1,68 @@
+import argparse
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from src.load_data import create_connection, dispose_engines, stream_query
+from src.train_model import load_training_data
+
+
+def make_database(path, n_rows=25):
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS t (id INTEGER, x REAL, name TEXT)")
+        db.executemany("INSERT INTO t VALUES (?, ?, ?)",
+                       [(i, None if i % 7 == 0 else i / 4, "row%i" % i) for i in range(n_rows)])
+
+
+def test_stream_query_matches_read_sql(tmp_path):
+    path = str(tmp_path / "data.db")
+    make_database(path)
+    conn = create_connection(database=path, sqltype="sqlite")
+
+    try:
+        sql = "SELECT * FROM t ORDER BY id"
+        chunks = list(stream_query(sql, conn, chunksize=10))
+        expected = pd.read_sql(sql, conn)
+    finally:
+        dispose_engines()
+
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
+
+
+def test_create_connection_reuses_engines(tmp_path):
+    path = str(tmp_path / "data.db")
+
+    try:
+        conn = create_connection(database=path, sqltype="sqlite")
+        assert create_connection(database=path, sqltype="sqlite") is conn
+        assert create_connection(database=str(tmp_path / "other.db"), sqltype="sqlite") is not conn
+        assert create_connection(database=path, sqltype="sqlite", reuse=False) is not conn
+    finally:
+        dispose_engines()
+
+
+def test_queries_are_only_cached_when_configured(tmp_path):
+    path = str(tmp_path / "data.db")
+    make_database(path, n_rows=5)
+    conn = create_connection(database=path, sqltype="sqlite")
+    config = dict(cache=dict(path=str(tmp_path / "cache")), train_model=dict(method="logistic"),
+                  load_data=dict(how="query", query=dict(sql="SELECT * FROM t", conn=conn)))
+    args = argparse.Namespace(csv=None)
+
+    try:
+        assert len(load_training_data(args, config)[0]) == 5
+        make_database(path, n_rows=3)
+        # Without a cache key or TTL the query is run again rather than its first results reused
+        assert len(load_training_data(args, config)[0]) == 8
+
+        config["load_data"]["cache_key"] = "v1"
+        assert len(load_training_data(args, config)[0]) == 8
+        make_database(path, n_rows=3)
+        assert len(load_training_data(args, config)[0]) == 8
+
+        with pytest.raises(ValueError):
+            load_training_data(args, dict(config, load_data=dict(config["load_data"], chunksize=2)))
+    finally:
+        dispose_engines()
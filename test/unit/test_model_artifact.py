@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+import xgboost
+
+from src.model_artifact import save_artifact, load_model, read_manifest
+
+
+@pytest.mark.parametrize("n_classes", [2, 3])
+def test_xgboost_classifier_artifact_round_trip(tmp_path, n_classes):
+    rng = np.random.RandomState(24)
+    X = rng.rand(200, 4)
+    y = np.minimum((X[:, 0] * n_classes).astype(int), n_classes - 1)
+    model = xgboost.XGBClassifier(n_estimators=5, max_depth=2).fit(X, y)
+
+    path = str(tmp_path / "model")
+    save_artifact(model, path, X=X)
+    loaded = load_model(path, lazy=False)
+
+    assert read_manifest(path)["classes"] == list(range(n_classes))
+    np.testing.assert_array_equal(loaded.predict(X), model.predict(X))
+    np.testing.assert_allclose(loaded.predict_proba(X), model.predict_proba(X), rtol=1e-6)
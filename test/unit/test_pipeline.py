@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from src.load_data import load_data
+from src.pipeline import run_stages
+from src.score_model import score_model, get_feature_pipeline
+from test.benchmark import make_dataset
+
+
+def featurizing_config(tmp_path):
+    path = str(tmp_path / "data.csv")
+    make_dataset(400).to_csv(path, index=False)
+    features = ["x%i" % j for j in range(10)] + ["c0", "c1"]
+
+    return dict(load_data=dict(how="csv", csv=dict(path=path)),
+                # One-hot encoded rather than binned or categorical dtype features, which the pinned xgboost lacks
+                generate_features=dict(make_categorical=dict(columns=["c0", "c1"], one_hot=True)),
+                train_model=dict(method="xgboost", featurize=True, save_tmo=str(tmp_path / "model"),
+                                 choose_features=dict(features_to_use=features), get_target=dict(target="target"),
+                                 split_data=dict(train_size=0.6, test_size=0.2, validate_size=0.2),
+                                 params=dict(n_estimators=10, max_depth=3)),
+                score_model=dict(featurize=True, path_to_tmo=str(tmp_path / "model")))
+
+
+def test_pipeline_scores_match_scoring_fresh_data(tmp_path):
+    config = featurizing_config(tmp_path)
+
+    outputs = run_stages(config, stages=["load_data", "train_model", "score_model"])
+
+    fresh = load_data(**config["load_data"])
+    # Featurizing stages must not change the data other stages are given
+    pd.testing.assert_frame_equal(outputs["load_data"], fresh)
+
+    expected = score_model(fresh, features=get_feature_pipeline(config), **config["score_model"])
+    np.testing.assert_array_equal(outputs["score_model"], expected)
@@ -0,0 +1,16 @@
+import pytest
+
+from test.test import check_dependencies
+
+
+def test_dependencies_are_ordered():
+    tests = dict(train={"depends_on": ["features"]}, features={}, score={"depends_on": "train"})
+    assert check_dependencies(tests) == ["features", "train", "score"]
+
+
+@pytest.mark.parametrize("tests", [dict(a={"depends_on": "a"}),
+                                   dict(a={"depends_on": "b"}, b={"depends_on": ["a"]}, c={}),
+                                   dict(a={"depends_on": "missing"})])
+def test_unrunnable_dependencies_raise(tests):
+    with pytest.raises(ValueError):
+        check_dependencies(tests)
@@ -0,0 +1,59 @@
+import os
+
+import boto3
+import pandas as pd
+try:
+    from moto import mock_aws
+except ImportError:
+    # moto before 5.0 mocks each service separately
+    from moto import mock_s3 as mock_aws
+
+from src.helpers import download_s3_objects, open_s3_object
+
+
+def spy_downloads(client):
+    downloaded, download_file = [], client.download_file
+
+    def download(bucket, key, path, **kwargs):
+        downloaded.append(key)
+        return download_file(bucket, key, path, **kwargs)
+
+    client.download_file = download
+    return downloaded
+
+
+@mock_aws
+def test_download_skips_unchanged_objects(tmp_path):
+    client = boto3.client("s3", region_name="us-east-1")
+    client.create_bucket(Bucket="bucket")
+    client.put_object(Bucket="bucket", Key="data/a.csv", Body=b"x\n1\n")
+    client.put_object(Bucket="bucket", Key="data/part/b.csv", Body=b"x\n2\n")
+    downloaded = spy_downloads(client)
+
+    paths = download_s3_objects("s3://bucket/data/", str(tmp_path), n_jobs=2, client=client)
+    assert sorted(paths) == [str(tmp_path / "a.csv"), str(tmp_path / "part" / "b.csv")]
+    assert sorted(downloaded) == ["data/a.csv", "data/part/b.csv"]
+
+    # Objects with the ETag and size the manifest recorded are not downloaded again
+    del downloaded[:]
+    download_s3_objects("s3://bucket/data/", str(tmp_path), n_jobs=2, client=client)
+    assert downloaded == []
+
+    client.put_object(Bucket="bucket", Key="data/a.csv", Body=b"x\n3\n")
+    download_s3_objects("s3://bucket/data/", str(tmp_path), n_jobs=2, client=client)
+    assert downloaded == ["data/a.csv"]
+    with open(os.path.join(str(tmp_path), "a.csv"), "r") as f:
+        assert f.read() == "x\n3\n"
+
+
+@mock_aws
+def test_open_s3_object_streams(tmp_path):
+    client = boto3.client("s3", region_name="us-east-1")
+    client.create_bucket(Bucket="bucket")
+    df = pd.DataFrame(dict(x=range(1000), y=[i / 3 for i in range(1000)]))
+    client.put_object(Bucket="bucket", Key="data.csv", Body=df.to_csv(index=False).encode("utf-8"))
+
+    stream = open_s3_object("s3://bucket/data.csv", client=client)
+    assert stream.read(2) == b"x,"
+    pd.testing.assert_frame_equal(pd.read_csv(open_s3_object("s3://bucket/data.csv", client=client)), df)
+    assert os.listdir(str(tmp_path)) == []
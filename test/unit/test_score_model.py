@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from src.evaluate_model import evaluate_model
+from src.generate_features import choose_features, compile_feature_pipeline, to_model_input
+from src.helpers import read_frame
+from src.score_model import score_model, score_chunks, get_feature_pipeline
+from src.train_model import train_model
+from test.benchmark import make_dataset
+
+
+def featurizing_config(tmp_path, save_tmo, sparse=False):
+    # As the example configuration, features are chosen and the target got when training, not generating features
+    return dict(generate_features=dict(make_categorical=dict(columns=["c0", "c1"], one_hot=True, sparse=sparse)),
+                train_model=dict(method="xgboost", featurize=True, save_tmo=str(tmp_path / save_tmo),
+                                 choose_features=dict(features_to_use=["x%i" % j for j in range(10)] + ["c0"]),
+                                 get_target=dict(target="target"),
+                                 split_data=dict(train_size=0.8, test_size=0.2),
+                                 params=dict(n_estimators=10, max_depth=3)),
+                score_model=dict(featurize=True, path_to_tmo=str(tmp_path / save_tmo)))
+
+
+@pytest.mark.parametrize("save_tmo, sparse", [("model.pkl", False), ("model", True)])
+def test_scoring_featurizes_as_when_training(tmp_path, save_tmo, sparse):
+    config = featurizing_config(tmp_path, save_tmo, sparse=sparse)
+    df = make_dataset(300)
+    df["id"] = np.arange(len(df))
+
+    train_config = {k: v for k, v in config["train_model"].items() if k != "featurize"}
+    model = train_model(df.copy(), features=compile_feature_pipeline(config, "train_model"), **train_config)
+
+    # New data holds the target, ids and columns that were not chosen as features, as scored data does
+    fresh = make_dataset(100, random_state=7)
+    fresh["id"] = np.arange(len(fresh))
+    features = get_feature_pipeline(config)
+    X = choose_features(features.transform(fresh.copy()), **config["train_model"]["choose_features"])
+    expected = model.predict(to_model_input(X))
+
+    np.testing.assert_array_equal(score_model(fresh.copy(), features=features, **config["score_model"]), expected)
+    np.testing.assert_array_equal(score_model(fresh.copy(), features=features, n_jobs=2, **config["score_model"]),
+                                  expected)
+
+    chunks = (fresh.iloc[start:start + 30].copy() for start in range(0, len(fresh), 30))
+    score_chunks(chunks, features=features, save_scores=str(tmp_path / "scores.csv"), **config["score_model"])
+    np.testing.assert_array_equal(read_frame(str(tmp_path / "scores.csv")).iloc[:, 0].values, expected)
+
+
+def test_scoring_with_predict_proba_saves_probabilities(tmp_path):
+    config = featurizing_config(tmp_path, "model")
+    config["score_model"]["method"] = "predict_proba"
+    df = make_dataset(300)
+
+    train_config = {k: v for k, v in config["train_model"].items() if k != "featurize"}
+    model = train_model(df.copy(), features=compile_feature_pipeline(config, "train_model"), **train_config)
+
+    fresh = make_dataset(100, random_state=7)
+    features = get_feature_pipeline(config)
+    X = choose_features(features.transform(fresh.copy()), **config["train_model"]["choose_features"])
+    expected = model.predict_proba(to_model_input(X))[:, 1]
+
+    np.testing.assert_allclose(score_model(fresh.copy(), features=features, **config["score_model"]), expected)
+    np.testing.assert_allclose(score_model(fresh.copy(), features=features, n_jobs=2, **config["score_model"]),
+                               expected)
+
+    chunks = (fresh.iloc[start:start + 30].copy() for start in range(0, len(fresh), 30))
+    score_chunks(chunks, features=features, save_scores=str(tmp_path / "scores.csv"), **config["score_model"])
+    scores = read_frame(str(tmp_path / "scores.csv")).iloc[:, 0].values
+    np.testing.assert_allclose(scores, expected, rtol=1e-6)
+
+    # Probabilities rather than labels can be evaluated with auc and logloss
+    evaluation = evaluate_model(fresh["target"].values, scores, metrics_to_use=["auc", "logloss"])
+    assert set(evaluation) >= {"auc", "logloss"}
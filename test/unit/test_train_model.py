@@ -0,0 +1,15 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.train_model import hash_splits
+
+
+@pytest.mark.parametrize("random_state", [24, -1, 12345678901234567890])
+def test_hash_splits_depend_only_on_keys_and_seed(random_state):
+    keys = pd.Series(np.arange(10000))
+    assigned = hash_splits(keys, 0.6, 0.2, 0.2, random_state=random_state)
+
+    np.testing.assert_array_equal(hash_splits(keys.iloc[::-1], 0.6, 0.2, 0.2, random_state)[::-1], assigned)
+    np.testing.assert_allclose(np.bincount(assigned) / len(keys), [0.6, 0.2, 0.2], atol=0.02)
+    assert (hash_splits(keys, 0.6, 0.2, 0.2, random_state=random_state + 1) != assigned).any()